@@ -2,6 +2,10 @@ import reader
 import cellmodel
 import helpers
 import meanshift
+import predictor
+import confidence
+import detection
+import convergence
 import hdf5_read
 import measurement
 import ivct_cmd
\ No newline at end of file
@@ -0,0 +1,285 @@
+/* Python extension module exposing the meanshift C kernel (see meanshift.c)
+ * the module is compiled once by setup.py, no compiler is needed at runtime
+ */
+#define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
+#include <Python.h>
+#include <numpy/arrayobject.h>
+#include <numpy/npy_math.h>
+
+#ifndef _WIN32
+#include <pthread.h>
+#endif
+
+#include "meanshift.h"
+
+#define MIN(a, b)  (((a) < (b)) ? (a) : (b))
+#define MAX(a, b)  (((a) > (b)) ? (a) : (b))
+#define MAX_THREADS 256
+
+static int check_array(PyArrayObject *array,int type_num,int ndim,const char *name){
+	//input arrays may be read-only (e.g. frames decoded by PIL)
+	if(PyArray_TYPE(array)!=type_num || PyArray_NDIM(array)!=ndim || !PyArray_ISCARRAY_RO(array)){
+		PyErr_Format(PyExc_TypeError,"%s: wrong type, dimension or memory layout",name);
+		return 0;
+	}
+	return 1;
+}
+
+static int check_finite(PyArrayObject *triangles,double off_x,double off_y){
+	//the kernels cast the triangle coordinates to pixel indices, NaN or infinite values are rejected
+	double *p = (double *)PyArray_DATA(triangles);
+	npy_intp i,n = PyArray_SIZE(triangles);
+	if(!npy_isfinite(off_x) || !npy_isfinite(off_y)){
+		PyErr_SetString(PyExc_ValueError,"offset: finite values expected");
+		return 0;
+	}
+	for(i=0;i<n;i++)
+		if(!npy_isfinite(p[i])){
+			PyErr_SetString(PyExc_ValueError,"triangles: finite coordinates expected");
+			return 0;
+		}
+	return 1;
+}
+
+/* a job is a contiguous part of a triangle table, jobs are run on a pool of native threads
+ * while the GIL is released, each thread writes its own rows of the out array
+ */
+enum {JOB_U8,JOB_U16,JOB_F32,JOB_MOMENTS};
+enum {MODE_BBOX,MODE_SCANLINE,MODE_SCANLINE32};
+
+typedef struct {
+	int kind;
+	int mode;         //kernel: MODE_BBOX, MODE_SCANLINE or MODE_SCANLINE32
+	void *pdata;      //image (or S prefix sums for JOB_MOMENTS)
+	double *X;        //x-moment prefix sums (JOB_MOMENTS)
+	double *LUT;
+	int sizex,sizey;
+	double off_x,off_y;
+	double *TRIANGLES;
+	int n_triangles;
+	double *OUT;
+} job_t;
+
+static void *run_job(void *arg){
+	job_t *job = (job_t *)arg;
+	switch(job->kind){
+	case JOB_U8:
+		if(job->mode==MODE_SCANLINE32)
+			compute_g_scan32_list((unsigned char *)job->pdata,job->sizex,job->sizey,job->off_x,job->off_y,job->TRIANGLES,job->n_triangles,job->OUT,job->LUT);
+		else if(job->mode==MODE_SCANLINE)
+			compute_g_scan_list((unsigned char *)job->pdata,job->sizex,job->sizey,job->off_x,job->off_y,job->TRIANGLES,job->n_triangles,job->OUT,job->LUT);
+		else
+			compute_g_list((unsigned char *)job->pdata,job->sizex,job->sizey,job->off_x,job->off_y,job->TRIANGLES,job->n_triangles,job->OUT,job->LUT);
+		break;
+	case JOB_U16:
+		if(job->mode==MODE_SCANLINE32)
+			compute_g_scan32_list_u16((unsigned short *)job->pdata,job->sizex,job->sizey,job->off_x,job->off_y,job->TRIANGLES,job->n_triangles,job->OUT,job->LUT);
+		else if(job->mode==MODE_SCANLINE)
+			compute_g_scan_list_u16((unsigned short *)job->pdata,job->sizex,job->sizey,job->off_x,job->off_y,job->TRIANGLES,job->n_triangles,job->OUT,job->LUT);
+		else
+			compute_g_list_u16((unsigned short *)job->pdata,job->sizex,job->sizey,job->off_x,job->off_y,job->TRIANGLES,job->n_triangles,job->OUT,job->LUT);
+		break;
+	case JOB_F32:
+		if(job->mode==MODE_SCANLINE32)
+			compute_g_scan32_list_f32((float *)job->pdata,job->sizex,job->sizey,job->off_x,job->off_y,job->TRIANGLES,job->n_triangles,job->OUT,job->LUT);
+		else if(job->mode==MODE_SCANLINE)
+			compute_g_scan_list_f32((float *)job->pdata,job->sizex,job->sizey,job->off_x,job->off_y,job->TRIANGLES,job->n_triangles,job->OUT,job->LUT);
+		else
+			compute_g_list_f32((float *)job->pdata,job->sizex,job->sizey,job->off_x,job->off_y,job->TRIANGLES,job->n_triangles,job->OUT,job->LUT);
+		break;
+	default:
+		compute_moments_list((double *)job->pdata,job->X,job->sizex,job->sizey,job->off_x,job->off_y,job->TRIANGLES,job->n_triangles,job->OUT);
+	}
+	return NULL;
+}
+
+static int run_jobs(job_t *job,int nthreads){
+	//split the triangle table in nthreads parts, returns the number of threads used
+	job_t jobs[MAX_THREADS];
+	int i,first,n;
+#ifndef _WIN32
+	pthread_t threads[MAX_THREADS];
+	int started[MAX_THREADS];
+#endif
+
+	nthreads = MAX(MIN(MIN(nthreads,MAX_THREADS),job->n_triangles),1);
+#ifdef _WIN32
+	nthreads = 1; //native thread pool only available on POSIX systems
+#endif
+	first = 0;
+	for(i=0;i<nthreads;i++){
+		n = job->n_triangles/nthreads + (i < job->n_triangles%nthreads ? 1 : 0);
+		jobs[i] = *job;
+		jobs[i].TRIANGLES = job->TRIANGLES+6*first;
+		jobs[i].OUT = job->OUT+8*first;
+		jobs[i].n_triangles = n;
+		first += n;
+	}
+
+	Py_BEGIN_ALLOW_THREADS
+#ifndef _WIN32
+	for(i=1;i<nthreads;i++)
+		started[i] = (pthread_create(threads+i,NULL,run_job,jobs+i) == 0);
+#endif
+	run_job(jobs);
+#ifndef _WIN32
+	for(i=1;i<nthreads;i++){
+		if(started[i])
+			pthread_join(threads[i],NULL);
+		else
+			run_job(jobs+i); //thread creation failed, run the part in the calling thread
+	}
+#endif
+	Py_END_ALLOW_THREADS
+
+	return nthreads;
+}
+
+static PyObject *py_compute_g_list(PyObject *self,PyObject *args){
+	PyArrayObject *ima,*triangles,*lut,*out;
+	double off_x,off_y;
+	int lut_size,nthreads=1,mode=MODE_BBOX;
+	job_t job;
+
+	if(!PyArg_ParseTuple(args,"O!O!ddO!O!|ii",
+			&PyArray_Type,&ima,&PyArray_Type,&triangles,&off_x,&off_y,
+			&PyArray_Type,&lut,&PyArray_Type,&out,&nthreads,&mode))
+		return NULL;
+
+	if(PyArray_NDIM(ima)!=2 || !PyArray_ISCARRAY_RO(ima) || !PyArray_ISNOTSWAPPED(ima)){
+		PyErr_SetString(PyExc_TypeError,"ima: 2D C-contiguous native byte order array expected");
+		return NULL;
+	}
+	if(!check_array(triangles,NPY_FLOAT64,2,"triangles")) return NULL;
+	if(!check_array(lut,NPY_FLOAT64,1,"lut")) return NULL;
+	if(!check_array(out,NPY_FLOAT64,2,"out")) return NULL;
+	if(!PyArray_ISWRITEABLE(out)){
+		PyErr_SetString(PyExc_ValueError,"out: writeable array expected");
+		return NULL;
+	}
+	if(PyArray_DIM(triangles,1)!=6 || PyArray_DIM(out,1)!=8 || PyArray_DIM(out,0)!=PyArray_DIM(triangles,0)){
+		PyErr_SetString(PyExc_ValueError,"triangles (K,6) and out (K,8) expected");
+		return NULL;
+	}
+	if(!check_finite(triangles,off_x,off_y)) return NULL;
+
+	switch(PyArray_TYPE(ima)){
+	case NPY_UINT8:
+		job.kind = JOB_U8;
+		lut_size = 256;
+		break;
+	case NPY_UINT16:
+		job.kind = JOB_U16;
+		lut_size = 65536;
+		break;
+	case NPY_FLOAT32:
+		job.kind = JOB_F32;
+		lut_size = 3; //power law parameters
+		break;
+	default:
+		PyErr_SetString(PyExc_TypeError,"ima: uint8, uint16 or float32 array expected");
+		return NULL;
+	}
+	if(PyArray_DIM(lut,0)<lut_size){
+		PyErr_Format(PyExc_ValueError,"lut: %d entries expected",lut_size);
+		return NULL;
+	}
+
+	if(mode<MODE_BBOX || mode>MODE_SCANLINE32){
+		PyErr_SetString(PyExc_ValueError,"mode: 0 (bounding box), 1 (scanline) or 2 (scanline, float32 accumulation) expected");
+		return NULL;
+	}
+
+	job.mode = mode;
+	job.pdata = PyArray_DATA(ima);
+	job.X = NULL;
+	job.LUT = (double *)PyArray_DATA(lut);
+	job.sizex = (int)PyArray_DIM(ima,1);
+	job.sizey = (int)PyArray_DIM(ima,0);
+	job.off_x = off_x;
+	job.off_y = off_y;
+	job.TRIANGLES = (double *)PyArray_DATA(triangles);
+	job.n_triangles = (int)PyArray_DIM(triangles,0);
+	job.OUT = (double *)PyArray_DATA(out);
+
+	run_jobs(&job,nthreads);
+
+	return Py_BuildValue("i",job.n_triangles);
+}
+
+static PyObject *py_compute_moments_list(PyObject *self,PyObject *args){
+	PyArrayObject *S,*X,*triangles,*out;
+	double off_x,off_y;
+	int nthreads=1;
+	job_t job;
+
+	if(!PyArg_ParseTuple(args,"O!O!O!ddO!|i",
+			&PyArray_Type,&S,&PyArray_Type,&X,&PyArray_Type,&triangles,&off_x,&off_y,
+			&PyArray_Type,&out,&nthreads))
+		return NULL;
+
+	if(!check_array(S,NPY_FLOAT64,2,"S")) return NULL;
+	if(!check_array(X,NPY_FLOAT64,2,"X")) return NULL;
+	if(!check_array(triangles,NPY_FLOAT64,2,"triangles")) return NULL;
+	if(!check_array(out,NPY_FLOAT64,2,"out")) return NULL;
+	if(!PyArray_ISWRITEABLE(out)){
+		PyErr_SetString(PyExc_ValueError,"out: writeable array expected");
+		return NULL;
+	}
+	if(PyArray_DIM(triangles,1)!=6 || PyArray_DIM(out,1)!=8 || PyArray_DIM(out,0)!=PyArray_DIM(triangles,0)){
+		PyErr_SetString(PyExc_ValueError,"triangles (K,6) and out (K,8) expected");
+		return NULL;
+	}
+	if(!check_finite(triangles,off_x,off_y)) return NULL;
+	if(PyArray_DIM(S,0)!=PyArray_DIM(X,0) || PyArray_DIM(S,1)!=PyArray_DIM(X,1) || PyArray_DIM(S,1)<2){
+		PyErr_SetString(PyExc_ValueError,"S and X (sizeY,sizeX+1) expected");
+		return NULL;
+	}
+
+	job.kind = JOB_MOMENTS;
+	job.mode = MODE_BBOX;
+	job.pdata = PyArray_DATA(S);
+	job.X = (double *)PyArray_DATA(X);
+	job.LUT = NULL;
+	job.sizex = (int)PyArray_DIM(S,1)-1;
+	job.sizey = (int)PyArray_DIM(S,0);
+	job.off_x = off_x;
+	job.off_y = off_y;
+	job.TRIANGLES = (double *)PyArray_DATA(triangles);
+	job.n_triangles = (int)PyArray_DIM(triangles,0);
+	job.OUT = (double *)PyArray_DATA(out);
+
+	run_jobs(&job,nthreads);
+
+	return Py_BuildValue("i",job.n_triangles);
+}
+
+static PyMethodDef meanshift_methods[] = {
+	{"compute_g_list",py_compute_g_list,METH_VARARGS,
+	 "compute_g_list(ima,triangles,offset_x,offset_y,lut,out[,nthreads[,mode]]) -> n\n\n"
+	 "compute the meanshift statistics of each (K,6) triangle into the (K,8) out array\n"
+	 "the triangles are split over nthreads native threads, the GIL is released during the computation\n"
+	 "mode=1 walks each triangle row by row, anti-aliasing is only computed on the boundary pixels\n"
+	 "mode=2 idem with float32 accumulation of the interior spans (normalized lut expected)\n"
+	 "ima is uint8 (256 entries lut), uint16 (65536 entries lut) or float32 (lut = power law {offset,sign,exp})"},
+	{"compute_moments_list",py_compute_moments_list,METH_VARARGS,
+	 "compute_moments_list(S,X,triangles,offset_x,offset_y,out[,nthreads]) -> n\n\n"
+	 "compute the crisp mass and centroid of each (K,6) triangle from the row prefix sums S and X"},
+	{NULL,NULL,0,NULL}
+};
+
+#if PY_MAJOR_VERSION >= 3
+static struct PyModuleDef meanshift_module = {
+	PyModuleDef_HEAD_INIT,"_meanshift",NULL,-1,meanshift_methods
+};
+
+PyMODINIT_FUNC PyInit__meanshift(void){
+	import_array();
+	return PyModule_Create(&meanshift_module);
+}
+#else
+PyMODINIT_FUNC init_meanshift(void){
+	Py_InitModule("_meanshift",meanshift_methods);
+	import_array();
+}
+#endif
@@ -1,200 +1,210 @@
 #define MIN(a, b)  (((a) < (b)) ? (a) : (b))
 #define MAX(a, b)  (((a) > (b)) ? (a) : (b))
+//clamp in double precision before any int cast, NaN is mapped to lo
+#define CLAMP(v, lo, hi)  (((v) >= (lo)) ? MIN((v),(hi)) : (lo))
 
 #include <stdio.h>
 #include <math.h>
 
-int compute_g(unsigned char * pdata,int sizeX,int sizeY,double off_x,double off_y,double *TRIANGLE,double *DATA,double *LUT) {
-	int bbx0,bby0,bbx1,bby1;
-	int xint,yint;
-	long int pos;
-	unsigned char *pimage;
+#define LANES 8 //independent partial sums of the scanline interior spans
 
-	double a0,b0,c0,a1,b1,c1,a2,b2,c2;
-	double s0,s1,s2;
-	double x0,y0,x1,y1,x2,y2,x,y;
-
-	double mx0,my0,mx1,my1,mx2,my2;
-
-	double xcentre,ycentre,xr,yr;
-	double alpha,surf,surfalpha,value,totalvalue,gmin,gmax;
+static void edge_line(double x0,double y0,double x1,double y1,double x2,double y2,double *a,double *b,double *c,double *s){
+	//normalised line coefficients of the side (x0,y0)-(x1,y1), s is the sign of the opposite vertex (x2,y2)
 	double n;
-
-	double sumX,sumY,sumXw,sumYw;
-
-	pimage = (unsigned char*)pdata;
-
-    mx0 = TRIANGLE[0]+off_x;
-	my0 = TRIANGLE[1]+off_y;
-	mx1 = TRIANGLE[2]+off_x;
-	my1 = TRIANGLE[3]+off_y;
-	mx2 = TRIANGLE[4]+off_x;
-	my2 = TRIANGLE[5]+off_y;
-
-	x0 = mx1;
-	y0 = my1;
-	x1 = mx0;
-	y1 = my0;
-	x2 = mx2;
-	y2 = my2;
-
-	//triangle bounding box
-	bbx0 = (int)(MIN(MIN(x0,x1),x2))-1;
-	bbx1 = (int)(MAX(MAX(x0,x1),x2))+1;
-	bby0 = (int)(MIN(MIN(y0,y1),y2))-1;
-	bby1 = (int)(MAX(MAX(y0,y1),y2))+1;
-
-	//triangle center
-	xcentre = (x0+x1+x2)/3.0;
-	ycentre = (y0+y1+y2)/3.0;
-
-	//triangle sides
-	if(x0==x1){
-		a0 = 1.0;
-		b0 = 0.0;
-		c0 = -x0;
-	}
-	else{
-		if(y0==y1){
-			a0 = 0.0;
-			b0 = 1.0;
-			c0 = -y0;
-		}
-		else{
-			a0 = 1.0/(x1-x0);
-			b0 = -1.0/(y1-y0);
-			c0 = y0/(y1-y0) - x0/(x1-x0);
-		}
-	}
-	//normalisation
-	n = sqrt(a0*a0+b0*b0);	a0 /= n; b0/= n; c0 /= n;
-	if ((a0*x2+b0*y2+c0) > 0) s0 = 1.0; else s0 = -1.0;
-	x0 = mx1;
-	y0 = my1;
-	x1 = mx2;
-	y1 = my2;
-	x2 = mx0;
-	y2 = my0;
-
 	if(x0==x1){
-		a1 = 1.0;
-		b1 = 0.0;
-		c1 = -x0;
+		*a = 1.0;
+		*b = 0.0;
+		*c = -x0;
 	}
 	else{
 		if(y0==y1){
-			a1 = 0.0;
-			b1 = 1.0;
-			c1 = -y0;
+			*a = 0.0;
+			*b = 1.0;
+			*c = -y0;
 		}
 		else{
-			a1 = 1.0/(x1-x0);
-			b1 = -1.0/(y1-y0);
-			c1 = y0/(y1-y0) - x0/(x1-x0);
+			*a = 1.0/(x1-x0);
+			*b = -1.0/(y1-y0);
+			*c = y0/(y1-y0) - x0/(x1-x0);
 		}
 	}
-	//normalisation
-	n = sqrt(a1*a1+b1*b1);	a1 /= n; b1/= n; c1 /= n;
-	if ((a1*x2+b1*y2+c1) > 0.0) s1 = 1.0; else s1 = -1.0;
-
-	x0 = mx0;
-	y0 = my0;
-	x1 = mx2;
-	y1 = my2;
-	x2 = mx1;
-	y2 = my1;
+	n = sqrt((*a)*(*a)+(*b)*(*b)); *a /= n; *b /= n; *c /= n;
+	if (((*a)*x2+(*b)*y2+(*c)) > 0.0) *s = 1.0; else *s = -1.0;
+}
 
-	if(x0==x1){
-		a2 = 1.0;
-		b2 = 0.0;
-		c2 = -x0;
+//uint8 images, 256 entries LUT
+#define KERNEL compute_g
+#define KERNEL_LIST compute_g_list
+#define KERNEL_SCAN compute_g_scan
+#define KERNEL_SCAN_LIST compute_g_scan_list
+#define ACC_T double
+#define PIXEL_T unsigned char
+#define WEIGHT(p) (LUT[(p)])
+#include "meanshift_kernel.h"
+#undef KERNEL
+#undef KERNEL_LIST
+#undef KERNEL_SCAN
+#undef KERNEL_SCAN_LIST
+#undef ACC_T
+#undef PIXEL_T
+#undef WEIGHT
+
+//uint16 images, 65536 entries LUT
+#define KERNEL compute_g_u16
+#define KERNEL_LIST compute_g_list_u16
+#define KERNEL_SCAN compute_g_scan_u16
+#define KERNEL_SCAN_LIST compute_g_scan_list_u16
+#define ACC_T double
+#define PIXEL_T unsigned short
+#define WEIGHT(p) (LUT[(p)])
+#include "meanshift_kernel.h"
+#undef KERNEL
+#undef KERNEL_LIST
+#undef KERNEL_SCAN
+#undef KERNEL_SCAN_LIST
+#undef ACC_T
+#undef PIXEL_T
+#undef WEIGHT
+
+//float32 images, power law weight: LUT = {offset,sign,exp}, weight = MAX(offset+sign*p,0)^exp
+#define KERNEL compute_g_f32
+#define KERNEL_LIST compute_g_list_f32
+#define KERNEL_SCAN compute_g_scan_f32
+#define KERNEL_SCAN_LIST compute_g_scan_list_f32
+#define ACC_T double
+#define PIXEL_T float
+#define WEIGHT(p) (pow(MAX(LUT[0]+LUT[1]*(double)(p),0.0),LUT[2]))
+#include "meanshift_kernel.h"
+#undef KERNEL
+#undef KERNEL_LIST
+#undef KERNEL_SCAN
+#undef KERNEL_SCAN_LIST
+#undef ACC_T
+#undef PIXEL_T
+#undef WEIGHT
+
+//float32 accumulation (normalized weights, see meanshift.compute_g_float32), scanline kernels only
+#define KERNEL_SCAN compute_g_scan32
+#define KERNEL_SCAN_LIST compute_g_scan32_list
+#define ACC_T float
+#define PIXEL_T unsigned char
+#define WEIGHT(p) (LUT[(p)])
+#include "meanshift_kernel.h"
+#undef KERNEL_SCAN
+#undef KERNEL_SCAN_LIST
+#undef ACC_T
+#undef PIXEL_T
+#undef WEIGHT
+
+#define KERNEL_SCAN compute_g_scan32_u16
+#define KERNEL_SCAN_LIST compute_g_scan32_list_u16
+#define ACC_T float
+#define PIXEL_T unsigned short
+#define WEIGHT(p) (LUT[(p)])
+#include "meanshift_kernel.h"
+#undef KERNEL_SCAN
+#undef KERNEL_SCAN_LIST
+#undef ACC_T
+#undef PIXEL_T
+#undef WEIGHT
+
+#define KERNEL_SCAN compute_g_scan32_f32
+#define KERNEL_SCAN_LIST compute_g_scan32_list_f32
+#define ACC_T float
+#define PIXEL_T float
+#define WEIGHT(p) (pow(MAX(LUT[0]+LUT[1]*(double)(p),0.0),LUT[2]))
+#include "meanshift_kernel.h"
+#undef KERNEL_SCAN
+#undef KERNEL_SCAN_LIST
+#undef ACC_T
+#undef PIXEL_T
+#undef WEIGHT
+
+int compute_moments(double *S,double *X,int sizeX,int sizeY,double off_x,double off_y,double *TRIANGLE,double *DATA) {
+	//triangle mass and centroid from the row prefix sums S (weights) and X (x-moments), both (sizeY,sizeX+1)
+	//each triangle row is a [xl,xr] pixel span, cost is proportional to the triangle height
+	double mx[3],my[3],a[3],b[3],c[3],s[3];
+	double lo,hi,t,r,y,mass,sumX,sumY,span,surf,xcentre,ycentre;
+	int i,yint,y0,y1,xl,xr;
+	long int row;
+	static const int vertex[3][3] = {{1,0,2},{1,2,0},{0,2,1}};
+
+	for(i=0;i<3;i++){
+		mx[i] = TRIANGLE[2*i]+off_x;
+		my[i] = TRIANGLE[2*i+1]+off_y;
 	}
-	else{
-		if(y0==y1){
-			a2 = 0.0;
-			b2 = 1.0;
-			c2 = -y0;
-		}
-		else{
-			a2 = 1.0/(x1-x0);
-			b2 = -1.0/(y1-y0);
-			c2 = y0/(y1-y0) - x0/(x1-x0);
-		}
+	for(i=0;i<3;i++){
+		edge_line(mx[vertex[i][0]],my[vertex[i][0]],mx[vertex[i][1]],my[vertex[i][1]],mx[vertex[i][2]],my[vertex[i][2]],
+			a+i,b+i,c+i,s+i);
+		a[i] *= s[i]; b[i] *= s[i]; c[i] *= s[i];
 	}
-	//normalisation
-	n = sqrt(a2*a2+b2*b2);	a2 /= n; b2/= n; c2 /= n;
-	if ((a2*x2+b2*y2+c2) > 0.0) s2 = 1.0; else s2 = -1.0;
-
-	//Data table Filling
-	surf = 0.0f;
-	surfalpha = 0.0f;
-	totalvalue =  0.0f;
-	gmax = 0.0f;
-	gmin = 1e31;
-	sumX=sumY=sumXw=sumYw = 0.0;
-	for(xint=bbx0;xint<=bbx1;xint++)
-	{
-		for(yint=bby0;yint<=bby1;yint++){
-			pos = xint +yint * sizeX;
-			x = (double)xint;
-			y = (double)yint;
-			xr = x - xcentre;
-			yr = y - ycentre;
-			if((((a0*x+b0*y+c0)*s0)>=0.0)&&
-				(((a1*x+b1*y+c1)*s1)>=0.0)&&
-				(((a2*x+b2*y+c2)*s2)>=0.0))
-			{
-				alpha = MIN(fabs(a0*x+b0*y+c0),1.0) * MIN(fabs(a1*x+b1*y+c1),1.0) * MIN(fabs(a2*x+b2*y+c2),1.0);
-				value = (double)(LUT[*(pimage+pos)]);
-				sumX += xr*alpha;
-				sumY += yr*alpha;
-				sumXw += xr*alpha*value;
-				sumYw += yr*alpha*value;
-				surfalpha += alpha;//
-				surf += 1;//crisp
-				totalvalue += (value*alpha);
-				gmin = MIN(gmin,value);
-				gmax = MAX(gmax,value);
-
+	xcentre = (mx[0]+mx[1]+mx[2])/3.0;
+	ycentre = (my[0]+my[1]+my[2])/3.0;
+
+	y0 = (int)ceil(CLAMP(MIN(MIN(my[0],my[1]),my[2]),0.0,(double)sizeY));
+	y1 = (int)floor(CLAMP(MAX(MAX(my[0],my[1]),my[2]),-1.0,(double)(sizeY-1)));
+
+	mass = sumX = sumY = surf = 0.0;
+	for(yint=y0;yint<=y1;yint++){
+		y = (double)yint;
+		lo = 0.0;
+		hi = (double)(sizeX-1);
+		for(i=0;i<3;i++){
+			//a*x + r >= 0
+			r = b[i]*y+c[i];
+			if(a[i]>0.0){
+				t = -r/a[i];
+				lo = MAX(lo,t);
 			}
+			else if(a[i]<0.0){
+				t = -r/a[i];
+				hi = MIN(hi,t);
+			}
+			else if(r<0.0)
+				hi = -1.0;
 		}
+		if(!(lo<=hi))
+			continue; //empty (or undefined) span
+		xl = (int)ceil(lo);
+		xr = (int)floor(hi);
+		if(xl>xr)
+			continue;
+		row = (long int)yint*(sizeX+1);
+		span = S[row+xr+1]-S[row+xl];
+		mass += span;
+		sumX += X[row+xr+1]-X[row+xl];
+		sumY += y*span;
+		surf += xr-xl+1;
 	}
-	if(surfalpha>0.0){
-		sumX /= surfalpha;
-		sumY /= surfalpha;
 
-		sumX += xcentre;
-		sumY += ycentre;
+	if(mass>0.0){
+		DATA[0] = sumX/mass;
+		DATA[1] = sumY/mass;
 	}
-
-	if(totalvalue>0.0){
-		sumXw /= totalvalue;
-		sumYw /= totalvalue;
-
-		sumXw += xcentre;
-		sumYw += ycentre;
-	}else
-	{
-		sumXw = xcentre;//m_p0.mX;
-		sumYw = ycentre;//m_p0.mY;
+	else{
+		DATA[0] = xcentre;
+		DATA[1] = ycentre;
 	}
-
-
-	DATA[0] = (double)sumXw;//centroid
-	DATA[1] = (double)sumYw;//centroid
-	DATA[2] = (double)surf;//surfCrisp
-	DATA[3] = (double)surfalpha;//surfAlpha
-	DATA[4] = (double)totalvalue;//sum
-	DATA[5] = (double)gmax; //max
-	DATA[6] = (double)gmin; //min
-	if(surfalpha>0.0)
-		DATA[7] = (double)(totalvalue/surfalpha);//mean
+	DATA[2] = surf;
+	DATA[3] = surf;
+	DATA[4] = mass;
+	DATA[5] = NAN;
+	DATA[6] = NAN;
+	if(surf>0.0)
+		DATA[7] = mass/surf;
 	else
-		DATA[7] = (double)0.0;
-
+		DATA[7] = 0.0;
 
 	return 0;
 }
 
+int compute_moments_list(double *S,double *X,int sizeX,int sizeY,double off_x,double off_y,double *TRIANGLES,int n_triangles,double *DATA) {
+	//process a complete (n_triangles,6) triangle table with the moment store, results are stored in DATA (n_triangles,8)
+	int i;
 
+	for(i=0;i<n_triangles;i++){
+		compute_moments(S,X,sizeX,sizeY,off_x,off_y,TRIANGLES+6*i,DATA+8*i);
+	}
 
+	return n_triangles;
+}
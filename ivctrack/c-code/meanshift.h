@@ -1,2 +1,32 @@
-int compute_g(char * pdata,int len,int sizeX,int sizeY,double mx0,double my0,
-				double mx1,double my1,double mx2,double my2,double DATA[8],double LUT[256]);
+int compute_g(unsigned char * pdata,int sizeX,int sizeY,double off_x,double off_y,
+				double *TRIANGLE,double *DATA,double *LUT);
+
+int compute_g_list(unsigned char * pdata,int sizeX,int sizeY,double off_x,double off_y,
+				double *TRIANGLES,int n_triangles,double *DATA,double *LUT);
+
+int compute_moments_list(double *S,double *X,int sizeX,int sizeY,double off_x,double off_y,
+				double *TRIANGLES,int n_triangles,double *DATA);
+
+int compute_g_list_u16(unsigned short * pdata,int sizeX,int sizeY,double off_x,double off_y,
+				double *TRIANGLES,int n_triangles,double *DATA,double *LUT);
+
+int compute_g_list_f32(float * pdata,int sizeX,int sizeY,double off_x,double off_y,
+				double *TRIANGLES,int n_triangles,double *DATA,double *LAW);
+
+int compute_g_scan_list(unsigned char * pdata,int sizeX,int sizeY,double off_x,double off_y,
+				double *TRIANGLES,int n_triangles,double *DATA,double *LUT);
+
+int compute_g_scan_list_u16(unsigned short * pdata,int sizeX,int sizeY,double off_x,double off_y,
+				double *TRIANGLES,int n_triangles,double *DATA,double *LUT);
+
+int compute_g_scan_list_f32(float * pdata,int sizeX,int sizeY,double off_x,double off_y,
+				double *TRIANGLES,int n_triangles,double *DATA,double *LAW);
+
+int compute_g_scan32_list(unsigned char * pdata,int sizeX,int sizeY,double off_x,double off_y,
+				double *TRIANGLES,int n_triangles,double *DATA,double *LUT);
+
+int compute_g_scan32_list_u16(unsigned short * pdata,int sizeX,int sizeY,double off_x,double off_y,
+				double *TRIANGLES,int n_triangles,double *DATA,double *LUT);
+
+int compute_g_scan32_list_f32(float * pdata,int sizeX,int sizeY,double off_x,double off_y,
+				double *TRIANGLES,int n_triangles,double *DATA,double *LAW);
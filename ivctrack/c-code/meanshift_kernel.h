@@ -0,0 +1,387 @@
+/* meanshift kernel template, included once per pixel type by meanshift.c
+ * the including file defines:
+ *   KERNEL       name of the single triangle function (optional)
+ *   KERNEL_LIST  name of the triangle table function (optional)
+ *   KERNEL_SCAN, KERNEL_SCAN_LIST  names of the scanline versions
+ *   PIXEL_T      image pixel type
+ *   WEIGHT(p)    weight of the pixel value p, computed from LUT
+ *   ACC_T        accumulator type of the scanline interior spans (double or float)
+ */
+
+#ifdef KERNEL
+
+int KERNEL(PIXEL_T * pdata,int sizeX,int sizeY,double off_x,double off_y,double *TRIANGLE,double *DATA,double *LUT) {
+	int bbx0,bby0,bbx1,bby1;
+	int xint,yint;
+	long int pos;
+	PIXEL_T *pimage;
+
+	double a0,b0,c0,a1,b1,c1,a2,b2,c2;
+	double s0,s1,s2;
+	double x0,y0,x1,y1,x2,y2,x,y;
+
+	double mx0,my0,mx1,my1,mx2,my2;
+
+	double xcentre,ycentre,xr,yr;
+	double alpha,surf,surfalpha,value,totalvalue,gmin,gmax;
+	double n;
+
+	double sumX,sumY,sumXw,sumYw;
+
+	pimage = (PIXEL_T*)pdata;
+
+    mx0 = TRIANGLE[0]+off_x;
+	my0 = TRIANGLE[1]+off_y;
+	mx1 = TRIANGLE[2]+off_x;
+	my1 = TRIANGLE[3]+off_y;
+	mx2 = TRIANGLE[4]+off_x;
+	my2 = TRIANGLE[5]+off_y;
+
+	x0 = mx1;
+	y0 = my1;
+	x1 = mx0;
+	y1 = my0;
+	x2 = mx2;
+	y2 = my2;
+
+	//triangle bounding box, clipped to the image: border triangles are never read out of bounds
+	//and the inner loop is the same for interior and border triangles
+	//the coordinates are clamped to [-1,size] before the int cast (huge or NaN values)
+	bbx0 = MIN(MAX((int)CLAMP(MIN(MIN(x0,x1),x2),-1.0,(double)sizeX)-1,0),sizeX-1);
+	bbx1 = MAX(MIN((int)CLAMP(MAX(MAX(x0,x1),x2),-1.0,(double)sizeX)+1,sizeX-1),0);
+	bby0 = MIN(MAX((int)CLAMP(MIN(MIN(y0,y1),y2),-1.0,(double)sizeY)-1,0),sizeY-1);
+	bby1 = MAX(MIN((int)CLAMP(MAX(MAX(y0,y1),y2),-1.0,(double)sizeY)+1,sizeY-1),0);
+
+	//triangle center
+	xcentre = (x0+x1+x2)/3.0;
+	ycentre = (y0+y1+y2)/3.0;
+
+	//triangle sides
+	if(x0==x1){
+		a0 = 1.0;
+		b0 = 0.0;
+		c0 = -x0;
+	}
+	else{
+		if(y0==y1){
+			a0 = 0.0;
+			b0 = 1.0;
+			c0 = -y0;
+		}
+		else{
+			a0 = 1.0/(x1-x0);
+			b0 = -1.0/(y1-y0);
+			c0 = y0/(y1-y0) - x0/(x1-x0);
+		}
+	}
+	//normalisation
+	n = sqrt(a0*a0+b0*b0);	a0 /= n; b0/= n; c0 /= n;
+	if ((a0*x2+b0*y2+c0) > 0) s0 = 1.0; else s0 = -1.0;
+	x0 = mx1;
+	y0 = my1;
+	x1 = mx2;
+	y1 = my2;
+	x2 = mx0;
+	y2 = my0;
+
+	if(x0==x1){
+		a1 = 1.0;
+		b1 = 0.0;
+		c1 = -x0;
+	}
+	else{
+		if(y0==y1){
+			a1 = 0.0;
+			b1 = 1.0;
+			c1 = -y0;
+		}
+		else{
+			a1 = 1.0/(x1-x0);
+			b1 = -1.0/(y1-y0);
+			c1 = y0/(y1-y0) - x0/(x1-x0);
+		}
+	}
+	//normalisation
+	n = sqrt(a1*a1+b1*b1);	a1 /= n; b1/= n; c1 /= n;
+	if ((a1*x2+b1*y2+c1) > 0.0) s1 = 1.0; else s1 = -1.0;
+
+	x0 = mx0;
+	y0 = my0;
+	x1 = mx2;
+	y1 = my2;
+	x2 = mx1;
+	y2 = my1;
+
+	if(x0==x1){
+		a2 = 1.0;
+		b2 = 0.0;
+		c2 = -x0;
+	}
+	else{
+		if(y0==y1){
+			a2 = 0.0;
+			b2 = 1.0;
+			c2 = -y0;
+		}
+		else{
+			a2 = 1.0/(x1-x0);
+			b2 = -1.0/(y1-y0);
+			c2 = y0/(y1-y0) - x0/(x1-x0);
+		}
+	}
+	//normalisation
+	n = sqrt(a2*a2+b2*b2);	a2 /= n; b2/= n; c2 /= n;
+	if ((a2*x2+b2*y2+c2) > 0.0) s2 = 1.0; else s2 = -1.0;
+
+	//Data table Filling
+	surf = 0.0f;
+	surfalpha = 0.0f;
+	totalvalue =  0.0f;
+	gmax = 0.0f;
+	gmin = 1e31;
+	sumX=sumY=sumXw=sumYw = 0.0;
+	for(xint=bbx0;xint<=bbx1;xint++)
+	{
+		for(yint=bby0;yint<=bby1;yint++){
+			pos = xint +yint * sizeX;
+			x = (double)xint;
+			y = (double)yint;
+			xr = x - xcentre;
+			yr = y - ycentre;
+			if((((a0*x+b0*y+c0)*s0)>=0.0)&&
+				(((a1*x+b1*y+c1)*s1)>=0.0)&&
+				(((a2*x+b2*y+c2)*s2)>=0.0))
+			{
+				alpha = MIN(fabs(a0*x+b0*y+c0),1.0) * MIN(fabs(a1*x+b1*y+c1),1.0) * MIN(fabs(a2*x+b2*y+c2),1.0);
+				value = WEIGHT(*(pimage+pos));
+				sumX += xr*alpha;
+				sumY += yr*alpha;
+				sumXw += xr*alpha*value;
+				sumYw += yr*alpha*value;
+				surfalpha += alpha;//
+				surf += 1;//crisp
+				totalvalue += (value*alpha);
+				gmin = MIN(gmin,value);
+				gmax = MAX(gmax,value);
+
+			}
+		}
+	}
+	if(surfalpha>0.0){
+		sumX /= surfalpha;
+		sumY /= surfalpha;
+
+		sumX += xcentre;
+		sumY += ycentre;
+	}
+
+	if(totalvalue>0.0){
+		sumXw /= totalvalue;
+		sumYw /= totalvalue;
+
+		sumXw += xcentre;
+		sumYw += ycentre;
+	}else
+	{
+		sumXw = xcentre;//m_p0.mX;
+		sumYw = ycentre;//m_p0.mY;
+	}
+
+
+	DATA[0] = (double)sumXw;//centroid
+	DATA[1] = (double)sumYw;//centroid
+	DATA[2] = (double)surf;//surfCrisp
+	DATA[3] = (double)surfalpha;//surfAlpha
+	DATA[4] = (double)totalvalue;//sum
+	DATA[5] = (double)gmax; //max
+	DATA[6] = (double)gmin; //min
+	if(surfalpha>0.0)
+		DATA[7] = (double)(totalvalue/surfalpha);//mean
+	else
+		DATA[7] = (double)0.0;
+
+
+	return 0;
+}
+
+int KERNEL_LIST(PIXEL_T * pdata,int sizeX,int sizeY,double off_x,double off_y,double *TRIANGLES,int n_triangles,double *DATA,double *LUT) {
+	//process a complete (n_triangles,6) triangle table in one call, results are stored in DATA (n_triangles,8)
+	int i;
+
+	for(i=0;i<n_triangles;i++){
+		KERNEL(pdata,sizeX,sizeY,off_x,off_y,TRIANGLES+6*i,DATA+8*i,LUT);
+	}
+
+	return n_triangles;
+}
+#endif
+
+int KERNEL_SCAN(PIXEL_T * pdata,int sizeX,int sizeY,double off_x,double off_y,double *TRIANGLE,double *DATA,double *LUT) {
+	//scanline version of KERNEL: each row of the bounding box is walked between the triangle sides,
+	//the anti-aliasing alpha is only computed for the boundary pixels, interior spans have alpha = 1
+	//(same pixels and same weights as KERNEL, only the summation order differs)
+	int bbx0,bby0,bbx1,bby1;
+	int xint,yint,xleft,xright,i,l,n;
+	PIXEL_T *prow;
+	ACC_T laneXw[LANES],laneValue[LANES];
+
+	double mx[3],my[3],a[3],b[3],c[3],s[3],d[3];
+	double y,xr,yr,xcentre,ycentre,t,lo,hi;
+	double alpha,surf,surfalpha,value,totalvalue,gmin,gmax;
+	double sumXw,sumYw;
+	double rowXw,rowValue,rowMin,rowMax;
+	static const int vertex[3][3] = {{1,0,2},{1,2,0},{0,2,1}};
+
+	for(i=0;i<3;i++){
+		mx[i] = TRIANGLE[2*i]+off_x;
+		my[i] = TRIANGLE[2*i+1]+off_y;
+	}
+
+	//triangle bounding box, clipped to the image
+	bbx0 = MIN(MAX((int)CLAMP(MIN(MIN(mx[0],mx[1]),mx[2]),-1.0,(double)sizeX)-1,0),sizeX-1);
+	bbx1 = MAX(MIN((int)CLAMP(MAX(MAX(mx[0],mx[1]),mx[2]),-1.0,(double)sizeX)+1,sizeX-1),0);
+	bby0 = MIN(MAX((int)CLAMP(MIN(MIN(my[0],my[1]),my[2]),-1.0,(double)sizeY)-1,0),sizeY-1);
+	bby1 = MAX(MIN((int)CLAMP(MAX(MAX(my[0],my[1]),my[2]),-1.0,(double)sizeY)+1,sizeY-1),0);
+
+	//triangle center
+	xcentre = (mx[1]+mx[0]+mx[2])/3.0;
+	ycentre = (my[1]+my[0]+my[2])/3.0;
+
+	//triangle sides
+	for(i=0;i<3;i++)
+		edge_line(mx[vertex[i][0]],my[vertex[i][0]],mx[vertex[i][1]],my[vertex[i][1]],mx[vertex[i][2]],my[vertex[i][2]],
+			a+i,b+i,c+i,s+i);
+
+#define SIDES(x) (d[0] = a[0]*(x)+b[0]*y+c[0], d[1] = a[1]*(x)+b[1]*y+c[1], d[2] = a[2]*(x)+b[2]*y+c[2])
+#define INSIDE(x) (SIDES(x), ((d[0]*s[0])>=0.0)&&((d[1]*s[1])>=0.0)&&((d[2]*s[2])>=0.0))
+#define CORE(x) (SIDES(x), (fabs(d[0])>=1.0)&&(fabs(d[1])>=1.0)&&(fabs(d[2])>=1.0))
+#define ACCUMULATE(x) { \
+		SIDES(x); \
+		alpha = MIN(fabs(d[0]),1.0) * MIN(fabs(d[1]),1.0) * MIN(fabs(d[2]),1.0); \
+		value = WEIGHT(prow[(int)(x)]); \
+		xr = (x) - xcentre; \
+		sumXw += xr*alpha*value; \
+		sumYw += yr*alpha*value; \
+		surfalpha += alpha; \
+		surf += 1; \
+		totalvalue += (value*alpha); \
+		gmin = MIN(gmin,value); \
+		gmax = MAX(gmax,value); }
+
+	//Data table Filling
+	surf = 0.0;
+	surfalpha = 0.0;
+	totalvalue = 0.0;
+	gmax = 0.0;
+	gmin = 1e31;
+	sumXw=sumYw = 0.0;
+	for(yint=bby0;yint<=bby1;yint++){
+		y = (double)yint;
+		yr = y - ycentre;
+		prow = (PIXEL_T*)pdata + (long int)yint*sizeX;
+
+		//row span between the triangle sides, first estimated then fixed with the exact pixel test
+		lo = (double)bbx0;
+		hi = (double)bbx1;
+		for(i=0;i<3;i++){
+			if(a[i]*s[i]>0.0){
+				t = -(b[i]*y+c[i])/a[i];
+				lo = MAX(lo,t);
+			}
+			else if(a[i]*s[i]<0.0){
+				t = -(b[i]*y+c[i])/a[i];
+				hi = MIN(hi,t);
+			}
+		}
+		if(!(lo<=hi+1.0))
+			continue;
+		xleft = MAX((int)ceil(lo),bbx0);
+		xright = MIN((int)floor(hi),bbx1);
+		while((xleft>bbx0) && INSIDE((double)(xleft-1))) xleft--;
+		while((xleft<=MIN(xright+1,bbx1)) && !INSIDE((double)xleft)) xleft++;
+		if(xleft>MIN(xright+1,bbx1))
+			continue;
+		xright = MAX(xright,xleft);
+		while((xright<bbx1) && INSIDE((double)(xright+1))) xright++;
+		while(!INSIDE((double)xright)) xright--;
+
+		//left boundary pixels
+		for(;(xleft<=xright) && !CORE((double)xleft);xleft++)
+			ACCUMULATE((double)xleft);
+		//right boundary pixels
+		for(;(xright>=xleft) && !CORE((double)xright);xright--)
+			ACCUMULATE((double)xright);
+
+		//interior span, alpha = 1, accumulated in ACC_T on LANES independent partial sums
+		for(l=0;l<LANES;l++)
+			laneXw[l] = laneValue[l] = (ACC_T)0;
+		rowMin = gmin;
+		rowMax = gmax;
+		for(xint=xleft;xint<=xright;xint+=LANES){
+			n = MIN(LANES,xright-xint+1);
+			for(l=0;l<n;l++){
+				value = WEIGHT(prow[xint+l]);
+				laneXw[l] += (ACC_T)((double)(xint+l) - xcentre)*(ACC_T)value;
+				laneValue[l] += (ACC_T)value;
+				rowMin = MIN(rowMin,value);
+				rowMax = MAX(rowMax,value);
+			}
+		}
+		rowXw = rowValue = 0.0;
+		for(l=0;l<LANES;l++){
+			rowXw += (double)laneXw[l];
+			rowValue += (double)laneValue[l];
+		}
+		if(xright>=xleft){
+			t = (double)(xright-xleft+1);
+			sumXw += rowXw;
+			sumYw += yr*rowValue;
+			surfalpha += t;
+			surf += t;
+			totalvalue += rowValue;
+			gmin = rowMin;
+			gmax = rowMax;
+		}
+	}
+#undef SIDES
+#undef INSIDE
+#undef CORE
+#undef ACCUMULATE
+
+	if(totalvalue>0.0){
+		sumXw /= totalvalue;
+		sumYw /= totalvalue;
+
+		sumXw += xcentre;
+		sumYw += ycentre;
+	}else
+	{
+		sumXw = xcentre;
+		sumYw = ycentre;
+	}
+
+	DATA[0] = sumXw;//centroid
+	DATA[1] = sumYw;//centroid
+	DATA[2] = surf;//surfCrisp
+	DATA[3] = surfalpha;//surfAlpha
+	DATA[4] = totalvalue;//sum
+	DATA[5] = gmax; //max
+	DATA[6] = gmin; //min
+	if(surfalpha>0.0)
+		DATA[7] = totalvalue/surfalpha;//mean
+	else
+		DATA[7] = 0.0;
+
+	return 0;
+}
+
+int KERNEL_SCAN_LIST(PIXEL_T * pdata,int sizeX,int sizeY,double off_x,double off_y,double *TRIANGLES,int n_triangles,double *DATA,double *LUT) {
+	//scanline version of KERNEL_LIST
+	int i;
+
+	for(i=0;i<n_triangles;i++){
+		KERNEL_SCAN(pdata,sizeX,sizeY,off_x,off_y,TRIANGLES+6*i,DATA+8*i,LUT);
+	}
+
+	return n_triangles;
+}
@@ -23,7 +23,15 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 #generic import
+import os
 from datetime import datetime
+from copy import deepcopy
+import cPickle
+from math import sqrt
+from time import time
+from multiprocessing import Pipe,Process,RawArray
+from threading import Lock,Thread
+from traceback import format_exc
 import numpy as npy
 import csv
 from cache_decorators import lru_cache
@@ -32,34 +40,133 @@ from cache_decorators import lru_cache
 import h5py
 
 #local imports
-from meanshift import LUT,generate_triangles,generate_inverted_triangles,meanshift,meanshift_features
-from reader import ZipSource,Reader
+from meanshift import LUT,weight_table,generate_triangles,generate_inverted_triangles,meanshift,meanshift_batch,meanshift_features,image_pyramid
+from reader import ZipSource,Reader,Prefetcher
+from predictor import make_predictor,predictor_features
+from confidence import confidence,confidence_features
+from detection import detect_seeds
 
 
-class Cell():
+class ModelSpec(object):
+    """Read-only parameter set of the cell models, built once per parameter set (see :func:`model_spec`)
+    and shared by all the cells using it:
+
+    * the model parameters (N, radius_halo, radius_soma, exp_halo, exp_soma, niter, alpha, vmax, tol, levels)
+    * the uint8 weights LutW (white halo) and LutB (black soma)
+    * the unit triangle tables def_tri_halo (N,6) and def_tri_soma (N/2,6) of :class:`AdaptiveCell`
+
+    specs are hashable, two specs with the same parameters are equal
+    """
+    parameters = ['N','radius_halo','radius_soma','exp_halo','exp_soma','niter','alpha','vmax','tol','levels']
+
+    def __init__(self,N=16,radius_halo=30,radius_soma=12,exp_halo=10,exp_soma=2,niter=10,alpha=.75,vmax=None,tol=0.0,levels=1):
+        d = self.__dict__
+        d['key'] = (N,radius_halo,radius_soma,exp_halo,exp_soma,niter,alpha,vmax,tol,levels)
+        d.update(zip(self.parameters,d['key']))
+        d['LutW'] = weight_table('white',exp_halo,npy.uint8,vmax)
+        d['LutB'] = weight_table('black',exp_soma,npy.uint8,vmax)
+
+        cos_table,sin_table,cos_table1,sin_table1 = pre_compute_cos_sin_table(N)
+        def_tri_halo = npy.zeros((N,6))
+        def_tri_halo[:,2] = cos_table
+        def_tri_halo[:,3] = sin_table
+        def_tri_halo[:,4] = cos_table1
+        def_tri_halo[:,5] = sin_table1
+
+        cos_table,sin_table,cos_table1,sin_table1,cos_table_5,sin_table_5 = pre_compute_cos_sin_table2(N/2)
+        def_tri_soma = npy.zeros((N/2,6))
+        def_tri_soma[:,0] = -cos_table_5
+        def_tri_soma[:,1] = -sin_table_5
+        def_tri_soma[:,2] = cos_table
+        def_tri_soma[:,3] = sin_table
+        def_tri_soma[:,4] = cos_table1
+        def_tri_soma[:,5] = sin_table1
+        d['def_tri_halo'] = def_tri_halo
+        d['def_tri_soma'] = def_tri_soma
+
+        #read-only views: the shared weight tables of weight_table stay writeable for their other users
+        for name in ['LutW','LutB']:
+            d[name] = d[name].view()
+        for table in [self.LutW,self.LutB,def_tri_halo,def_tri_soma]:
+            table.flags.writeable = False
+
+    def __setattr__(self,name,value):
+        raise AttributeError('ModelSpec is read-only')
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __eq__(self,other):
+        return isinstance(other,ModelSpec) and self.key == other.key
+
+    def __ne__(self,other):
+        return not self == other
+
+    def __repr__(self):
+        return 'ModelSpec(%s)'%','.join(['%s=%r'%p for p in zip(self.parameters,self.key)])
+
+    def __reduce__(self):
+        #unpickled specs (e.g. tracks sent back by worker processes) are the shared ones
+        return (model_spec,self.key)
+
+    def params(self):
+        """returns the parameters as a dict (e.g. to build a model)
+        """
+        return dict(zip(self.parameters,self.key))
+
+    def luts(self,im):
+        """returns the halo and soma weights (LUT or power law) for the image dtype
+        """
+        if im.dtype == npy.uint8:
+            return self.LutW,self.LutB
+        return (weight_table('white',self.exp_halo,im.dtype,self.vmax),
+                weight_table('black',self.exp_soma,im.dtype,self.vmax))
+
+def model_spec(N=16,radius_halo=30,radius_soma=12,exp_halo=10,exp_soma=2,niter=10,alpha=.75,vmax=None,tol=0.0,levels=1):
+    """returns the shared :class:`ModelSpec` of a parameter set
+    """
+    return _model_spec(N,radius_halo,radius_soma,exp_halo,exp_soma,niter,alpha,vmax,tol,levels)
+
+@lru_cache()
+def _model_spec(*key):
+    return ModelSpec(*key)
+
+
+class Cell(object):
     """Cell object, the model is described by:
 
     * a cell position
     * the number of division (for both outer and inner part)
     * the weight Look Up Table used for the inner (black soma) and for the outer part (white halo)
+
+    uint8, uint16 and float32 frames are tracked directly, vmax is the maximum image value used by the
+    weights (default: dtype maximum, 1.0 for float images)
+
+    the update stops after niter iterations, or as soon as the center moves by less than tol pixel
+    (default 0.0: always niter iterations), the number of iterations used is kept in iterations
+
+    with levels > 1, the cell first converges on a downsampled image pyramid (see :meth:`coarse_to_fine`)
     """
-    def __init__(self,x0,y0,N=16,radius_halo=30,radius_soma=12,exp_halo=10,exp_soma=2,niter=10,alpha=.75):
+    def __init__(self,x0,y0,N=16,radius_halo=30,radius_soma=12,exp_halo=10,exp_soma=2,niter=10,alpha=.75,vmax=None,tol=0.0,levels=1):
+        #model parameters, shared by the cells with the same parameters
+        self.spec = model_spec(N,radius_halo,radius_soma,exp_halo,exp_soma,niter,alpha,vmax,tol,levels)
+
         #model center
         self.center = npy.asarray((x0,y0),dtype=float)
-
-        #model parameters
-        self.N = N
-        self.radius_halo = radius_halo
-        self.radius_soma = radius_soma
-        self.LutW = LUT('white',exp_halo)
-        self.LutB = LUT('black',exp_soma)
-        self.niter = niter
-        self.alpha = alpha
+        self.iterations = 0
         self.tri_halo = npy.ndarray((self.N,6))
         self.tri_soma = npy.ndarray((self.N,6))
+        self.level_time = npy.zeros(levels)
+        self.allocate_buffers()
 
         self.build_triangles()
 
+    def __getattr__(self,name):
+        #model parameters, weights and unit triangles are read from the shared spec
+        if name != 'spec' and 'spec' in self.__dict__:
+            return getattr(self.spec,name)
+        raise AttributeError(name)
+
     def build_triangles(self):
         """Build triangle lists for the Cell model, one for the halo tracking, one for the soma tracking
         """
@@ -71,44 +178,161 @@ class Cell():
         self.center[1] = y
         self.build_triangles()
 
+    def luts(self,im):
+        """returns the halo and soma weights (LUT or power law) for the image dtype
+        """
+        return self.spec.luts(im)
+
+    def allocate_buffers(self):
+        """allocates the per-cell buffers reused by every update: path, meanshift results (shift_halo,
+        shift_soma) and temporaries, the steady-state update allocates no result
+        buffer (only short-lived views and scalars)
+        """
+        n_halo = self.tri_halo.shape[0]
+        self._path = npy.zeros((self.niter,2))
+        self.shift_halo = npy.zeros((n_halo,8))
+        self.shift_soma = npy.zeros((self.tri_soma.shape[0],8))
+        self._prev = npy.zeros(2)
+        self._mean_halo = npy.zeros(2)
+        self._mean_soma = npy.zeros(2)
+        self._dist = npy.zeros((n_halo,2))
+        self._radii = npy.zeros((4,n_halo))
+
+    def coarse_model(self,level):
+        """returns the cell model used at a pyramid level: same model and parameters, radii divided by 2**level
+        """
+        coarse = self.__dict__.setdefault('_coarse',{})
+        if level not in coarse:
+            params = self.spec.params()
+            params['radius_halo'] = self.radius_halo/2.**level
+            params['radius_soma'] = self.radius_soma/2.**level
+            params['levels'] = 1
+            coarse[level] = self.__class__(self.center[0],self.center[1],**params)
+        return coarse[level]
+
+    def coarse_to_fine(self,im):
+        """moves the cell to its position converged on the image pyramid (see :func:`meanshift.image_pyramid`),
+        from the coarsest level (levels-1) to level 1, the full resolution update is left to the caller.
+        The pyramid pixel (i,j) of level k is located at 2**k*(i,j)+(2**k-1)/2, level_time[k] is the time
+        spent at level k by the last update (pyramid construction included in the coarsest level)
+        """
+        self.level_time = npy.zeros(self.levels)
+        ts = time()
+        pyramid = image_pyramid(im,self.levels)
+        x,y = self.center
+        for level in range(self.levels-1,0,-1):
+            scale = 2.**level
+            shift = (scale-1.)/2.
+            cell = self.coarse_model(level)
+            cell.set((x-shift)/scale,(y-shift)/scale)
+            cell.update(pyramid[level])
+            x = cell.center[0]*scale+shift
+            y = cell.center[1]*scale+shift
+            self.level_time[level] = time()-ts
+            ts = time()
+        self.set(x,y)
+
+    def start(self):
+        """reset the iteration state before an update
+        """
+        self._path.fill(0.0)
+        self.path = self._path
+        self.iterations = 0
+        self.displacement = npy.inf
+
+    def move(self,iter,halo,soma):
+        """moves the center to the weighted mean of the halo and soma centroids (in place)
+        """
+        self._prev[:] = self.center
+        halo.mean(axis=0,out=self._mean_halo)
+        soma.mean(axis=0,out=self._mean_soma)
+        npy.multiply(self._mean_soma,1.-self.alpha,out=self._mean_soma)
+        npy.multiply(self._mean_halo,self.alpha,out=self._mean_halo)
+        npy.add(self._mean_soma,self._mean_halo,out=self.center)
+        self.path[iter,:] = self.center
+        self.iterations = iter+1
+        dx = self.center[0]-self._prev[0]
+        dy = self.center[1]-self._prev[1]
+        self.displacement = sqrt(dx*dx+dy*dy)
+
+    def reserve(self,niter):
+        """makes room in the path buffer for niter iterations (see :func:`schedule_cells`)
+        """
+        if niter > self._path.shape[0]:
+            self._path = npy.zeros((niter,2))
+            self.path = self._path
+
+    def converged(self):
+        """returns True if the update is over (niter iterations done or center displacement below tol)
+        """
+        return self.iterations >= self.niter or self.displacement < self.tol
+
     def update(self,im):
         """Update cell position with respect to a given image
         """
-        self.path = npy.zeros((self.niter,2))
-        for iter in range(self.niter):
+        if self.levels > 1:
+            self.coarse_to_fine(im)
+        ts = time()
+        lut_halo,lut_soma = self.luts(im)
+        self.start()
+        for iter in xrange(self.niter):
             #compute the shifts
-            self.shift_halo = meanshift(im,self.tri_halo,0.0,0.0,lut = self.LutW)
-            self.shift_soma = meanshift(im,self.tri_soma,0.0,0.0,lut = self.LutB)
+            meanshift(im,self.tri_halo,0.0,0.0,lut = lut_halo,out = self.shift_halo)
+            meanshift(im,self.tri_soma,0.0,0.0,lut = lut_soma,out = self.shift_soma)
+            self.step(iter,self.shift_halo,self.shift_soma)
+            if self.converged():
+                break
+        self.path = self._path[:self.iterations]
+        self.level_time[0] = time()-ts
+
+    def step(self,iter,shift_halo,shift_soma):
+        """one iteration of the cell update, given the meanshift results of the halo and soma triangles
+        """
+        self.store_shifts(shift_halo,shift_soma)
 
-            #update the position
-            # halo centroid
-            halo = npy.asarray([sh[0:2] for sh in self.shift_halo])
-            # nucleus centroid
-            soma = npy.asarray([sh[0:2] for sh in self.shift_halo])
+        #update the position
+        # halo centroid
+        halo = self.shift_halo[:,0:2]
+        # nucleus centroid
+        soma = self.shift_halo[:,0:2]
 
-            self.center[:] = (1.-self.alpha) * soma.mean(axis=0) + self.alpha * halo.mean(axis=0)
-            self.path[iter,:] = self.center
+        self.move(iter,halo,soma)
 
-            #update the triangles
-            self.build_triangles()
+        #update the triangles
+        self.build_triangles()
+
+    def store_shifts(self,shift_halo,shift_soma):
+        """copies the meanshift results into the cell buffers (unless they were computed in place)
+        """
+        if shift_halo is not self.shift_halo:
+            self.shift_halo[...] = shift_halo
+        if shift_soma is not self.shift_soma:
+            self.shift_soma[...] = shift_soma
 
     def rec(self):
         """returns a record grouping cell useful data
         """
-        return (self.center.copy(),self.shift_halo.copy(),self.shift_soma.copy())
+        return (self.center.copy(),self.shift_halo.copy(),self.shift_soma.copy(),npy.asarray([self.iterations]))
 
     def rec_structure(self):
         """returns the structure of a rec produced by this model
         one dict entry will generate a distinct dataset, each line of these datasets will be populated with model data
         """
-        center = {'dataset_name':'center',
-                  'attributes':[('features',['x','y']),]}
-        halo = {'dataset_name':'halo',
-                'attributes':[('features',meanshift_features),('dims',['0-frame','1-pie#','2-features'])]}
-        soma = {'dataset_name':'soma',
-                'attributes':[('features',meanshift_features),('dims',['0-frame','1-pie#','2-features'])]}
+        return rec_structure()
 
-        return [center,halo,soma]
+def rec_structure():
+    """returns the structure of the cell records (see :meth:`Cell.rec_structure`)
+    """
+    center = {'dataset_name':'center',
+              'attributes':[('features',['x','y']),]}
+    halo = {'dataset_name':'halo',
+            'attributes':[('features',meanshift_features),('dims',['0-frame','1-pie#','2-features'])]}
+    soma = {'dataset_name':'soma',
+            'attributes':[('features',meanshift_features),('dims',['0-frame','1-pie#','2-features'])]}
+    iterations = {'dataset_name':'iterations',
+                  'attributes':[('features',['niter']),]}
+
+    return [center,halo,soma,iterations]
 
 @lru_cache()
 def pre_compute_cos_sin_table(N):
@@ -136,41 +360,19 @@ def pre_compute_cos_sin_table2(N):
     return (cos_table,sin_table,cos_table1,sin_table1,cos_table_5,sin_table_5)
 
 class AdaptiveCell(Cell):
-    def __init__(self,x0,y0,N=16,radius_halo=30,radius_soma=12,exp_halo=10,exp_soma=2,niter=10,alpha=.75):
+    def __init__(self,x0,y0,N=16,radius_halo=30,radius_soma=12,exp_halo=10,exp_soma=2,niter=10,alpha=.75,vmax=None,tol=0.0,levels=1):
+        #model parameters and unit triangles (def_tri_halo, def_tri_soma), shared by the cells with the same parameters
+        self.spec = model_spec(N,radius_halo,radius_soma,exp_halo,exp_soma,niter,alpha,vmax,tol,levels)
+
         #model center
         self.center = npy.asarray((x0,y0),dtype=float)
-
-        #model parameters
-        self.N = N # N must be even
-        self.radius_halo = radius_halo
-        self.radius_soma = radius_soma
-        self.LutW = LUT('white',exp_halo)
-        self.LutB = LUT('black',exp_soma)
-        self.niter = niter
-        self.alpha = alpha
+        self.iterations = 0
         #triangle description
         self.tri_halo = npy.ndarray((self.N,6))
         self.tri_soma = npy.ndarray((self.N/2,6)) # N/2 triangles for the soma
         self.prev_radii = npy.ones(N)*radius_halo
-
-        cos_table,sin_table,cos_table1,sin_table1 = pre_compute_cos_sin_table(self.N)
-
-        self.def_tri_halo = npy.zeros_like(self.tri_halo)
-        self.def_tri_halo[:,0:2] = self.center
-        self.def_tri_halo[:,2] = cos_table
-        self.def_tri_halo[:,3] = sin_table
-        self.def_tri_halo[:,4] = cos_table1
-        self.def_tri_halo[:,5] = sin_table1
-
-        cos_table,sin_table,cos_table1,sin_table1,cos_table_5,sin_table_5 = pre_compute_cos_sin_table2(self.N/2)
-
-        self.def_tri_soma = npy.zeros_like(self.tri_soma)
-        self.def_tri_soma[:,0] = -cos_table_5
-        self.def_tri_soma[:,1] = -sin_table_5
-        self.def_tri_soma[:,2] = cos_table
-        self.def_tri_soma[:,3] = sin_table
-        self.def_tri_soma[:,4] = cos_table1
-        self.def_tri_soma[:,5] = sin_table1
+        self.level_time = npy.zeros(levels)
+        self.allocate_buffers()
         self.update_triangles()
 
     def set(self,x,y):
@@ -180,99 +382,436 @@ class AdaptiveCell(Cell):
 
     def update_triangles(self):
         #external pies
-        R = self.prev_radii*1.5
-        x,y = self.center
+        R = self._radii[3]
+        npy.multiply(self.prev_radii,1.5,out=R)
         self.tri_halo[:,:] = self.def_tri_halo
         self.tri_halo[:,0:2] = self.center
-        self.tri_halo[:,2:6] = self.tri_halo[:,2:6] * R[:,npy.newaxis]
-        self.tri_halo[:,2:6] += npy.asarray([x,y,x,y])
+        pies = self.tri_halo[:,2:6]
+        npy.multiply(pies,R[:,npy.newaxis],out=pies)
+        self.tri_halo[:,2:4] += self.center
+        self.tri_halo[:,4:6] += self.center
 
         #internal pies
         self.tri_soma[:,:] = self.def_tri_soma
-        R = self.radius_soma
-        self.tri_soma[:,:] = self.tri_soma[:,:]*R
-        self.tri_soma[:,:] += npy.asarray([x,y,x,y,x,y])
+        self.tri_soma *= self.radius_soma
+        self.tri_soma[:,0:2] += self.center
+        self.tri_soma[:,2:4] += self.center
+        self.tri_soma[:,4:6] += self.center
 
     def update(self,im):
         """Update cell position with respect to a given image
         raddii are adjusted accordingly to the previous size
         """
-        self.path = npy.zeros((self.niter,2))
-        for iter in range(self.niter):
+        if self.levels > 1:
+            self.coarse_to_fine(im)
+        ts = time()
+        lut_halo,lut_soma = self.luts(im)
+        self.start()
+        for iter in xrange(self.niter):
             #compute the shifts
-            self.shift_halo = meanshift(im,self.tri_halo,0.0,0.0,lut = self.LutW)
-            self.shift_soma = meanshift(im,self.tri_soma,0.0,0.0,lut = self.LutB)
+            meanshift(im,self.tri_halo,0.0,0.0,lut = lut_halo,out = self.shift_halo)
+            meanshift(im,self.tri_soma,0.0,0.0,lut = lut_soma,out = self.shift_soma)
+            self.step(iter,self.shift_halo,self.shift_soma)
+            if self.converged():
+                break
+        self.path = self._path[:self.iterations]
+        self.level_time[0] = time()-ts
+
+    def step(self,iter,shift_halo,shift_soma):
+        """one iteration of the cell update, given the meanshift results of the halo and soma triangles
+        """
+        self.store_shifts(shift_halo,shift_soma)
+
+        #update the position
+        # halo centroid
+        halo = self.shift_halo[:,0:2]
+        # nucleus centroid
+        soma = self.shift_soma[:,0:2]
+
+        self.move(iter,halo,soma)
+
+        #update previous radii (in place, r1 and r2 are the rolled radii)
+        MaxRadius = self.radius_halo
+        MinRadius = self.radius_soma
+        radii,r1,r2 = self._radii[0],self._radii[1],self._radii[2]
+        npy.subtract(halo,self.center,out=self._dist)
+        npy.multiply(self._dist,self._dist,out=self._dist)
+        self._dist.sum(axis=1,out=radii)
+        npy.sqrt(radii,out=radii)
+        npy.minimum(radii,MaxRadius,out=radii)
+        npy.maximum(radii,MinRadius,out=radii)
+        #filter previous radii
+        r1[:-1] = radii[1:]
+        r1[-1] = radii[0]
+        r2[1:] = radii[:-1]
+        r2[0] = radii[-1]
+        r1 *= .5
+        r1 += radii
+        r2 *= .5
+        r1 += r2
+        npy.multiply(r1,.5,out=self.prev_radii)
+
+        #update the triangles
+        self.update_triangles()
+
+class CellPopulation(object):
+    """Population of :class:`AdaptiveCell` sharing the same parameters, stored as arrays (one line per cell):
+
+    * center (C,2), prev_radii (C,N)
+    * tri_halo (C,N,6), tri_soma (C,N/2,6) and the last meanshift results shift_halo (C,N,8), shift_soma (C,N/2,8)
+    * iterations (C,) and displacement (C,) of the last update, path (C,niter,2)
+
+    the triangles of all the cells are rebuilt by one broadcast and the kernel is called once per iteration
+    for the whole population (halo, then soma), records are identical to the :class:`AdaptiveCell` ones
+    """
+    def __init__(self,centers,N=16,radius_halo=30,radius_soma=12,exp_halo=10,exp_soma=2,niter=10,alpha=.75,vmax=None,tol=0.0):
+        centers = npy.asarray(centers,dtype=float).reshape(-1,2)
+        C = centers.shape[0]
+        #model parameters and unit triangles, shared with the cells with the same parameters
+        self.spec = model_spec(N,radius_halo,radius_soma,exp_halo,exp_soma,niter,alpha,vmax,tol)
+
+        #per cell state
+        self.center = centers.copy()
+        self.prev_radii = npy.ones((C,N))*radius_halo
+        self.tri_halo = npy.zeros((C,N,6))
+        self.tri_soma = npy.zeros((C,N/2,6))
+        self.shift_halo = npy.zeros((C,N,8))
+        self.shift_soma = npy.zeros((C,N/2,8))
+        self.iterations = npy.zeros(C,dtype=int)
+        self.displacement = npy.ones(C)*npy.inf
+        self.path = npy.zeros((C,niter,2))
+        self.update_triangles()
+
+    def __getattr__(self,name):
+        #model parameters, weights and unit triangles are read from the shared spec
+        if name != 'spec' and 'spec' in self.__dict__:
+            return getattr(self.spec,name)
+        raise AttributeError(name)
+
+    def __len__(self):
+        return self.center.shape[0]
+
+    def _index(self,index):
+        if index is None:
+            return npy.arange(len(self))
+        return npy.asarray(index,dtype=int).ravel()
 
-            #update the position
-            # halo centroid
-            halo = self.shift_halo[:,0:2]
-            # nucleus centroid
-            soma = self.shift_soma[:,0:2]
+    def luts(self,im):
+        """returns the halo and soma weights (LUT or power law) for the image dtype
+        """
+        return self.spec.luts(im)
 
-            halo_mean = halo.mean(axis=0)
-            soma_mean = soma.mean(axis=0)
+    def set(self,i,x,y):
+        self.center[i,:] = (x,y)
+        self.update_triangles([i])
 
-            self.center[:] = (1.-self.alpha) * soma_mean + self.alpha * halo_mean
-            self.path[iter,:] = self.center
+    def update_triangles(self,index=None):
+        """rebuild the triangles of the indexed cells (default: all)
+        """
+        index = self._index(index)
+        center = self.center[index]
+        xyxy = npy.tile(center,2)[:,npy.newaxis,:]
+        #external pies
+        R = self.prev_radii[index]*1.5
+        self.tri_halo[index,:,0:2] = center[:,npy.newaxis,:]
+        self.tri_halo[index,:,2:6] = self.def_tri_halo[:,2:6] * R[:,:,npy.newaxis] + xyxy
+        #internal pies
+        self.tri_soma[index] = self.def_tri_soma*self.radius_soma + npy.tile(center,3)[:,npy.newaxis,:]
 
-            #update previous radii
-            MaxRadius = self.radius_halo
-            MinRadius = self.radius_soma
-            self.prev_radii = npy.maximum(npy.minimum(npy.sqrt(npy.sum((halo-self.center)**2,axis=1)),MaxRadius),MinRadius)
-            #filter previous radii
-            r1 = npy.roll(self.prev_radii,-1)
-            r2 = npy.roll(self.prev_radii,+1)
-            self.prev_radii = .5*(self.prev_radii + .5*r1 + .5*r2)
+    def update(self,im,index=None,nthreads=None):
+        """update the indexed cells (default: all) with respect to a given image,
+        converged cells (see :meth:`Cell.converged`) leave the batch
+        """
+        index = self._index(index)
+        lut_halo,lut_soma = self.luts(im)
+        self.path[index] = 0.0
+        self.iterations[index] = 0
+        self.displacement[index] = npy.inf
+        active = index if self.niter > 0 else index[:0]
+        iter = 0
+        while len(active):
+            n = len(active)
+            shift_halo = meanshift(im,self.tri_halo[active].reshape(-1,6),0.0,0.0,lut = lut_halo,nthreads = nthreads)
+            shift_soma = meanshift(im,self.tri_soma[active].reshape(-1,6),0.0,0.0,lut = lut_soma,nthreads = nthreads)
+            self.step(active,iter,shift_halo.reshape(n,self.N,8),shift_soma.reshape(n,self.N/2,8))
+            active = active[(self.iterations[active] < self.niter) & ~(self.displacement[active] < self.tol)]
+            iter += 1
+
+    def step(self,index,iter,shift_halo,shift_soma):
+        """one iteration of the update of the indexed cells (see :meth:`AdaptiveCell.step`)
+        """
+        self.shift_halo[index] = shift_halo
+        self.shift_soma[index] = shift_soma
+
+        #update the position
+        halo = shift_halo[:,:,0:2]
+        soma = shift_soma[:,:,0:2]
+        prev = self.center[index]
+        center = (1.-self.alpha) * soma.mean(axis=1) + self.alpha * halo.mean(axis=1)
+        self.center[index] = center
+        self.path[index,iter] = center
+        self.iterations[index] = iter+1
+        self.displacement[index] = npy.sqrt(npy.sum((center-prev)**2,axis=1))
+
+        #update previous radii
+        MaxRadius = self.radius_halo
+        MinRadius = self.radius_soma
+        radii = npy.maximum(npy.minimum(npy.sqrt(npy.sum((halo-center[:,npy.newaxis,:])**2,axis=2)),MaxRadius),MinRadius)
+        #filter previous radii
+        r1 = npy.roll(radii,-1,axis=1)
+        r2 = npy.roll(radii,+1,axis=1)
+        self.prev_radii[index] = .5*(radii + .5*r1 + .5*r2)
+
+        #update the triangles
+        self.update_triangles(index)
+
+    def rec(self,i):
+        """returns the record of the cell i (see :meth:`Cell.rec`)
+        """
+        return (self.center[i].copy(),self.shift_halo[i].copy(),self.shift_soma[i].copy(),npy.asarray([self.iterations[i]]))
 
-            #update the triangles
-            self.update_triangles()
+    def rec_structure(self):
+        return rec_structure()
+
+def update_cells(cells,im,nthreads=None):
+    """Update all the cells of a frame together, results are identical to calling each cell.update(im)
+
+    at each iteration, the halo (resp. soma) triangles of all the cells sharing the same weights are processed
+    by one single kernel call running on nthreads native threads (see :func:`meanshift.meanshift`),
+    converged cells (see :meth:`Cell.converged`) leave the batch
+    """
+    for c in cells:
+        if c.levels > 1:
+            c.coarse_to_fine(im)
+    ts = time()
+    for c in cells:
+        c.start()
+    active = [c for c in cells if not c.converged()]
+    while active:
+        iterate_cells(active,im,nthreads)
+        #converged cells leave the batch
+        active = [c for c in active if not c.converged()]
+    #the full resolution time is shared by the cells
+    elapsed = time()-ts
+    for c in cells:
+        c.path = c.path[:c.iterations]
+        c.level_time[0] = elapsed/len(cells)
+
+def iterate_cells(cells,im,nthreads=None):
+    """one iteration of each cell, the halo (resp. soma) triangles of the cells sharing the same weights
+    are processed by one single kernel call
+    """
+    #group the cells by weights
+    groups = {}
+    for c in cells:
+        lut_halo,lut_soma = c.luts(im)
+        groups.setdefault((id(lut_halo),id(lut_soma)),(lut_halo,lut_soma,[]))[2].append(c)
+    for lut_halo,lut_soma,group in groups.values():
+        shift_halo = meanshift_batch(im,[c.tri_halo for c in group],0.0,0.0,lut = lut_halo,nthreads = nthreads)
+        shift_soma = meanshift_batch(im,[c.tri_soma for c in group],0.0,0.0,lut = lut_soma,nthreads = nthreads)
+        for c,sh,ss in zip(group,shift_halo,shift_soma):
+            c.step(c.iterations,sh,ss)
+
+def schedule_cells(cells,im,budget,cap=None,nthreads=None):
+    """Update all the cells of a frame within a total budget of cell iterations (one iteration is one halo
+    and one soma meanshift), the niter parameter of the cells is replaced by the per-cell cap (default: niter)
+
+    cells are iterated by rounds (see :func:`iterate_cells`), after each round only the cells whose
+    displacement is still above their tol are kept, when the budget left is smaller than the number of
+    cells still moving, the cells moving the most are iterated first. Returns the number of iterations used
+    """
+    for c in cells:
+        if c.levels > 1:
+            c.coarse_to_fine(im)
+    ts = time()
+    for c in cells:
+        c.start()
+        c.reserve(c.niter if cap is None else cap)
+    caps = dict((id(c),c.niter if cap is None else cap) for c in cells)
+    active = [c for c in cells if caps[id(c)] > 0]
+    used = 0
+    while active and used < budget:
+        if len(active) > budget-used:
+            active.sort(key=lambda c:c.displacement,reverse=True)
+            active = active[:budget-used]
+        iterate_cells(active,im,nthreads)
+        used += len(active)
+        active = [c for c in active if c.iterations < caps[id(c)] and c.displacement >= c.tol]
+    elapsed = time()-ts
+    for c in cells:
+        c.path = c.path[:c.iterations]
+        c.level_time[0] = elapsed/len(cells)
+    return used
 
 
 class Track(object):
     """Object responsible for recording different cell position during time, it also manage the mark positions
+
+    an optional motion predictor ('velocity', 'kalman' or an instance, see :mod:`predictor`) seeds the
+    cell position of each new frame, its prediction and state are recorded with the cell data
+
+    with a policy (see :class:`confidence.LossPolicy`) the confidence of each update is recorded (see
+    :func:`confidence.confidence`) and the track is lost when the confidence drops and is no longer updated
+    in that direction: lost[dir] is (frame,reason) and saved counts the kernel calls (halo and soma
+    meanshift, niter of each per frame) skipped since
+
+    records are kept in memory (records[frame]) unless a sink is given: sink(track,frame,rec) then receives
+    them as they are recorded (see :class:`TrackStream`)
     """
-    def __init__(self,x0,y0,frame0,model,params):
+    def __init__(self,x0,y0,frame0,model,params,predictor=None,policy=None):
         self.model = model
         self.params = params
         self.cell = model(x0,y0,**params)
+        self.predictor = make_predictor(predictor)
+        self.policy = policy
+        self.lost = {}
+        self.saved = 0
+        self.low = 0
         self.frame0 = frame0
         self.x0 = x0
         self.y0 = y0
         self.frame = frame0
         self.frame_range = [frame0,frame0]      # [first,last] tracked frames
         self.records = {}                           # data record
+        self.sink = None
+        self.reference = None                       # mark frame score
+        if self.predictor is not None:
+            self.predictor.reset(x0,y0)
 
     def reset_cell_pos(self):
         self.frame = self.frame0
+        self.low = 0
         self.cell.set(self.x0,self.y0)
+        if self.predictor is not None:
+            self.predictor.reset(self.x0,self.y0)
 
-    def update(self,frame,im,dir):
+    def accepts(self,frame,dir):
+        """returns True if the frame is the next one to be tracked in the given direction (and the track is not lost)
+        """
+        return dir not in self.lost and self.follows(frame,dir)
+
+    def follows(self,frame,dir):
+        """returns True if the frame is the current or the next one in the given direction
+        """
         if dir=='fwd':
-            if (frame == self.frame+1) | (frame == self.frame):
-                self.cell.update(im)
-                self.records[frame] = self.cell.rec()
-                self.frame = frame
-                self.frame_range[1] = self.frame
+            return (frame == self.frame+1) | (frame == self.frame)
+        if dir=='rev':
+            return (frame == self.frame-1) | (frame == self.frame)
+        return False
 
+    def prepare(self,frame):
+        """moves the cell to the predicted position before its update for a new frame
+        """
+        if self.predictor is not None and frame != self.frame:
+            x,y = self.predictor.predict()
+            self.cell.set(x,y)
+
+    def record(self,frame,dir,im):
+        """record the (already updated on im) cell for the frame, then applies the loss policy
+        """
+        rec = self.cell.rec()
+        if self.predictor is not None:
+            self.predictor.correct(self.cell.center[0],self.cell.center[1])
+            rec = rec + (self.predictor.rec(),)
+        if self.policy is not None:
+            conf = confidence(self.cell,im)
+            rec = rec + (conf,)
+        if self.sink is None:
+            self.records[frame] = rec
+        else:
+            self.sink(self,frame,rec)
+        if self.policy is not None:
+            #the mark frame gives the reference score
+            if frame == self.frame0:
+                self.reference = conf[3]
+            reference = conf[3] if self.reference is None else self.reference
+            reason,self.low = self.policy.check(conf,reference,self.low)
+            if reason is not None:
+                self.lost[dir] = (frame,reason)
+        self.frame = frame
+        if dir=='fwd':
+            self.frame_range[1] = self.frame
         if dir=='rev':
-            if (frame == self.frame-1) | (frame == self.frame):
-                self.cell.update(im)
-                self.records[frame] = self.cell.rec()
-                self.frame = frame
-                self.frame_range[0] = self.frame
+            self.frame_range[0] = self.frame
 
-    def export_to_hdf5(self,hdf5_group):
-        """write the track results into the given HDF5 group
+    def rec_structure(self):
+        """returns the structure of the track records: cell model data, then predictor data and confidence if any
+        """
+        structure = self.cell.rec_structure()
+        if self.predictor is not None:
+            structure.append({'dataset_name':'predictor',
+                              'attributes':[('features',predictor_features),('predictor',[repr(self.predictor)])]})
+        if self.policy is not None:
+            structure.append({'dataset_name':'confidence',
+                              'attributes':[('features',confidence_features),('policy',[repr(self.policy)])]})
+        return structure
+
+    def skip(self,frame,dir):
+        """follows the frames of a lost direction without updating the cell (counting the saved kernel calls)
+        """
+        if dir in self.lost and frame != self.frame and self.follows(frame,dir):
+            self.frame = frame
+            self.saved += 2*self.cell.niter
+
+    def update(self,frame,im,dir):
+        if self.accepts(frame,dir):
+            self.prepare(frame)
+            self.cell.update(im)
+            self.record(frame,dir,im)
+        else:
+            self.skip(frame,dir)
+
+    def split(self):
+        """returns a copy of the track (cell and predictor state included) without records, used to track the
+        reverse direction concurrently, see :meth:`merge`
+        """
+        records,sink = self.records,self.sink
+        self.records,self.sink = {},None
+        try:
+            twin = deepcopy(self)
+        finally:
+            self.records,self.sink = records,sink
+        twin.sink = sink
+        twin.saved = 0
+        return twin
+
+    def merge(self,twin):
+        """merges the records of the reverse direction twin (see :meth:`split`), the mark frame record is kept
+        """
+        for frame,rec in twin.records.items():
+            if frame != self.frame0 or frame not in self.records:
+                self.records[frame] = rec
+        self.frame_range[0] = twin.frame_range[0]
+        if 'rev' in twin.lost:
+            self.lost['rev'] = twin.lost['rev']
+        self.saved += twin.saved
+
+    def lost_frames(self):
+        """returns the frames where the track was lost in the fwd and rev directions (-1 if not lost)
+        """
+        return [self.lost.get(dir,(-1,''))[0] for dir in ['fwd','rev']]
+
+    def export_attributes(self,hdf5_group):
+        """write the track attributes (frame range, model, loss) into the given HDF5 group
         """
         hdf5_group.attrs.create('frame_range',self.frame_range)
 
         hdf5_group.attrs.create('model',str(self.model))
-        hdf5_group.attrs.create('parameters',str(self.params))
+        #sorted keys: the same text for a copied or unpickled dict
+        hdf5_group.attrs.create('parameters','{%s}'%', '.join(['%r: %r'%kv for kv in sorted(self.params.items())]))
+        hdf5_group.attrs.create('lost_frame',self.lost_frames())
+        hdf5_group.attrs.create('lost_reason',[self.lost.get(dir,(-1,''))[1] for dir in ['fwd','rev']])
+        hdf5_group.attrs.create('saved_calls',self.saved)
+
+    def export_to_hdf5(self,hdf5_group):
+        """write the track results into the given HDF5 group
+        """
+        self.export_attributes(hdf5_group)
 
         # specific track data (depends on cell model)
         L = list(self.records)
         L.sort()
-        for i,s in enumerate(self.cell.rec_structure()):
+        for i,s in enumerate(self.rec_structure()):
             #extract data
             data = []
             for k in L:
@@ -288,41 +827,459 @@ class Track(object):
 class Experiment(object):
     """An experiment keep all track of on sequence together,
     it is responsible for saving tracking result to file
+
+    if nthreads is given, the cells of all the tracks are updated together at each frame (see :func:`update_cells`)
+    with the kernel running on nthreads native threads, otherwise each track is updated on its own
+
+    if budget is given, the cells of a frame share a total of budget iterations, with at most cap iterations
+    per cell (see :func:`schedule_cells`), frame_iterations[frame] keeps the number of iterations used
+
+    if processes is given, the tracks are split between processes worker processes (see :meth:`process_frames`), a budget
+    is split between them
+
+    the tracks of a pass are activated at their mark frame (see :meth:`activate`), frames without active track
+    are not decoded: decoded_frames counts the frames read from the reader, update_calls the track updates
+
+    if prefetch is given, decoders background threads decode up to prefetch frames ahead of the tracking
+    (see :meth:`prefetch_frames`), queue_depths and stall_time keep the prefetch metrics
+
+    the records can be written to a HDF5 file while tracking instead of being kept in memory (see :meth:`stream_hdf5`)
+
+    if checkpoint is given, the state of a fwd or rev pass is saved in this file every checkpoint_every frames
+    (see :meth:`save_checkpoint`), an interrupted pass is completed by :meth:`resume`, the checkpoint is removed once
+    the pass is completed
     """
-    def __init__(self,reader,exp_name='no_name'):
+    def __init__(self,reader,exp_name='no_name',nthreads=None,budget=None,cap=None,processes=None,prefetch=None,decoders=1,
+                 checkpoint=None,checkpoint_every=100):
         self.reader = reader
         self.name = exp_name
+        self.nthreads = nthreads
+        self.budget = budget
+        self.cap = cap
+        self.processes = processes
+        self.prefetch = prefetch
+        self.decoders = decoders
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.queue_depths = []
+        self.stall_time = 0.0
+        self.decoded_frames = 0
+        self.update_calls = 0
         self.track_list = []
+        self.reset_index()
+        self.level_time = npy.zeros(1)
+        self.frame_iterations = {}
+        self.stream = None
+        self.streamed_counts = npy.zeros(1,dtype=int)
 
     def add_track(self,track):
         self.track_list.append(track)
 
+    def add_seeds(self,frame,model,params,predictor=None,policy=None,**detection):
+        """detects the cells of a frame (see :func:`detection.detect_seeds`, detection holds its optional
+        arguments) and adds one track per seed, returns the (K,2) seeds
+        """
+        seeds = detect_seeds(self.reader.moveto(frame),params,**detection)
+        for x0,y0 in seeds:
+            self.add_track(Track(x0=x0,y0=y0,frame0=frame,model=model,params=params,predictor=predictor,policy=policy))
+        return seeds
+
     def do_tracking(self,read_dir,first_frame=0,last_frame=None):
+        """tracks the frames in one direction ('fwd' or 'rev'), or in both directions from the marks in one single pass
+        ('both', see :meth:`track_both`)
+        """
+        self.check_pass(read_dir)
         r  = range(0,self.reader.N())
         frames = list(r[first_frame:last_frame])
 
         #reset Cell to mark position before changing tracking direction
         for t in self.track_list:
             t.reset_cell_pos()
+            for dir in ['fwd','rev']:
+                if read_dir in [dir,'both']:
+                    t.lost.pop(dir,None)
+        self.attach_stream()
+        if read_dir=='both':
+            self.track_both(frames)
+            return
+        if read_dir not in ['fwd','rev'] or not self.track_list:
+            return
+        #no track before the first mark (fwd) or after the last one (rev)
         if read_dir=='fwd':
-            for frame in frames:
-                print 'process frame ',frame
-                im = self.reader.moveto(frame)
-                for t in self.track_list:
-                    t.update(frame,im,read_dir)
+            frames = [f for f in frames if f >= min([t.frame0 for t in self.track_list])]
         if read_dir=='rev':
-            frames.reverse()
+            frames = [f for f in reversed(frames) if f <= max([t.frame0 for t in self.track_list])]
+        if self.processes is not None:
+            self.process_frames(frames,read_dir)
+            return
+        self.reset_index()
+        self.track_frames(frames,read_dir)
+
+    def check_pass(self,read_dir):
+        """raises ValueError if the options of the experiment do not allow a pass in the read_dir direction
+        """
+        if self.checkpoint is not None and (read_dir=='both' or self.processes is not None):
+            raise ValueError('checkpoints are only saved by the fwd and rev passes of a single process')
+        if read_dir=='both' and self.processes is not None:
+            raise ValueError('both directions are tracked by threads of a single process (no worker processes)')
+
+    def options(self):
+        """returns the tracking options saved in a checkpoint, a pass is resumed with the same options
+        """
+        return dict((k,getattr(self,k)) for k in ['nthreads','budget','cap','processes','prefetch'])
+
+    def track_frames(self,frames,read_dir):
+        """tracks the frames of a pass (from the current activation index, see :meth:`reset_index`), decoded ahead
+        if prefetch is given, a checkpoint is saved every checkpoint_every frames (and removed at the end of the pass)
+        """
+        if self.prefetch is not None:
+            self.prefetch_frames(frames,read_dir)
+        else:
+            for n,frame in enumerate(frames):
+                if self.activate(frame,read_dir):
+                    print 'process frame ',frame
+                    im = self.reader.moveto(frame)
+                    self.decoded_frames += 1
+                    self.update_tracks(frame,im,read_dir)
+                self.pass_checkpoint(frames,n,read_dir)
+        remove_checkpoint(self.checkpoint)
+
+    def pass_checkpoint(self,frames,n,read_dir):
+        """saves a checkpoint every checkpoint_every frames of the pass, once the frame n is tracked
+        """
+        if self.checkpoint is not None and (n+1)%self.checkpoint_every == 0 and n+1 < len(frames):
+            self.save_checkpoint(frames[n+1:],read_dir)
+
+    def save_checkpoint(self,frames,read_dir):
+        """saves the state of the pass in the checkpoint file (replaced atomically), frames being the frames left to
+        track: the tracks (cell and predictor state, records kept in memory), the activation index, the counters,
+        the tracking options (see :meth:`options`) and the number of rows of each track in the streamed HDF5 file,
+        whose buffered records are written first
+        """
+        stream = None
+        if self.stream is not None:
+            stream = (self.stream.filename,self.stream.chunk,self.stream.sync(self.track_list))
+        counters = dict((k,getattr(self,k)) for k in ['decoded_frames','update_calls','level_time','frame_iterations',
+                                                    'queue_depths','stall_time','streamed_counts'])
+        state = {'read_dir':read_dir,'frames':frames,'track_list':self.track_list,'index':self.index,
+                 'active':self.active,'inactive':self.inactive,'counters':counters,'stream':stream,
+                 'options':self.options()}
+        sinks = [t.sink for t in self.track_list]
+        for t in self.track_list:
+            t.sink = None
+        try:
+            fid = open(self.checkpoint+'.tmp','wb')
+            cPickle.dump(state,fid,cPickle.HIGHEST_PROTOCOL)
+            fid.close()
+            os.rename(self.checkpoint+'.tmp',self.checkpoint)
+        finally:
+            for t,sink in zip(self.track_list,sinks):
+                t.sink = sink
+
+    def resume(self,checkpoint):
+        """restores the state saved in the checkpoint file (see :meth:`save_checkpoint`), the streamed HDF5 file is
+        reopened and truncated to the checkpoint rows, then tracks the frames left of the interrupted pass.
+        The experiment must have the reader and the options (see :meth:`options`) of the interrupted run, other
+        options raise ValueError. The results are the ones of an uninterrupted run (the export date of the
+        'tracks' group excepted), the checkpoint is removed once the pass is completed
+        """
+        fid = open(checkpoint,'rb')
+        state = cPickle.load(fid)
+        fid.close()
+        if state['options'] != self.options():
+            raise ValueError('the pass was interrupted with the options %r, not %r'%(state['options'],self.options()))
+        self.check_pass(state['read_dir'])
+        self.track_list = state['track_list']
+        self.index = state['index']
+        self.active = state['active']
+        self.inactive = state['inactive']
+        for k,v in state['counters'].items():
+            setattr(self,k,v)
+        if state['stream'] is not None:
+            filename,chunk,rows = state['stream']
+            self.stream = TrackStream(filename,chunk,rows=rows)
+        self.attach_stream()
+        self.track_frames(state['frames'],state['read_dir'])
+        remove_checkpoint(checkpoint)
+
+    def stream_hdf5(self,filename,chunk=16):
+        """the records of the next tracking passes are written to the HDF5 file as they are recorded (see
+        :class:`TrackStream`) instead of being kept in the tracks, the file is completed by :meth:`close_stream`
+        (it has the :meth:`save_hdf5` layout)
+        """
+        self.stream = TrackStream(filename,chunk)
+        self.attach_stream()
+
+    def attach_stream(self):
+        """gives each track the record sink of its group in the stream (if any)
+        """
+        if self.stream is not None:
+            for no,t in enumerate(self.track_list):
+                t.sink = self.stream.sink(no)
+
+    def close_stream(self):
+        """completes and closes the HDF5 file of :meth:`stream_hdf5`: rows sorted by frame, track attributes and summary
+        """
+        stream,self.stream = self.stream,None
+        n_records = []
+        for no,t in enumerate(self.track_list):
+            t.sink = None
+            group,rows = stream.finish(no,t)
+            n_records.append(rows)
+            if 'iterations' in group:
+                counts = npy.bincount(group['iterations'][:,0].astype(int),minlength=len(self.streamed_counts))
+                counts[0:len(self.streamed_counts)] += self.streamed_counts
+                self.streamed_counts = counts
+        self.export_summary(stream.fid,n_records)
+        stream.close()
+
+    def prefetch_frames(self,frames,read_dir):
+        """tracks the frames decoded ahead by a :class:`reader.Prefetcher` (self.decoders threads, at most
+        self.prefetch frames ahead, in the tracking direction), the decoding stops once all the tracks are lost.
+        Frames decoded ahead are counted in decoded_frames even if no track needs them in the end
+        """
+        if hasattr(self.reader,'read'):
+            read = self.reader.read
+        else:
+            lock = Lock()
+            def read(frame):
+                with lock:
+                    return self.reader.moveto(frame)
+        prefetcher = Prefetcher(read,frames,self.prefetch,self.decoders)
+        try:
+            for n,frame in enumerate(frames):
+                active = self.activate(frame,read_dir)
+                if active:
+                    print 'process frame ',frame
+                    self.update_tracks(frame,prefetcher.get(frame),read_dir)
+                elif not self.index:
+                    #no more track to update
+                    prefetcher.close()
+                self.pass_checkpoint(frames,n,read_dir)
+        finally:
+            prefetcher.close()
+            self.decoded_frames += prefetcher.decoded
+            self.queue_depths.extend(prefetcher.depths)
+            self.stall_time += prefetcher.stall_time
+
+    def reset_index(self):
+        """builds the activation index of a new tracking pass: the tracks keyed by their mark frame
+        """
+        self.index = {}
+        for t in self.track_list:
+            self.index.setdefault(t.frame0,[]).append(t)
+        self.active = []
+        self.inactive = []
+
+    def activate(self,frame,read_dir):
+        """returns the active tracks of the frame: the tracks marked on the frame join the active set, lost tracks
+        leave it (and only follow the frames to count the saved kernel calls, see :meth:`Track.skip`)
+        """
+        self.active.extend(self.index.pop(frame,[]))
+        if any([read_dir in t.lost for t in self.active]):
+            self.inactive.extend([t for t in self.active if read_dir in t.lost])
+            self.active = [t for t in self.active if read_dir not in t.lost]
+        for t in self.inactive:
+            t.skip(frame,read_dir)
+        return self.active
+
+    def track_both(self,frames,maxsize=16):
+        """tracks the forward and the reverse halves of every track concurrently, in two threads (pipelines)
+        sharing the decoded frames (see :class:`FrameCache`, maxsize frames kept at most), then merges the
+        reverse halves in the tracks (see :meth:`Track.merge`).
+        The forward pipeline reads the frames from the first mark on, the reverse one up to the last mark,
+        each frame is decoded once. The pipelines use nthreads, budget and cap (processes are refused by
+        :meth:`do_tracking`)
+        """
+        if not self.track_list:
+            return
+        starts = [t.frame0 for t in self.track_list]
+        fwd_frames = [f for f in frames if f >= min(starts)]
+        rev_frames = [f for f in reversed(frames) if f <= max(starts)]
+        twins = [t.split() for t in self.track_list]
+        cache = FrameCache(self.reader,[fwd_frames,rev_frames],maxsize)
+        pipelines = []
+        for read_dir,tracks,pipeline_frames in [('fwd',self.track_list,fwd_frames),('rev',twins,rev_frames)]:
+            part = Experiment(None,self.name,self.nthreads,self.budget,self.cap)
+            part.track_list = tracks
+            part.reset_index()
+            pipelines.append((part,Thread(target=part.run_pipeline,args=(cache,pipeline_frames,read_dir))))
+        for part,thread in pipelines:
+            thread.start()
+        for part,thread in pipelines:
+            thread.join()
+        for part,thread in pipelines:
+            if part.error is not None:
+                raise part.error
+        for t,twin in zip(self.track_list,twins):
+            t.merge(twin)
+        for part,thread in pipelines:
+            self.add_level_time(part.level_time)
+            for frame,n in part.frame_iterations.items():
+                self.frame_iterations[frame] = self.frame_iterations.get(frame,0)+n
+            self.update_calls += part.update_calls
+        self.decoded_frames += cache.decoded
+
+    def run_pipeline(self,cache,frames,read_dir):
+        """updates the tracks for the frames read from the cache, keeps the exception raised if any in error
+        """
+        self.error = None
+        try:
             for frame in frames:
+                if self.activate(frame,read_dir):
+                    print 'process frame %s (%s)'%(frame,read_dir)
+                    self.update_tracks(frame,cache.get(frame),read_dir)
+                else:
+                    cache.release(frame)
+        except Exception as e:
+            self.error = e
+
+    def process_frames(self,frames,read_dir):
+        """tracks the frames with self.processes worker processes, each one updating its share of the tracks
+        (one track out of processes, see :func:`track_worker`)
+
+        the parent decodes each frame once into a shared memory double buffer (see :class:`SharedFrames`) read
+        zero-copy by the workers, the next frame is decoded while the workers process the current one.
+        The tracks updated by the workers replace the ones of track_list at the end. When streaming, the workers
+        send the records of each frame back to the parent that writes them.
+
+        Frames without active track are not decoded (the workers only follow them, see :meth:`activate`). The
+        workers report their active tracks with the acknowledgement of each frame and the parent decodes a frame
+        while the previous one is processed, so that one frame at most is decoded after all the tracks are lost.
+
+        A budget is split between the workers in proportion to their tracks, each worker schedules its own tracks
+        (see :func:`schedule_cells`): the results are the ones of serial experiments tracking track_list[k::processes]
+        with their share of the budget, not the ones of a serial experiment with the whole budget
+        """
+        if not frames or not self.track_list:
+            return
+        P = max(min(self.processes,len(self.track_list)),1)
+        im = self.reader.moveto(frames[0])
+        self.decoded_frames += 1
+        shared = SharedFrames(im.shape,im.dtype)
+        starts = set([t.frame0 for t in self.track_list])
+        workers = []
+        inflight = []
+        state = {'acked':-1,'alive':True}
+        def acknowledge():
+            #acknowledgements of the oldest frame sent
+            n = inflight.pop(0)
+            alive = False
+            for k,(p,conn) in enumerate(workers):
+                frame,active,recs = receive(conn)
+                alive = alive or active
+                for i,rec in recs:
+                    t = self.track_list[k+i*P]
+                    t.sink(t,frame,rec)
+            state['acked'],state['alive'] = n,alive
+        try:
+            for k in range(P):
+                part = Experiment(None,self.name,self.nthreads,cap=self.cap)
+                part.track_list = self.track_list[k::P]
+                part.reset_index()
+                if self.budget is not None:
+                    part.budget = int(round(self.budget*len(part.track_list)/float(len(self.track_list))))
+                parent_conn,child_conn = Pipe()
+                p = Process(target=track_worker,args=(child_conn,part,shared,self.stream is not None))
+                p.daemon = True
+                p.start()
+                workers.append((p,parent_conn))
+            sent = 0
+            for n,frame in enumerate(frames):
+                #the buffer of the frame sent two frames ago is reused once it is processed
+                if len(inflight) >= 2:
+                    acknowledge()
+                #no active track (as of the last acknowledged frame) and no mark since
+                if not state['alive'] and not starts.intersection(frames[state['acked']+1:n+1]):
+                    for p,conn in workers:
+                        conn.send((frame,None,read_dir))
+                    continue
                 print 'process frame ',frame
-                im = self.reader.moveto(frame)
-                for t in self.track_list:
-                    t.update(frame,im,read_dir)
+                if n:
+                    im = self.reader.moveto(frame)
+                    self.decoded_frames += 1
+                shared.write(sent%2,im)
+                for p,conn in workers:
+                    conn.send((frame,sent%2,read_dir))
+                inflight.append(n)
+                sent += 1
+            while inflight:
+                acknowledge()
+            #merge the worker results
+            for k,(p,conn) in enumerate(workers):
+                conn.send(None)
+                tracks,level_time,frame_iterations,update_calls = receive(conn)
+                self.track_list[k::P] = tracks
+                self.update_calls += update_calls
+                self.add_level_time(level_time)
+                for frame,n in frame_iterations.items():
+                    self.frame_iterations[frame] = self.frame_iterations.get(frame,0)+n
+                p.join()
+            self.attach_stream()
+        finally:
+            for p,conn in workers:
+                if p.is_alive():
+                    p.terminate()
+
+    def update_tracks(self,frame,im,read_dir):
+        """update the active tracks (see :meth:`activate`) concerned by the frame
+        """
+        active = [t for t in self.active if t.accepts(frame,read_dir)]
+        self.update_calls += len(active)
+        if self.budget is not None:
+            for t in active:
+                t.prepare(frame)
+            self.frame_iterations[frame] = schedule_cells([t.cell for t in active],im,self.budget,
+                                                          cap=self.cap,nthreads=self.nthreads)
+            for t in active:
+                t.record(frame,read_dir,im)
+        elif self.nthreads is None:
+            for t in active:
+                t.update(frame,im,read_dir)
+        else:
+            for t in active:
+                t.prepare(frame)
+            update_cells([t.cell for t in active],im,nthreads=self.nthreads)
+            for t in active:
+                t.record(frame,read_dir,im)
+        #time spent per pyramid level (level 0 is the full resolution)
+        for t in active:
+            self.add_level_time(t.cell.level_time)
+
+    def add_level_time(self,level_time):
+        if len(level_time) > len(self.level_time):
+            self.level_time = npy.hstack((self.level_time,npy.zeros(len(level_time)-len(self.level_time))))
+        self.level_time[0:len(level_time)] += level_time
+
+    def iteration_counts(self):
+        """returns h, h[k] being the number of recorded cell updates (all tracks and frames) that used k iterations
+        (e.g. to tune niter and tol), the streamed records are counted once the stream is closed
+        """
+        used = [rec[3][0] for t in self.track_list for rec in t.records.values()]
+        counts = npy.bincount(npy.asarray(used,dtype=int),minlength=len(self.streamed_counts))
+        counts[0:len(self.streamed_counts)] += self.streamed_counts
+        return counts
 
     def save_hdf5(self,filename):
         """saves all track data to HDF5 file
         """
         fid = h5py.File(filename, 'w')
+        self.export_summary(fid,[len(t.records) for t in self.track_list])
+
+        # TRACK group
+        tracks = fid.create_group("tracks")
+        export_datetime = datetime.now().isoformat(' ')
+        tracks.attrs.create('date',[export_datetime])
+        for no,t in enumerate(self.track_list):
+            # one group per track
+            track = tracks.create_group('track%04d'%no)
+            t.export_to_hdf5(track)
+
+        del(fid)
 
+    def export_summary(self,fid,n_records):
+        """writes the summary group of the HDF5 file, n_records being the number of records of each track
+        """
         # create one experiment SUMMARY dataset
         # these data are common for all models
         n_track = len(self.track_list)
@@ -332,23 +1289,234 @@ class Experiment(object):
         frames = summary.create_dataset('frames', (n_track,3), dtype=int)
         frames.attrs.create('features',['#frame','first_frame','last_frame'])
         for no,t in enumerate(self.track_list):
-            frames[no,:] = [len(t.records),t.frame_range[0],t.frame_range[1]]
+            frames[no,:] = [n_records[no],t.frame_range[0],t.frame_range[1]]
         # marks
         marks = summary.create_dataset('marks', (n_track,3), dtype=int)
         marks.attrs.create('features',['x','y','#frame'])
         for no,t in enumerate(self.track_list):
             marks[no,:] = [t.x0,t.y0,t.frame0]
-
-        # TRACK group
-        tracks = fid.create_group("tracks")
-        export_datetime = datetime.now().isoformat(' ')
-        tracks.attrs.create('date',[export_datetime])
+        # iterations used per update
+        counts = self.iteration_counts()
+        iterations = summary.create_dataset('iterations', counts.shape, dtype=int)
+        iterations.attrs.create('features',['#updates with k iterations'])
+        iterations[:] = counts
+        # lost tracks
+        lost = summary.create_dataset('lost', (n_track,3), dtype=int)
+        lost.attrs.create('features',['fwd_lost_frame','rev_lost_frame','saved_calls'])
         for no,t in enumerate(self.track_list):
-            # one group per track
-            track = tracks.create_group('track%04d'%no)
-            t.export_to_hdf5(track)
+            lost[no,:] = t.lost_frames()+[t.saved]
+        summary.attrs.create('saved_calls',sum([t.saved for t in self.track_list]))
+
+class TrackStream(object):
+    """HDF5 file written while tracking (see :meth:`Experiment.stream_hdf5`): one group per track ('tracks/track%04d')
+    holding one resizable dataset per record field (see :meth:`Track.rec_structure`) and the frame of each row
+    ('frames'). The records of a track are buffered and appended chunk rows at a time, so that the memory used
+    does not grow with the number of frames, the file is flushed every flush seconds at most.
+    Rows are appended in the tracking order, :meth:`finish` sorts them by frame (the last record of a frame is kept)
+    and removes 'frames'
+
+    with rows (see :meth:`sync`), an existing file is reopened and its tracks truncated to rows[no] rows
+    """
+    def __init__(self,filename,chunk=16,flush=10.0,rows=None):
+        self.filename = filename
+        if rows is None:
+            self.fid = h5py.File(filename,'w')
+            self.tracks = self.fid.create_group('tracks')
+            self.tracks.attrs.create('date',[datetime.now().isoformat(' ')])
+        else:
+            self.fid = h5py.File(filename,'r+')
+            self.tracks = self.fid['tracks']
+            for name,group in self.tracks.items():
+                for ds in group.values():
+                    ds.resize(rows.get(int(name[5:]),0),axis=0)
+        self.chunk = chunk
+        self.flush = flush
+        self.flushed = time()
+        self.buffers = {}
+        self.lock = Lock()
+
+    def sink(self,no):
+        """returns the record sink of the track no (see :class:`Track`)
+        """
+        def append(track,frame,rec):
+            self.append(no,track,frame,rec)
+        return append
+
+    def append(self,no,track,frame,rec):
+        with self.lock:
+            buffer = self.buffers.setdefault(no,[])
+            buffer.append((frame,rec))
+            if len(buffer) >= self.chunk:
+                self.write(no,track)
+
+    def group(self,no):
+        name = 'track%04d'%no
+        if name not in self.tracks:
+            group = self.tracks.create_group(name)
+            frames = group.create_dataset('frames',(0,),maxshape=(None,),chunks=(self.chunk,),dtype=int)
+            frames.attrs.create('features',['#frame'])
+        return self.tracks[name]
+
+    def write(self,no,track):
+        """appends the buffered records of the track no
+        """
+        buffer = self.buffers.pop(no,[])
+        group = self.group(no)
+        if not buffer:
+            return group
+        n = group['frames'].shape[0]
+        group['frames'].resize((n+len(buffer),))
+        group['frames'][n:] = [frame for frame,rec in buffer]
+        for i,s in enumerate(track.rec_structure()):
+            data = npy.asarray([rec[i] for frame,rec in buffer])
+            if s['dataset_name'] not in group:
+                shape = data.shape[1:]
+                ds = group.create_dataset(s['dataset_name'],(0,)+shape,maxshape=(None,)+shape,
+                                          chunks=(self.chunk,)+shape,dtype=float)
+                for att_name,att_list in s['attributes']:
+                    ds.attrs.create(att_name,att_list)
+            ds = group[s['dataset_name']]
+            ds.resize(n+len(buffer),axis=0)
+            ds[n:] = data
+        if time()-self.flushed > self.flush:
+            self.fid.flush()
+            self.flushed = time()
+        return group
+
+    def sync(self,track_list):
+        """writes the buffered records and flushes the file, returns the rows of each track {no:rows}
+        """
+        with self.lock:
+            for no in list(self.buffers):
+                self.write(no,track_list[no])
+            self.fid.flush()
+            self.flushed = time()
+            return dict((int(name[5:]),group['frames'].shape[0]) for name,group in self.tracks.items())
+
+    def finish(self,no,track):
+        """writes the last records and the attributes of the track no, sorts its rows by frame and removes the
+        'frames' dataset (the group then has the :meth:`Experiment.save_hdf5` layout), returns (group,rows)
+        """
+        with self.lock:
+            group = self.write(no,track)
+            frames = group['frames'][:]
+            del group['frames']
+            last = dict((frame,i) for i,frame in enumerate(frames))
+            rows = [last[frame] for frame in sorted(last)]
+            if rows != range(len(frames)):
+                #one track at a time in memory
+                for name in group:
+                    data = group[name][:][rows]
+                    group[name].resize(len(rows),axis=0)
+                    group[name][:] = data
+            track.export_attributes(group)
+            return group,len(rows)
+
+    def close(self):
+        self.fid.close()
+
+class FrameCache(object):
+    """decoded frames shared by tracking pipelines running in threads (see :meth:`Experiment.track_both`), pipelines
+    is the list of the frames read by each pipeline: a frame is decoded once and kept until all the pipelines reading
+    it got it (at most maxsize frames are kept, the others are decoded again), decoded counts the decoded frames
+    """
+    def __init__(self,reader,pipelines,maxsize=16):
+        self.reader = reader
+        self.maxsize = maxsize
+        self.uses = {}
+        for frames in pipelines:
+            for frame in frames:
+                self.uses[frame] = self.uses.get(frame,0)+1
+        self.frames = {}
+        self.decoded = 0
+        self.lock = Lock()
+
+    def get(self,frame):
+        with self.lock:
+            im = self.frames.get(frame)
+            if im is None:
+                im = self.reader.moveto(frame)
+                self.decoded += 1
+            self.uses[frame] -= 1
+            if self.uses[frame] > 0 and len(self.frames) < self.maxsize:
+                self.frames[frame] = im
+            else:
+                self.frames.pop(frame,None)
+            return im
+
+    def release(self,frame):
+        """a pipeline skips the frame (no active track)
+        """
+        with self.lock:
+            self.uses[frame] -= 1
+            if self.uses[frame] <= 0:
+                self.frames.pop(frame,None)
+
+class SharedFrames(object):
+    """frames of a given shape and dtype in shared memory (n buffers), allocated before the worker processes are
+    forked, view(i) is a numpy array on the buffer i (no copy)
+    """
+    def __init__(self,shape,dtype,n=2):
+        self.shape = shape
+        self.dtype = npy.dtype(dtype)
+        size = int(npy.prod(shape))*self.dtype.itemsize
+        self.buffers = [RawArray('b',size) for i in range(n)]
+
+    def view(self,i):
+        return npy.frombuffer(self.buffers[i],dtype=self.dtype).reshape(self.shape)
+
+    def write(self,i,im):
+        if im.shape != self.shape or im.dtype != self.dtype:
+            raise ValueError('all the frames must have the same shape and dtype')
+        self.view(i)[...] = im
+
+def track_worker(conn,experiment,shared,stream=False):
+    """worker process of :meth:`Experiment.process_frames`: updates the active tracks of experiment for each
+    (frame,buffer,read_dir) message received, acknowledged by (frame,active,recs), active being True if some
+    tracks are still active (not lost). A None buffer is a frame without active track, followed (see
+    :meth:`Experiment.activate`) but not acknowledged. A None message ends the tracking and sends back
+    (track_list,level_time,frame_iterations,update_calls), an error is sent back as a RuntimeError
+
+    with stream, the records are not kept: recs is [(i,rec),...], i being the index of the track in
+    experiment.track_list, otherwise recs is empty
+    """
+    try:
+        if stream:
+            for t in experiment.track_list:
+                t.sink = None
+        while True:
+            msg = conn.recv()
+            if msg is None:
+                break
+            frame,i,read_dir = msg
+            if i is None:
+                experiment.activate(frame,read_dir)
+                continue
+            #a new view per frame: the pyramid and moment caches are keyed on the array identity
+            if experiment.activate(frame,read_dir):
+                experiment.update_tracks(frame,shared.view(i),read_dir)
+            recs = []
+            if stream:
+                recs = [(k,t.records.pop(frame)) for k,t in enumerate(experiment.track_list) if frame in t.records]
+            active = any([read_dir not in t.lost for t in experiment.active])
+            conn.send((frame,active,recs))
+        conn.send((experiment.track_list,experiment.level_time,experiment.frame_iterations,experiment.update_calls))
+    except Exception:
+        conn.send(RuntimeError(format_exc()))
+
+def remove_checkpoint(filename):
+    """removes the checkpoint file of a completed pass (if any)
+    """
+    if filename is not None and os.path.exists(filename):
+        os.remove(filename)
 
-        del(fid)
+def receive(conn):
+    """receives a worker message, raises the worker errors
+    """
+    msg = conn.recv()
+    if isinstance(msg,Exception):
+        raise msg
+    return msg
 
 #=================================================================================================
 def import_marks(filename):
@@ -362,17 +1530,29 @@ def import_marks(filename):
         marks.append((float(row[0]),float(row[1]),float(row[2])))
     return npy.asarray(marks)
 
-def test_experiment(datazip_filename,marks_filename,hdf5_filename,dir='fwd',params=None):
+def export_marks(filename,marks):
+    """write the (x,y,frame) marks in a CSV file (see :func:`import_marks`)
+    """
+    fid = open(filename,'w+t')
+    for x,y,t in marks:
+        fid.write('%f,%f,%d\n'%(x,y,t))
+    fid.close()
+
+def test_experiment(datazip_filename,marks_filename,hdf5_filename,dir='fwd',params=None,nthreads=None,predictor=None,budget=None,cap=None,policy=None,seed_frame=0,processes=None,prefetch=None,stream=False,
+                    checkpoint=None,checkpoint_every=100,resume=False):
     """Test function: create an Experiment object for a sequence, data are saved in HDF5 file
+    without marks file, the cells are detected on seed_frame (see :meth:`Experiment.add_seeds`)
+    with stream, the HDF5 file is written while tracking (see :meth:`Experiment.stream_hdf5`)
+    with checkpoint, the tracking state is saved every checkpoint_every frames, with resume the tracking
+    restarts from the checkpoint (see :meth:`Experiment.resume`)
     """
     #define sequence source
 #    datazip_filename = '../test/data/seq0.zip'
     reader = Reader(ZipSource(datazip_filename))
 
-    experiment = Experiment(reader,exp_name='Test')
+    experiment = Experiment(reader,exp_name='Test',nthreads=nthreads,budget=budget,cap=cap,processes=processes,prefetch=prefetch,
+                            checkpoint=checkpoint,checkpoint_every=checkpoint_every)
 
-    #mark initial cell position (may be in the middle of the sequence
-    marks = import_marks(marks_filename)
     if params is None:
         params = {'N':12,'radius_halo':20,'radius_soma':15,'exp_halo':15,'exp_soma':2,'niter':5,'alpha':.75}
         import json
@@ -384,17 +1564,45 @@ def test_experiment(datazip_filename,marks_filename,hdf5_filename,dir='fwd',para
         del fid
         print 'parameters saved in ',filename
 
-    track_list = []
-    for x0,y0,frame0 in marks:
-        t = Track(x0=x0,y0=y0,frame0=frame0,model=AdaptiveCell,params=params)
-        experiment.add_track(t)
+    #mark initial cell position (may be in the middle of the sequence
+    if resume:
+        pass
+    elif marks_filename is None:
+        seeds = experiment.add_seeds(seed_frame,AdaptiveCell,params,predictor=predictor,policy=policy)
+        print '%d cells detected on frame %d'%(len(seeds),seed_frame)
+    else:
+        marks = import_marks(marks_filename)
+        for x0,y0,frame0 in marks:
+            t = Track(x0=x0,y0=y0,frame0=frame0,model=AdaptiveCell,params=params,predictor=predictor,policy=policy)
+            experiment.add_track(t)
 
     #process the tracking
 #    experiment.do_tracking('rev')
-    experiment.do_tracking(dir)
+    if resume:
+        experiment.resume(checkpoint)
+    else:
+        if stream:
+            experiment.stream_hdf5(hdf5_filename)
+        experiment.do_tracking(dir)
+    streamed = experiment.stream is not None
+    if streamed:
+        experiment.close_stream()
+
+    counts = experiment.iteration_counts()
+    print 'iterations per update:',dict((k,n) for k,n in enumerate(counts) if n),' mean:',npy.dot(npy.arange(len(counts)),counts)/max(counts.sum(),1.)
+    if budget is not None:
+        print 'iterations per frame (budget %d):'%budget,[n for f,n in sorted(experiment.frame_iterations.items())]
+    if policy is not None:
+        lost = [t for t in experiment.track_list if t.lost]
+        print 'lost tracks: %d/%d, kernel calls saved: %d'%(len(lost),len(experiment.track_list),sum([t.saved for t in lost]))
+    print 'frames decoded:',experiment.decoded_frames,' track updates:',experiment.update_calls
+    if prefetch is not None:
+        print 'prefetch queue depth (mean): %2.2f, stall time: %2.3f sec'%(npy.mean(experiment.queue_depths or [0]),experiment.stall_time)
+    print 'time per pyramid level (0 is full resolution):',', '.join(['%d: %2.3f sec'%lt for lt in enumerate(experiment.level_time)])
 
     #save data to file
-    experiment.save_hdf5(hdf5_filename)
+    if not streamed:
+        experiment.save_hdf5(hdf5_filename)
 
 if __name__ == "__main__":
 
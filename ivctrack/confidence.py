@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+'''Tracking confidence and track-loss policy (see :class:`cellmodel.Track`)
+'''
+__author__ = 'Copyright (C) 2012, Olivier Debeir <odebeir@ulb.ac.be>'
+__license__ ="""
+ivctrack is a python module for in-vitro cell tracking.
+
+Copyright (C) 2012  Olivier Debeir
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as npy
+
+from meanshift import PowerLaw
+
+confidence_features = ['halo','soma','coverage','score']
+
+def weight_range(lut,exp):
+    """returns the image value giving the largest weight of a LUT or :class:`PowerLaw` (i.e. vmax)
+    """
+    if isinstance(lut,PowerLaw):
+        return lut.vmax
+    return lut.max()**(1./exp)
+
+def power_mean(shift,lut,exp):
+    """returns the weighted mean of the meanshift results (totalvalue/surfalpha), as a normalized
+    value in [0,1] (i.e. (mean weight)**(1/exp)/vmax)
+    """
+    surfalpha = shift[:,3].sum()
+    if surfalpha <= 0.0:
+        return 0.0
+    return (shift[:,4].sum()/surfalpha)**(1./exp)/weight_range(lut,exp)
+
+def coverage(tri,shape):
+    """returns the part of the bounding box of a (K,6) triangle table inside an image of the given shape
+    """
+    m,n = shape[0:2]
+    x = tri[:,0::2]
+    y = tri[:,1::2]
+    cover = 1.0
+    for v,size in [(x,n),(y,m)]:
+        vmin,vmax = v.min(),v.max()
+        if vmax <= vmin:
+            return 0.0
+        cover *= max(min(vmax,size-.5)-max(vmin,-.5),0.0)/(vmax-vmin)
+    return cover
+
+def confidence(cell,im):
+    """returns the confidence of the last cell update on im, see confidence_features:
+
+    * halo: normalized brightness of the halo (power mean of the halo weights)
+    * soma: normalized darkness of the soma (power mean of the soma weights)
+    * coverage: part of the halo (bounding box) inside the image
+    * score: halo+soma-1, the contrast between the halo and the soma (1 for a white halo around
+      a black soma, about 0 on a uniform background)
+    """
+    lut_halo,lut_soma = cell.luts(im)
+    halo = power_mean(cell.shift_halo,lut_halo,cell.exp_halo)
+    soma = power_mean(cell.shift_soma,lut_soma,cell.exp_soma)
+    return npy.asarray([halo,soma,coverage(cell.tri_halo,im.shape),halo+soma-1.])
+
+class LossPolicy(object):
+    """Decides when a track is lost (and is no longer updated):
+
+    * 'border': the halo coverage is below coverage (the cell leaves the image)
+    * 'low confidence': the score stays below max(threshold,ratio*reference) during patience consecutive frames,
+      the reference being the score of the track mark frame
+    """
+    def __init__(self,threshold=0.0,ratio=0.5,patience=3,coverage=0.5):
+        self.threshold = threshold
+        self.ratio = ratio
+        self.patience = patience
+        self.coverage = coverage
+
+    def check(self,conf,reference,low):
+        """returns (reason,low): the loss reason (None if the track is not lost) and the updated number of
+        consecutive low confidence frames, given the confidence of the frame and the reference score
+        """
+        if conf[2] < self.coverage:
+            return 'border',low
+        if conf[3] < max(self.threshold,self.ratio*reference):
+            low += 1
+        else:
+            low = 0
+        if low >= self.patience:
+            return 'low confidence',low
+        return None,low
+
+    def __repr__(self):
+        return 'LossPolicy(threshold=%r,ratio=%r,patience=%r,coverage=%r)'%(self.threshold,self.ratio,self.patience,self.coverage)
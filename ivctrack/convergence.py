@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+'''Basins of attraction of a cell model on a frame (e.g. for model parameters tuning), headless
+'''
+__author__ = 'Copyright (C) 2012, Olivier Debeir <odebeir@ulb.ac.be>'
+__license__ ="""
+ivctrack is a python module for in-vitro cell tracking.
+
+Copyright (C) 2012  Olivier Debeir
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as npy
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from cellmodel import AdaptiveCell,CellPopulation,update_cells
+
+def cluster_points(points,distance):
+    """returns the (K,) labels of the (K,2) points, two points closer than distance share the same label
+    (single linkage), labels are numbered by decreasing cluster size
+    """
+    K = points.shape[0]
+    if K == 0:
+        return npy.zeros(0,dtype=int)
+    pairs = cKDTree(points).query_pairs(distance,output_type='ndarray') if K > 1 else npy.zeros((0,2),dtype=int)
+    graph = coo_matrix((npy.ones(len(pairs)),(pairs[:,0],pairs[:,1])),shape=(K,K))
+    n,labels = connected_components(graph,directed=False)
+    #relabel by decreasing size
+    order = npy.argsort(-npy.bincount(labels,minlength=n),kind='mergesort')
+    rank = npy.empty(n,dtype=int)
+    rank[order] = npy.arange(n)
+    return rank[labels]
+
+def update_grid(frame,model,params,starts,nthreads=None):
+    """Updates a model started from each of the (K,2) starts on the frame, all the cells are updated together:
+    AdaptiveCell through a :class:`cellmodel.CellPopulation`, other models through :func:`cellmodel.update_cells`
+
+    returns (centers,iterations,paths): the (K,2) convergence points, the (K,) iterations used and the list
+    of the K (iterations,2) paths
+    """
+    if model is AdaptiveCell and params.get('levels',1) == 1:
+        population = CellPopulation(starts,**dict((k,v) for k,v in params.items() if k != 'levels'))
+        population.update(frame,nthreads=nthreads)
+        iterations = population.iterations
+        paths = [path[:k] for path,k in zip(population.path,iterations)]
+        return population.center,iterations,paths
+    cells = [model(x,y,**params) for x,y in starts]
+    update_cells(cells,frame,nthreads=nthreads)
+    return npy.asarray([c.center for c in cells]),npy.asarray([c.iterations for c in cells]),[c.path for c in cells]
+
+def convergence_map(frame,model,params,step,distance=1.0,nthreads=None):
+    """Updates a model started from every node of a grid (spacing step pixels) on the frame, all the
+    grid cells are updated together (see :func:`update_grid`)
+
+    returns (grid,centers,iterations,labels):
+
+    * grid (ny,nx,2): starting points (x,y)
+    * centers (ny,nx,2): convergence points
+    * iterations (ny,nx): iterations used
+    * labels (ny,nx): basin of attraction, starting points whose convergence points are closer than
+      distance share the same label (0 is the largest basin, see :func:`cluster_points`)
+    """
+    m,n = frame.shape[0:2]
+    xx,yy = npy.meshgrid(npy.arange(step/2.,n,step),npy.arange(step/2.,m,step))
+    grid = npy.dstack((xx,yy))
+    centers,iterations,paths = update_grid(frame,model,params,grid.reshape(-1,2),nthreads)
+    labels = cluster_points(centers,distance)
+    return grid,centers.reshape(grid.shape),iterations.reshape(xx.shape),labels.reshape(xx.shape)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+'''Automatic detection of the initial cell positions (seeds), used instead of manual marks
+'''
+__author__ = 'Copyright (C) 2012, Olivier Debeir <odebeir@ulb.ac.be>'
+__license__ ="""
+ivctrack is a python module for in-vitro cell tracking.
+
+Copyright (C) 2012  Olivier Debeir
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from math import floor,log
+import numpy as npy
+from scipy.ndimage import gaussian_filter1d,maximum_filter1d
+
+from meanshift import image_pyramid
+
+def gaussian(ima,sigma):
+    """separable gaussian filter (one 1D filter per axis), float32 result
+    """
+    f = gaussian_filter1d(ima,sigma,axis=0,output=npy.float32)
+    return gaussian_filter1d(f,sigma,axis=1,output=npy.float32)
+
+def local_maxima(ima,size):
+    """returns the mask of the pixels equal to the maximum of their size x size neighbourhood
+    (separable maximum filter)
+    """
+    m = maximum_filter1d(ima,size,axis=0)
+    m = maximum_filter1d(m,size,axis=1)
+    return ima == m
+
+def seed_response(frame,params):
+    """returns the detection response and the pyramid level it is computed on:
+    the difference of gaussians G(radius_halo/2)-G(radius_soma/3), positive on dark somas
+    surrounded by a bright halo. The frame is downsampled (see :func:`meanshift.image_pyramid`)
+    as long as the smallest sigma stays above 2 pixels
+    """
+    s1 = params['radius_soma']/3.
+    s2 = params['radius_halo']/2.
+    level = max(int(floor(log(s1/2.,2))),0)
+    ima = image_pyramid(frame,level+1)[level].astype(npy.float32)
+    scale = 2.**level
+    return gaussian(ima,s2/scale)-gaussian(ima,s1/scale),level
+
+def detect_seeds(frame,params,threshold=20.0,min_distance=None,max_seeds=None):
+    """Detect the cells of a frame, returns a (K,2) array of (x,y) seeds sorted by decreasing response
+
+    :param frame: image (uint8, uint16 or float32)
+    :param params: cell model parameters (radius_halo and radius_soma are used, see :class:`cellmodel.Cell`)
+    :param threshold: minimum response, in median absolute deviations above the median response
+    :param min_distance: minimum distance between two seeds (non-maximum suppression window), default radius_soma
+    :param max_seeds: maximum number of seeds (the strongest are kept)
+    """
+    if min_distance is None:
+        min_distance = params['radius_soma']
+    response,level = seed_response(frame,params)
+    scale = 2.**level
+    size = 2*int(min_distance/scale)+1
+    med = npy.median(response)
+    mad = npy.median(npy.abs(response-med))
+    peaks = local_maxima(response,size) & (response > med+threshold*mad)
+    y,x = npy.nonzero(peaks)
+    order = npy.argsort(-response[y,x],kind='mergesort')[:max_seeds]
+    #pyramid pixel (i,j) of level k is located at 2**k*(i,j)+(2**k-1)/2
+    shift = (scale-1.)/2.
+    return npy.column_stack((x[order]*scale+shift,y[order]*scale+shift))
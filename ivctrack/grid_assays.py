@@ -34,6 +34,7 @@ import numpy as npy
 from chaco.tools.api import PanTool, ZoomTool
 
 from cellmodel import Cell
+from convergence import convergence_map,update_grid
 from reader import ZipSource,Reader
 
 from enable.api import BaseTool
@@ -50,50 +51,40 @@ def get_marks(bg):
     return xy
 
 
-def plot_grid(bg,model,params):
-    """seach the convergence point for a grid af initial starting points
-    plots the results (MPL)
+def plot_grid(bg,model,params,step=None):
+    """seach the convergence point for a grid af initial starting points (see :func:`convergence.convergence_map`)
+    plots the results (MPL), one color per basin of attraction
     """
-    print 'random seed'
     m,n = bg.shape
-    N = 10
-    xx,yy = npy.meshgrid(npy.linspace(0,n,N),npy.linspace(0,m,N))
-    data = []
-    for xr,yr in zip(xx.flatten(),yy.flatten()):
-        print xr,yr
-        cell = model(xr,yr,**params)
-        cell.update(bg)
-        data.append((xr,yr,cell.center[0],cell.center[1]))
-    data = npy.asarray(data)
-    print data
-
-    plt.imshow(bg)
-#    plt.plot(data[:,0],data[:,1],'or')
-    plt.plot(data[:,2],data[:,3],'o')
+    if step is None:
+        step = max(m,n)/10.
+    grid,centers,iterations,labels = convergence_map(bg,model,params,step)
+    plot_convergence_map(bg,grid,centers,labels)
     plt.show()
 
+def plot_convergence_map(bg,grid,centers,labels):
+    """plots the starting points colored by basin of attraction, and the convergence points (MPL)
+    """
+    plt.imshow(bg,cmap=plt.cm.gray)
+    plt.scatter(grid[:,:,0].ravel(),grid[:,:,1].ravel(),c=labels.ravel(),s=9,cmap=plt.cm.jet,lw=0)
+    plt.plot(centers[:,:,0].ravel(),centers[:,:,1].ravel(),'ow')
+    plt.xlim(0,bg.shape[1])
+    plt.ylim(bg.shape[0],0)
+
 def plot_grid_path(bg,model,params):
-    """seach the convergence point for a grid af initial starting points
-    plots the results (MPL)
+    """seach the convergence point for a grid af initial starting points (see :func:`convergence.update_grid`)
+    plots the paths (MPL)
     """
-    print 'random seed'
     m,n = bg.shape
     N = 5
     xx,yy = npy.meshgrid(npy.linspace(0,n,N),npy.linspace(0,m,N))
-    data = []
+    centers,iterations,paths = update_grid(bg,model,params,npy.column_stack((xx.flatten(),yy.flatten())))
 
     plt.figure()
     plt.imshow(bg)
 
-    for xr,yr in zip(xx.flatten(),yy.flatten()):
-        print xr,yr
-        cell = model(xr,yr,**params)
-        cell.update(bg)
-        data.append((xr,yr,cell.center[0],cell.center[1]))
-        plt.plot(cell.path[:,0],cell.path[:,1])
-    data = npy.asarray(data)
-    print data
-
+    for path in paths:
+        plt.plot(path[:,0],path[:,1])
 
     plt.show()
 
@@ -31,12 +31,31 @@ def test_marks(filename):
     m = import_marks(filename)
     print m
 
-def track(source,dir,marks,hdf5,params):
+def track(source,dir,marks,hdf5,params,threads=None,predictor=None,budget=None,cap=None,lost=False,seed_frame=None,processes=None,prefetch=None,stream=False,
+          checkpoint=None,checkpoint_every=100,resume=False):
     import json
     s = json.loads(open(params).read())
     print s
     from cellmodel import test_experiment
-    test_experiment(datazip_filename=source,marks_filename=marks,hdf5_filename=hdf5,dir=dir,params=s)
+    from confidence import LossPolicy
+    policy = LossPolicy() if lost else None
+    if seed_frame is not None:
+        marks = None
+    test_experiment(datazip_filename=source,marks_filename=marks,hdf5_filename=hdf5,dir=dir,params=s,nthreads=threads,predictor=predictor,budget=budget,cap=cap,policy=policy,
+                    seed_frame=seed_frame,processes=processes,prefetch=prefetch,stream=stream,
+                    checkpoint=checkpoint,checkpoint_every=checkpoint_every,resume=resume)
+
+def detect(source,frame,marks,params):
+    import json
+    from reader import ZipSource,Reader
+    from detection import detect_seeds
+    from cellmodel import export_marks
+    s = json.loads(open(params).read())
+    reader = Reader(ZipSource(source))
+    im = reader.moveto(frame)
+    seeds = detect_seeds(im,s)
+    export_marks(marks,[(x,y,reader.head) for x,y in seeds])
+    print '%d cells detected, marks saved in '%len(seeds),marks
 
 def play(source,hdf5):
     from player import test_player
@@ -90,6 +109,14 @@ if __name__ == '__main__':
     parser_mark.add_argument("--frame", type=int,help="frame where to place marks (-1 is last frame etc)",default=1)
     parser_mark.set_defaults(mode='mark')
 
+    parser_detect = subparsers.add_parser('detect', help='detects the cells of the n-th frame of a zipped sequence file, save marks in a .csv file',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser_detect.add_argument("--seq", type=str,help="image sequence (.zip)",required=True)
+    parser_detect.add_argument("--marks", type=str,help="marks file (.csv)",default='marks.csv')
+    parser_detect.add_argument("--frame", type=int,help="frame where to detect the cells",default=0)
+    parser_detect.add_argument("--params", type=str,help="parameters file (.json), radius_halo and radius_soma set the cell size",default='parameters.json')
+    parser_detect.set_defaults(mode='detect')
+
     parser_track = subparsers.add_parser('track', help='track a zipped sequence file using marks',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser_track.add_argument("--seq", type=str,help="image sequence (.zip)",required=True)
@@ -97,6 +124,18 @@ if __name__ == '__main__':
     parser_track.add_argument("--dir", choices=['fwd','rev','both'],help="tracking direction",default='fwd')
     parser_track.add_argument("--hdf5", type=str,help="HDF5 destination filepath",default='tracks.hdf5')
     parser_track.add_argument("--params", type=str,help="parameters file (.json)",default='parameters.json')
+    parser_track.add_argument("--threads", type=int,help="update all the cells of a frame together using THREADS kernel threads",default=None)
+    parser_track.add_argument("--predictor", choices=['velocity','kalman'],help="seed each frame with the predicted cell position",default=None)
+    parser_track.add_argument("--processes", type=int,help="split the tracks between PROCESSES worker processes (a BUDGET is split between them in proportion to their tracks)",default=None)
+    parser_track.add_argument("--prefetch", type=int,metavar='K',help="decode the next K frames in a background thread",default=None)
+    parser_track.add_argument("--budget", type=int,help="total number of cell iterations per frame",default=None)
+    parser_track.add_argument("--cap", type=int,help="maximum number of iterations per cell when a BUDGET is given (default: niter)",default=None)
+    parser_track.add_argument("--detect", type=int,metavar='FRAME',help="detect the cells of FRAME instead of reading MARKS",default=None)
+    parser_track.add_argument("--lost", action='store_true',help="stop updating the tracks whose confidence drops (lost tracks)")
+    parser_track.add_argument("--stream", action='store_true',help="write the HDF5 file while tracking (records are not kept in memory)")
+    parser_track.add_argument("--checkpoint", type=str,metavar='FILE',help="save the tracking state in FILE every EVERY frames",default=None)
+    parser_track.add_argument("--every", type=int,help="number of frames between two checkpoints",default=100)
+    parser_track.add_argument("--resume", action='store_true',help="restart an interrupted tracking from its CHECKPOINT (same options, others are refused)")
     parser_track.set_defaults(mode='track')
 
     parser_play = subparsers.add_parser('play', help='play a tracked sequence',
@@ -134,6 +173,9 @@ if __name__ == '__main__':
         print
         set_marks(datazip_filename=args.seq,mark_filename=args.marks,frame=args.frame)
 
+    if args.mode == 'detect':
+        detect(source=args.seq,frame=args.frame,marks=args.marks,params=args.params)
+
     if args.mode == 'track':
         if args.seq is not None:
             print 'source=',args.seq
@@ -142,8 +184,13 @@ if __name__ == '__main__':
             print '--seq needed'
             parser.print_usage()
             exit(1)
+        if args.resume and args.checkpoint is None:
+            print '--checkpoint needed to resume'
+            parser.print_usage()
+            exit(1)
         print 'dir=',args.dir
-        track(source=args.seq,dir=args.dir,marks=args.marks,hdf5=args.hdf5,params=args.params)
+        track(source=args.seq,dir=args.dir,marks=args.marks,hdf5=args.hdf5,params=args.params,threads=args.threads,predictor=args.predictor,budget=args.budget,cap=args.cap,lost=args.lost,seed_frame=args.detect,processes=args.processes,prefetch=args.prefetch,stream=args.stream,
+              checkpoint=args.checkpoint,checkpoint_every=args.every,resume=args.resume)
 
     if args.mode == 'play':
         if args.seq is not None:
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+'''Motion predictors, used to seed the cell position of the next frame (see :class:`cellmodel.Track`)
+'''
+__author__ = 'Copyright (C) 2012, Olivier Debeir <odebeir@ulb.ac.be>'
+__license__ ="""
+ivctrack is a python module for in-vitro cell tracking.
+
+Copyright (C) 2012  Olivier Debeir
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as npy
+
+predictor_features = ['px','py','x','y','vx','vy']
+
+class ConstantVelocity(object):
+    """Constant velocity predictor: the next position is the last one plus the last displacement
+    (velocities are in pixels per tracked frame, whatever the tracking direction)
+    """
+    def __init__(self):
+        self.reset(0.0,0.0)
+
+    def reset(self,x,y):
+        """restart the prediction from the (x,y) position, with a null velocity
+        """
+        self.state = npy.asarray([x,y,0.0,0.0])
+        self.prediction = npy.asarray([x,y],dtype=float)
+        self.n = 0
+
+    def predict(self):
+        """returns the predicted position of the next frame
+        """
+        self.prediction = self.state[0:2]+self.state[2:4]
+        return self.prediction
+
+    def correct(self,x,y):
+        """updates the state with the (converged) position of the frame
+        """
+        if self.n:
+            self.state[2:4] = (x-self.state[0],y-self.state[1])
+        self.state[0:2] = (x,y)
+        self.n += 1
+
+    def rec(self):
+        """returns the predicted position and the state, see predictor_features
+        """
+        return npy.hstack((self.prediction,self.state))
+
+    def __repr__(self):
+        return 'ConstantVelocity()'
+
+class Kalman(ConstantVelocity):
+    """Kalman filter with a constant velocity model, the state is (x,y,vx,vy)
+
+    q is the process noise (acceleration variance, pixel^2/frame^4), r the measurement noise (pixel^2)
+    """
+    def __init__(self,q=1.0,r=1.0):
+        self.q = q
+        self.r = r
+        self.F = npy.eye(4)
+        self.F[0,2] = self.F[1,3] = 1.0
+        self.H = npy.eye(2,4)
+        #discrete white noise acceleration
+        G = npy.asarray([[.5,0.0],[0.0,.5],[1.0,0.0],[0.0,1.0]])
+        self.Q = q*npy.dot(G,G.T)
+        self.R = r*npy.eye(2)
+        self.reset(0.0,0.0)
+
+    def reset(self,x,y):
+        ConstantVelocity.reset(self,x,y)
+        #the position is known, the velocity is not
+        self.P = npy.diag([self.r,self.r,1e3,1e3])
+
+    def predict(self):
+        self.state = npy.dot(self.F,self.state)
+        self.P = npy.dot(npy.dot(self.F,self.P),self.F.T)+self.Q
+        self.prediction = self.state[0:2].copy()
+        return self.prediction
+
+    def correct(self,x,y):
+        if self.n == 0:
+            self.state[0:2] = (x,y)
+        else:
+            S = npy.dot(npy.dot(self.H,self.P),self.H.T)+self.R
+            K = npy.dot(npy.dot(self.P,self.H.T),npy.linalg.inv(S))
+            self.state = self.state+npy.dot(K,npy.asarray([x,y])-npy.dot(self.H,self.state))
+            self.P = npy.dot(npy.eye(4)-npy.dot(K,self.H),self.P)
+        self.n += 1
+
+    def __repr__(self):
+        return 'Kalman(q=%r,r=%r)'%(self.q,self.r)
+
+predictors = {'velocity':ConstantVelocity,'kalman':Kalman}
+
+def make_predictor(predictor):
+    """returns a new predictor: predictor is None, a name in predictors ('velocity' or 'kalman')
+    or a predictor instance (returned as is)
+    """
+    if predictor is None or not isinstance(predictor,basestring):
+        return predictor
+    if predictor not in predictors:
+        raise ValueError('predictor must be in %s'%sorted(predictors))
+    return predictors[predictor]()
@@ -24,6 +24,8 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
 from zipfile import ZipFile
+from threading import Condition,Lock,Thread
+from time import time
 import os.path as path
 import re
 import ImageFile
@@ -42,6 +44,7 @@ class Reader(object):
         self.source = source
         self.im_list = source.im_list
         self.head = 0
+        self.lock = Lock()
 
     def range(self):
         return range(len(self.im_list))
@@ -50,7 +53,7 @@ class Reader(object):
         return len(self.im_list)
 
     def __str__(self):
-        s = super(Reader, self).__str__()
+        s = '<%s.%s>'%(self.__module__,self.__class__.__name__)
         s = s + str(self.source)+' head:' + str(self.head)
         return s
 
@@ -94,6 +97,18 @@ class Reader(object):
         else:
             return self.source.read_image(self.im_list[self.head][1])
 
+    def read(self,frame):
+        """returns the frame without moving the head (and without the image cache), can be called
+        from several threads: the compressed data are read one at a time, the decoding is concurrent
+        """
+        if (frame < 0) or (frame >= len(self.im_list)):
+            raise IndexError
+        image_name = self.im_list[frame][1]
+        if hasattr(self.source,'read_imagedata'):
+            return self.source.parse_imagedata(self.source.read_imagedata(image_name))
+        with self.lock:
+            return self.source.read_image(image_name)
+
     def getframe(self):
         """Returns the frame under the head
         """
@@ -109,6 +124,7 @@ class ZipSource(object):
         self.description = filename
         self.zipfilename = filename
         self.zf = ZipFile(self.zipfilename, 'r')
+        self.lock = Lock()
         self.build_image_list()
 
     def build_image_list(self):
@@ -142,7 +158,8 @@ class ZipSource(object):
         self.im_list = im_list
 
     def __str__(self):
-        s = super(ZipSource, self).__str__()
+        #no object address: the HDF5 summary is the same for every run
+        s = '<%s.%s>'%(self.__module__,self.__class__.__name__)
         s = s + self.zipfilename+' first:%d'%self.first+' last:%d'%self.last+' #:%d'%len(self.im_list)
         return s
 
@@ -173,10 +190,11 @@ class ZipSource(object):
         return self.parse_imagedata(image_data)
 
     def read_imagedata(self,image_name):
-        """returns compressed image data
+        """returns compressed image data (thread safe)
         """
-        fid = self.zf.open(image_name)
-        return fid.read()
+        with self.lock:
+            fid = self.zf.open(image_name)
+            return fid.read()
 
     def generator(self,read_dir='fwd',first_frame = 0,last_frame = -1):
         """generate a list of numpy arrays from the zipfile
@@ -223,7 +241,7 @@ class DumbSource(object):
         self.last = self.n
 
     def __str__(self):
-        s = super(DumbSource, self).__str__()
+        s = '<%s.%s>'%(self.__module__,self.__class__.__name__)
         s = s + self.zipfilename+' first:%d'%self.first+' last:%d'%self.last+' #:%d'%len(self.im_list)
         return s
 
@@ -234,6 +252,86 @@ class DumbSource(object):
 
         return npy.zeros((1,1))
 
+class Prefetcher(object):
+    """Decodes the frames ahead of their consumer (e.g. the tracker): workers background threads call read(frame)
+    on the next frames of the list, in order, while the consumer processes the current one. At most depth frames
+    are decoded ahead (ring buffer).
+
+    metrics: decoded (frames decoded), depths (number of frames ready each time the consumer asked for one, the
+    queue depth) and stall_time (time the consumer waited for a frame)
+    """
+    def __init__(self,read,frames,depth=4,workers=1):
+        self.read = read
+        self.frames = list(frames)
+        self.position = dict((frame,i) for i,frame in enumerate(self.frames))
+        self.depth = max(depth,1)
+        self.ready = {}
+        self.next = 0
+        self.consumed = 0
+        self.closed = False
+        self.decoded = 0
+        self.depths = []
+        self.stall_time = 0.0
+        self.cond = Condition()
+        self.threads = [Thread(target=self.produce) for i in range(max(workers,1))]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def produce(self):
+        while True:
+            with self.cond:
+                while not self.closed and self.next < len(self.frames) and self.next >= self.consumed+self.depth:
+                    self.cond.wait()
+                if self.closed or self.next >= len(self.frames):
+                    return
+                i = self.next
+                self.next += 1
+            try:
+                result = self.read(self.frames[i])
+            except Exception as e:
+                result = e
+            with self.cond:
+                if i >= self.consumed:
+                    self.ready[i] = result
+                self.decoded += 1
+                self.cond.notify_all()
+
+    def get(self,frame):
+        """returns the decoded frame, the frames listed before it are dropped, errors raised by read are raised here
+        """
+        i = self.position[frame]
+        with self.cond:
+            if i < self.consumed:
+                raise ValueError('frame %s already consumed'%frame)
+            #the frames before are no longer needed
+            for k in [k for k in self.ready if k < i]:
+                del self.ready[k]
+            self.consumed = i
+            self.next = max(self.next,i)
+            self.cond.notify_all()
+            self.depths.append(len([k for k in self.ready if k >= i]))
+            t0 = time()
+            while i not in self.ready:
+                self.cond.wait()
+            self.stall_time += time()-t0
+            result = self.ready.pop(i)
+            self.consumed = i+1
+            self.cond.notify_all()
+        if isinstance(result,Exception):
+            raise result
+        return result
+
+    def close(self):
+        """stops the decoding, waits for the worker threads
+        """
+        with self.cond:
+            self.closed = True
+            self.ready.clear()
+            self.cond.notify_all()
+        for t in self.threads:
+            t.join()
+
 @timeit
 def main():
     """open data sample
@@ -1,13 +1,23 @@
 import os
+import sys
 
 
 def configuration(parent_package='', top_path=None):
-    from numpy.distutils.misc_util import Configuration
+    from numpy.distutils.misc_util import Configuration, get_numpy_include_dirs
 
     config = Configuration('ivctrack', parent_package, top_path)
 
     #config.add_subpackage('data')
 
+    # meanshift kernel, compiled ahead of time
+    config.add_extension('_meanshift',
+                         sources=[os.path.join('c-code','_meanshift.c'),
+                                  os.path.join('c-code','meanshift.c')],
+                         depends=[os.path.join('c-code','meanshift.h'),
+                                  os.path.join('c-code','meanshift_kernel.h')],
+                         include_dirs=get_numpy_include_dirs()+['c-code'],
+                         libraries=[] if sys.platform == 'win32' else ['pthread'])
+
     def add_test_directories(arg, dirname, fnames):
         if dirname.split(os.path.sep)[-1] == 'tests':
             config.add_data_dir(dirname)
@@ -7,10 +7,29 @@ __author__ = 'Copyright (C) 2012, Olivier Debeir <odebeir@ulb.ac.be>'
 
 from ivctrack.reader import ZipSource
 from ivctrack.helpers import timeit
-from ivctrack.cellmodel import Cell
+from ivctrack.cellmodel import Cell,AdaptiveCell,CellPopulation,update_cells,schedule_cells,model_spec,Track
+from ivctrack.meanshift import LUT,generate_triangles,generate_inverted_triangles,meanshift,integral_meanshift,set_backend,get_backend
 
 from time import sleep
 
+def ring_frames(size,centers,n_frames=1,shift=(1,0),seed=0):
+    """returns n_frames uint8 frames of the (m,n) size: a random background (60 to 120) with a dark soma
+    (radius 10) in a bright ring (radius 16) around each (x,y) center, frame i is rolled by i*shift (dx,dy)
+    """
+    import numpy as npy
+
+    m,n = size
+    bg = (npy.random.RandomState(seed).rand(m,n)*60+60).astype('uint8')
+    for x,y in centers:
+        i0,i1 = max(int(y)-16,0),min(int(y)+17,m)
+        j0,j1 = max(int(x)-16,0),min(int(x)+17,n)
+        yy,xx = npy.mgrid[i0:i1,j0:j1]
+        d = npy.sqrt((xx-x)**2+(yy-y)**2)
+        patch = bg[i0:i1,j0:j1]
+        patch[(d>10)&(d<16)] = 230
+        patch[d<=10] = 20
+    return [npy.roll(npy.roll(bg,shift[0]*i,axis=1),shift[1]*i,axis=0) for i in range(n_frames)]
+
 def benchmark_access():
     """Test function: evaluate the computation time for image access
     """
@@ -48,7 +67,390 @@ def benchmark_process():
         print '#frames:',i,' #cells:',len(cell_list)
     process()
 
+def benchmark_meanshift(n_cells=100,N=16,radius=30,n_repeat=10):
+    """Test function: compare the per-triangle kernel calls with the batched kernel call
+    (all the triangles of all the cells processed at once)
+    """
+    import numpy as npy
+
+    im = (npy.random.rand(512,640)*255).astype('uint8')
+    lut = LUT('white',10)
+    xy = npy.random.rand(n_cells,2)*(400,500)+(radius+1)
+    triangles = npy.vstack([generate_triangles(x,y,N,radius) for x,y in xy])
+
+    @timeit
+    def per_triangle():
+        for r in range(n_repeat):
+            for i in range(triangles.shape[0]):
+                meanshift(im,triangles[i:i+1,:],0.0,0.0,lut=lut)
+
+    @timeit
+    def batched():
+        for r in range(n_repeat):
+            meanshift(im,triangles,0.0,0.0,lut=lut)
+
+    per_triangle()
+    batched()
+    print '#cells:',n_cells,' #triangles:',triangles.shape[0],' #repeat:',n_repeat
+
+def benchmark_backends(n_cells=100,N=16,radius_list=[20,40,60],backend_list=['c','numpy']):
+    """Test function: compare the meanshift backends and the integral engine (crisp weights, see
+    integral_meanshift) for increasing halo radii
+    """
+    import numpy as npy
+    from time import time
+
+    im = (npy.random.rand(1024,1024)*255).astype('uint8')
+    lut = LUT('white',10)
+    current = get_backend()
+    for radius in radius_list:
+        xy = npy.random.rand(n_cells,2)*(1024-2*radius-2)+(radius+1)
+        triangles = npy.vstack([generate_triangles(x,y,N,radius) for x,y in xy])
+        for backend in backend_list:
+            set_backend(backend)
+            meanshift(im,triangles[:1],0.0,0.0,lut=lut) # per-frame setup (e.g. moment store)
+            ts = time()
+            meanshift(im,triangles,0.0,0.0,lut=lut)
+            print 'radius:%d backend:%s %2.4f sec'%(radius,backend,time()-ts)
+        integral_meanshift(im,triangles[:1],0.0,0.0,lut=lut) # per-frame moment store
+        ts = time()
+        integral_meanshift(im,triangles,0.0,0.0,lut=lut)
+        print 'radius:%d engine:integral %2.4f sec'%(radius,time()-ts)
+    set_backend(current)
+
+def benchmark_scanline(n_cells=100,n_repeat=10,combo_list=[(12,20,15),(16,30,15),(32,30,10)]):
+    """Test function: compare the bounding box, scanline and float32 C kernels for the (N,radius_halo,radius_soma)
+    combinations used by the tracking (test_experiment, Cell defaults and test sequences)
+    """
+    import numpy as npy
+    from time import time
+
+    im = (npy.random.rand(512,640)*255).astype('uint8')
+    lut = LUT('white',10)
+    current = get_backend()
+    for N,radius_halo,radius_soma in combo_list:
+        xy = npy.random.rand(n_cells,2)*(400,500)+(radius_halo+1)
+        triangles = npy.vstack([generate_triangles(x,y,N,radius_halo) for x,y in xy]+
+                               [generate_inverted_triangles(x,y,N/2,radius_soma) for x,y in xy])
+        for backend in ['c','scanline','float32']:
+            set_backend(backend)
+            ts = time()
+            for r in range(n_repeat):
+                meanshift(im,triangles,0.0,0.0,lut=lut)
+            print 'N:%d radius_halo:%d radius_soma:%d backend:%s %2.4f sec'%(N,radius_halo,radius_soma,backend,time()-ts)
+    set_backend(current)
+
+def benchmark_float32(n_cells=100,n_repeat=10,N=16,radius_list=[30,60]):
+    """Test function: float32 accumulation against the float64 'c' and scanline kernels with exp 15 weights, for the
+    three image types (time ratios to c printed)
+
+    measured on 512x640 images, 100 cells, N=16 (gcc 12, -O2): scanline 0.5-0.8, float32 0.55-0.9 of the c time,
+    the float32 accumulation is not faster than the float64 scanline kernel (the weight lookup dominates)
+    """
+    import numpy as npy
+    from time import time
+    from ivctrack.meanshift import PowerLaw
+
+    im = (npy.random.rand(512,640)*255).astype('uint8')
+    images = [('uint8',im,LUT('white',15)),
+              ('uint16',im.astype('uint16')*257,LUT('white',15,'uint16')),
+              ('float32',im.astype('float32')/255,PowerLaw('white',15))]
+    current = get_backend()
+    for radius in radius_list:
+        xy = npy.random.rand(n_cells,2)*(400,500)+(radius+1)
+        triangles = npy.vstack([generate_triangles(x,y,N,radius) for x,y in xy])
+        for name,ima,lut in images:
+            elapsed = {}
+            for backend in ['c','scanline','float32']:
+                set_backend(backend)
+                meanshift(ima,triangles[:1],0.0,0.0,lut=lut) # normalized weights
+                ts = time()
+                for r in range(n_repeat):
+                    meanshift(ima,triangles,0.0,0.0,lut=lut)
+                elapsed[backend] = time()-ts
+            print 'radius:%d image:%s c:%2.4f sec scanline:%.2f float32:%.2f (time ratios to c)'%(radius,name,elapsed['c'],
+                elapsed['scanline']/elapsed['c'],elapsed['float32']/elapsed['c'])
+    set_backend(current)
+
+def benchmark_population(n_cells=2000,n_frames=3):
+    """Test function: compare per-cell AdaptiveCell updates, frame-level updates (update_cells)
+    and the vectorized CellPopulation update
+    """
+    import numpy as npy
+
+    im = (npy.random.rand(1024,1024)*255).astype('uint8')
+    params = {'N':12,'radius_halo':20,'radius_soma':15,'exp_halo':15,'exp_soma':2,'niter':5,'alpha':.75}
+    xy = npy.random.rand(n_cells,2)*(1024-62)+31
+
+    @timeit
+    def per_cell():
+        cells = [AdaptiveCell(x,y,**params) for x,y in xy]
+        for f in range(n_frames):
+            for c in cells:
+                c.update(im)
+
+    @timeit
+    def frame_level():
+        cells = [AdaptiveCell(x,y,**params) for x,y in xy]
+        for f in range(n_frames):
+            update_cells(cells,im,nthreads=1)
+
+    @timeit
+    def population():
+        pop = CellPopulation(xy,**params)
+        for f in range(n_frames):
+            pop.update(im)
+
+    per_cell()
+    frame_level()
+    population()
+    print '#cells:',n_cells,' #frames:',n_frames
+
+def resident_memory():
+    """returns the resident memory of the process in bytes (Linux), or the peak resident memory
+    """
+    import os
+    try:
+        return int(open('/proc/self/statm').read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (IOError,ValueError,OSError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+def benchmark_memory(n_list=[10000,100000]):
+    """Test function: memory used by AdaptiveCell objects (model parameters, weights and unit triangles
+    are shared through the ModelSpec) and by a CellPopulation
+    """
+    import numpy as npy
+
+    params = {'N':12,'radius_halo':20,'radius_soma':15,'exp_halo':15,'exp_soma':2,'niter':5,'alpha':.75}
+    for n in n_list:
+        xy = npy.random.rand(n,2)*1000
+        m0 = resident_memory()
+        cells = [AdaptiveCell(x,y,**params) for x,y in xy]
+        m1 = resident_memory()
+        specs = len(set(id(c.spec) for c in cells))
+        del cells
+        pop = CellPopulation(xy,**params)
+        #zeroed arrays are not resident until written: count the array sizes
+        size = sum([a.nbytes for a in vars(pop).values() if isinstance(a,npy.ndarray)])
+        del pop
+        print '#cells:%d AdaptiveCell: %2.1f MB (%d bytes/cell, %d spec) CellPopulation: %2.1f MB (%d bytes/cell)'%(
+            n,(m1-m0)/2.**20,(m1-m0)/n,specs,size/2.**20,size/n)
+
+def benchmark_predictors(n_frames=20,velocity=(3,1)):
+    """Test function: iterations to converge (tol=0.05) with and without motion prediction,
+    for bright rings moving at a constant velocity on a noisy background
+    """
+    import numpy as npy
+
+    locations = npy.random.RandomState(0).rand(20,2)*(440,320)+(100,100)
+    frames = ring_frames((512,640),locations,n_frames,velocity)
+    params = {'N':12,'radius_halo':20,'radius_soma':15,'exp_halo':15,'exp_soma':2,'niter':20,'alpha':.75,'tol':0.05}
+    for predictor in [None,'velocity','kalman']:
+        tracks = [Track(x,y,0,AdaptiveCell,params,predictor=predictor) for x,y in locations]
+        for frame,im in enumerate(frames):
+            for t in tracks:
+                t.update(frame,im,'fwd')
+        used = [rec[3][0] for t in tracks for rec in t.records.values()]
+        counts = npy.bincount(used)
+        print 'predictor:%s mean iterations:%2.2f histogram:%s'%(predictor,npy.mean(used),
+            dict((k,n) for k,n in enumerate(counts) if n))
+
+def benchmark_pyramid(size=2048,n_cells=200,level_list=[1,2,3]):
+    """Test function: time spent per pyramid level (full resolution is level 0) for cells
+    started a few pixels away from bright rings
+    """
+    import numpy as npy
+    from time import time
+
+    locations = npy.random.RandomState(0).rand(n_cells,2)*(size-100)+50
+    im = ring_frames((size,size),locations)[0]
+    params = {'N':12,'radius_halo':20,'radius_soma':15,'exp_halo':15,'exp_soma':2,'niter':10,'alpha':.75,'tol':0.05}
+    for levels in level_list:
+        cells = [AdaptiveCell(x+6,y+4,levels=levels,**params) for x,y in locations]
+        t0 = time()
+        update_cells(cells,im)
+        t1 = time()
+        err = npy.asarray([npy.sqrt(npy.sum((c.center-xy)**2)) for c,xy in zip(cells,locations)])
+        level_time = npy.sum([c.level_time for c in cells],axis=0)
+        print 'levels:%d total:%2.3fs per level:%s median error:%2.2fpx'%(levels,t1-t0,
+            ' '.join(['%2.3fs'%t for t in level_time]),npy.median(err))
+
+def benchmark_schedule(n_cells=200,n_frames=10,budget=600,cap=20):
+    """Test function: per frame latency of the frame-level update (niter=20, tol=0.05)
+    and of the scheduler with a total iteration budget
+    """
+    import numpy as npy
+    from time import time
+
+    rs = npy.random.RandomState(0)
+    locations = rs.rand(n_cells,2)*924+50
+    im = ring_frames((1024,1024),locations[:n_cells/2])[0]
+    params = {'N':12,'radius_halo':20,'radius_soma':15,'exp_halo':15,'exp_soma':2,'niter':cap,'alpha':.75,'tol':0.05}
+    for name in ['update_cells','schedule_cells']:
+        latency = []
+        for frame in range(n_frames):
+            #cells start a few pixels away, half of them on the background
+            cells = [AdaptiveCell(x,y,**params) for x,y in locations+rs.randn(n_cells,2)*3]
+            t0 = time()
+            if name == 'update_cells':
+                update_cells(cells,im)
+            else:
+                schedule_cells(cells,im,budget)
+            latency.append(time()-t0)
+        print '%s: frame latency %2.3f +/- %2.3f sec (max %2.3f)'%(name,npy.mean(latency),npy.std(latency),max(latency))
+
+def benchmark_detection(size=2048,n_cells=400,n_repeat=5):
+    """Test function: seed detection time on a large frame, and seeds found within 2 pixels of a cell
+    """
+    import numpy as npy
+    from time import time
+    from ivctrack.detection import detect_seeds
+
+    locations = npy.vstack((npy.arange(50,size-50,100).repeat(20),npy.tile(npy.arange(50,size-50,100),20))).T[:n_cells]
+    im = ring_frames((size,size),locations)[0]
+    params = {'N':12,'radius_halo':20,'radius_soma':15,'exp_halo':15,'exp_soma':2,'niter':5,'alpha':.75}
+    for dtype,frame in [('uint8',im),('uint16',im.astype('uint16')*257),('float32',im.astype('float32')/255)]:
+        t0 = time()
+        for i in range(n_repeat):
+            seeds = detect_seeds(frame,params)
+        t1 = time()
+        d = npy.sqrt(((seeds[:,npy.newaxis,:]-locations[npy.newaxis,:,:])**2).sum(axis=2)).min(axis=1)
+        print '%s %dx%d: %2.3f sec/frame, %d seeds (%d within 2 px of a cell, %d cells)'%(dtype,size,size,
+            (t1-t0)/n_repeat,len(seeds),(d<2).sum(),len(locations))
+
+def benchmark_processes(n_tracks=500,n_frames=10,process_list=[None,1,2,4,8]):
+    """Test function: wall-clock time of an Experiment with the tracks split between worker processes
+    """
+    import numpy as npy
+    from time import time
+    from multiprocessing import cpu_count
+    from ivctrack.cellmodel import Experiment
+
+    class FrameReader(object):
+        description = 'synthetic frames'
+        def __init__(self,frames):
+            self.frames = frames
+            self.source = self
+        def N(self):
+            return len(self.frames)
+        def moveto(self,frame):
+            return self.frames[frame]
+
+    locations = npy.random.RandomState(0).rand(n_tracks,2)*924+50
+    frames = ring_frames((1024,1024),locations,n_frames)
+    params = {'N':12,'radius_halo':20,'radius_soma':15,'exp_halo':15,'exp_soma':2,'niter':5,'alpha':.75}
+    print 'cpu count:',cpu_count()
+    for processes in process_list:
+        experiment = Experiment(FrameReader(frames),processes=processes)
+        for x,y in locations:
+            experiment.add_track(Track(x,y,0,AdaptiveCell,params))
+        t0 = time()
+        experiment.do_tracking('fwd')
+        print 'processes:%s %d tracks x %d frames: %2.3f sec'%(processes,n_tracks,n_frames,time()-t0)
+
+def benchmark_prefetch(n_tracks=100,n_frames=20,prefetch_list=[None,1,4],decoders=2):
+    """Test function: tracking time of a zipped (PNG) sequence with and without frame prefetching,
+    with the prefetch queue depth and the time the tracker waited for frames
+    """
+    import os
+    import shutil
+    import tempfile
+    import zipfile
+    import numpy as npy
+    from time import time
+    from PIL import Image
+    from ivctrack.reader import Reader
+    from ivctrack.cellmodel import Experiment
+
+    locations = npy.random.RandomState(0).rand(n_tracks,2)*924+50
+    frames = ring_frames((1024,1024),locations,n_frames)
+    temp = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(temp,'seq.zip')
+        zf = zipfile.ZipFile(filename,'w')
+        for i in range(n_frames):
+            png = os.path.join(temp,'exp%04d.png'%i)
+            Image.fromarray(frames[i]).save(png)
+            zf.write(png,'exp%04d.png'%i)
+        zf.close()
+        params = {'N':12,'radius_halo':20,'radius_soma':15,'exp_halo':15,'exp_soma':2,'niter':5,'alpha':.75}
+        for prefetch in prefetch_list:
+            experiment = Experiment(Reader(ZipSource(filename)),prefetch=prefetch,decoders=decoders)
+            for x,y in locations:
+                experiment.add_track(Track(x,y,0,AdaptiveCell,params))
+            t0 = time()
+            experiment.do_tracking('fwd')
+            print 'prefetch:%s %d tracks x %d frames: %2.3f sec (queue depth %2.2f, stall %2.3f sec)'%(prefetch,n_tracks,
+                n_frames,time()-t0,npy.mean(experiment.queue_depths or [0]),experiment.stall_time)
+    finally:
+        shutil.rmtree(temp)
+
+def benchmark_stream(n_tracks=200,frame_list=[50,200]):
+    """Test function: memory growth of a tracking run keeping the records in memory, and streaming them to
+    a HDF5 file (see Experiment.stream_hdf5)
+    """
+    import os
+    import shutil
+    import tempfile
+    import numpy as npy
+    from time import time
+    from ivctrack.cellmodel import Experiment
+
+    class RollReader(object):
+        """frames rolled from a background, decoded on demand"""
+        description = 'synthetic frames'
+        def __init__(self,bg,n_frames):
+            self.bg = bg
+            self.n_frames = n_frames
+            self.source = self
+        def N(self):
+            return self.n_frames
+        def moveto(self,frame):
+            return npy.roll(self.bg,frame%8-4,axis=1)
+
+    rs = npy.random.RandomState(0)
+    bg = (rs.rand(1024,1024)*60+60).astype('uint8')
+    locations = rs.rand(n_tracks,2)*924+50
+    params = {'N':12,'radius_halo':20,'radius_soma':15,'exp_halo':15,'exp_soma':2,'niter':5,'alpha':.75}
+    temp = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(temp,'tracks.hdf5')
+        for n_frames in frame_list:
+            for stream in [False,True]:
+                experiment = Experiment(RollReader(bg,n_frames))
+                for x,y in locations:
+                    experiment.add_track(Track(x,y,0,AdaptiveCell,params))
+                m0 = resident_memory()
+                t0 = time()
+                if stream:
+                    experiment.stream_hdf5(filename)
+                experiment.do_tracking('fwd')
+                m1 = resident_memory()
+                if stream:
+                    experiment.close_stream()
+                else:
+                    experiment.save_hdf5(filename)
+                print 'stream:%s %d tracks x %d frames: %2.3f sec, memory growth %2.1f MB'%(stream,n_tracks,n_frames,
+                    time()-t0,(m1-m0)/2.**20)
+                del experiment
+    finally:
+        shutil.rmtree(temp)
+
 if __name__ == "__main__":
 
     benchmark_access()
     benchmark_process()
+    benchmark_meanshift()
+    benchmark_backends()
+    benchmark_scanline()
+    benchmark_float32()
+    benchmark_population()
+    benchmark_memory()
+    benchmark_predictors()
+    benchmark_pyramid()
+    benchmark_schedule()
+    benchmark_detection()
+    benchmark_processes()
+    benchmark_prefetch()
+    benchmark_stream()
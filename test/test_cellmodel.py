@@ -0,0 +1,542 @@
+# -*- coding: utf-8 -*-
+'''
+Cell models test cases
+'''
+__author__ = 'Copyright (C) 2012, Olivier Debeir <odebeir@ulb.ac.be>'
+
+import ctypes
+import gc
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as npy
+
+from ivctrack import meanshift as ms
+from ivctrack.cellmodel import Cell,AdaptiveCell,CellPopulation,ModelSpec,model_spec,update_cells,schedule_cells,Track,Experiment
+from ivctrack.confidence import LossPolicy
+from test_meanshift import synthetic_image
+
+datazip = os.path.join(os.path.dirname(os.path.abspath(__file__)),'data','seq0_extract.zip')
+
+params = {'N':12,'radius_halo':20,'radius_soma':15,'exp_halo':15,'exp_soma':2,'niter':5,'alpha':.75}
+locations = [(75,65),(195,115),(262,188),(150,150),(40,200)]
+
+def heap_in_use():
+    """returns the bytes allocated by malloc (glibc), None when mallinfo is not available
+    """
+    try:
+        libc = ctypes.CDLL('libc.so.6')
+        libc.mallinfo
+    except (OSError,AttributeError):
+        return None
+    class MallInfo(ctypes.Structure):
+        _fields_ = [(name,ctypes.c_int) for name in ['arena','ordblks','smblks','hblks','hblkhd',
+                                                      'usmblks','fsmblks','uordblks','fordblks','keepcost']]
+    libc.mallinfo.restype = MallInfo
+    info = libc.mallinfo()
+    return info.uordblks+info.hblkhd
+
+class ArrayReader(object):
+    """in-memory frame sequence, with the reader interface used by Experiment
+    """
+    description = 'synthetic frames'
+
+    def __init__(self,frames):
+        self.frames = frames
+        self.source = self
+
+    def N(self):
+        return len(self.frames)
+
+    def moveto(self,frame):
+        return self.frames[frame]
+
+
+class CellModelTestSuite(unittest.TestCase):
+    """Cell models test cases."""
+
+    def setUp(self):
+        self.im = synthetic_image()
+
+    def assertSameCells(self,cells,ref):
+        for c,r in zip(cells,ref):
+            npy.testing.assert_array_equal(c.center,r.center)
+            npy.testing.assert_array_equal(c.path,r.path)
+            npy.testing.assert_array_equal(c.shift_halo,r.shift_halo)
+            npy.testing.assert_array_equal(c.shift_soma,r.shift_soma)
+
+    def test_update_cells(self):
+        """the frame-level (multi-threaded) update gives the same results as the serial one
+        """
+        for model in [Cell,AdaptiveCell]:
+            ref = [model(x,y,**params) for x,y in locations]
+            for c in ref:
+                c.update(self.im)
+            for nthreads in [1,4]:
+                cells = [model(x,y,**params) for x,y in locations]
+                update_cells(cells,self.im,nthreads=nthreads)
+                self.assertSameCells(cells,ref)
+
+    def test_tol(self):
+        """converged cells stop early, serial and frame-level updates still agree
+        """
+        p = dict(params,niter=20,tol=0.01)
+        for model in [Cell,AdaptiveCell]:
+            ref = [model(x,y,**p) for x,y in locations]
+            full = [model(x,y,**dict(p,tol=0.0)) for x,y in locations]
+            for c,f in zip(ref,full):
+                c.update(self.im)
+                f.update(self.im)
+                self.assertEqual(f.iterations,20)
+                self.assertEqual(c.path.shape,(c.iterations,2))
+            #the first cells are on rings (the others drift on the background)
+            for c,f in zip(ref[:3],full[:3]):
+                self.assertTrue(c.iterations < 20 and c.displacement < 0.01)
+                npy.testing.assert_allclose(c.center,f.center,atol=0.1)
+            cells = [model(x,y,**p) for x,y in locations]
+            update_cells(cells,self.im,nthreads=2)
+            self.assertSameCells(cells,ref)
+            self.assertEqual([c.iterations for c in cells],[c.iterations for c in ref])
+            self.assertEqual(cells[0].rec()[3][0],ref[0].iterations)
+
+    def test_schedule(self):
+        """an unlimited budget gives the frame-level update, otherwise the budget and the cap are never exceeded
+        """
+        p = dict(params,niter=20,tol=0.01)
+        for model in [Cell,AdaptiveCell]:
+            ref = [model(x,y,**p) for x,y in locations]
+            update_cells(ref,self.im)
+            cells = [model(x,y,**p) for x,y in locations]
+            used = schedule_cells(cells,self.im,1000)
+            self.assertSameCells(cells,ref)
+            self.assertEqual(used,sum([c.iterations for c in ref]))
+            for budget,cap in [(12,None),(40,8),(200,30)]:
+                cells = [model(x,y,**p) for x,y in locations]
+                used = schedule_cells(cells,self.im,budget,cap=cap)
+                iterations = [c.iterations for c in cells]
+                self.assertTrue(used <= budget and sum(iterations) == used)
+                self.assertTrue(max(iterations) <= (cap or 20))
+                self.assertEqual([c.path.shape for c in cells],[(n,2) for n in iterations])
+            #the drifting background cells use the iterations left by the converged ones
+            self.assertEqual(iterations[3:],[30,30])
+
+    def test_population(self):
+        """a CellPopulation gives the same records as the AdaptiveCell objects
+        """
+        frames = [npy.roll(npy.roll(self.im,2*i,axis=1),i,axis=0) for i in range(3)]
+        for p in [params,dict(params,niter=20,tol=0.01)]:
+            ref = [AdaptiveCell(x,y,**p) for x,y in locations]
+            pop = CellPopulation(locations,**p)
+            for k,im in enumerate(frames):
+                #a subset of the cells is tracked on the first frame
+                index = [0,2,3] if k == 0 else None
+                for i,c in enumerate(ref):
+                    if index is None or i in index:
+                        c.update(im)
+                pop.update(im,index=index,nthreads=2)
+                for i,c in enumerate(ref):
+                    if index is None or i in index:
+                        for a,b in zip(pop.rec(i),c.rec()):
+                            npy.testing.assert_array_equal(a,b)
+                        npy.testing.assert_array_equal(pop.path[i,:c.iterations],c.path)
+
+    def test_model_spec(self):
+        """cells built with the same parameters share one read-only spec
+        """
+        cells = [AdaptiveCell(x,y,**params) for x,y in locations]+[Cell(x,y,**params) for x,y in locations]
+        self.assertTrue(all([c.spec is cells[0].spec for c in cells]))
+        self.assertTrue(CellPopulation(locations,**params).spec is cells[0].spec)
+        spec = cells[0].spec
+        self.assertEqual(spec,ModelSpec(**params))
+        self.assertEqual(hash(spec),hash(ModelSpec(**params)))
+        self.assertNotEqual(spec,model_spec(**dict(params,niter=6)))
+        self.assertTrue(model_spec(**spec.params()) is spec)
+        self.assertEqual((cells[0].niter,cells[0].def_tri_soma.shape),(params['niter'],(params['N']/2,6)))
+        self.assertRaises(AttributeError,setattr,spec,'niter',3)
+        self.assertRaises(ValueError,spec.def_tri_halo.__setitem__,0,1.0)
+        #the spec LUTs are read-only views of the shared weight tables, which stay writeable
+        table = ms.weight_table('white',params['exp_halo'],npy.uint8,None)
+        self.assertTrue(spec.LutW.base is table and table.flags.writeable)
+        self.assertRaises(ValueError,spec.LutW.__setitem__,0,1.0)
+
+    @unittest.skipIf(heap_in_use() is None,'glibc mallinfo not available')
+    def test_steady_state_memory(self):
+        """steady-state updates reuse the per-cell buffers (same arrays, same data) and the meanshift out buffer,
+        the heap in use does not grow over 1000 updates (short-lived views and floats are still created)
+        """
+        frames = [npy.roll(self.im,i,axis=1) for i in range(6)]
+        buffers = ['shift_halo','shift_soma','_path','_radii','_dist','prev_radii','tri_halo','tri_soma','center']
+        for model in [Cell,AdaptiveCell]:
+            cells = [model(x,y,**params) for x,y in locations]
+            for im in frames:
+                for c in cells:
+                    c.update(im)
+            before = [[(b,c.__dict__[b],c.__dict__[b].ctypes.data) for b in buffers if b in c.__dict__] for c in cells]
+            gc.collect()
+            heap = heap_in_use()
+            for i in range(1000/len(cells)):
+                for c in cells:
+                    c.update(frames[i%len(frames)])
+            #a leaked (N,8) array per update would add about 1MB
+            gc.collect()
+            self.assertTrue(heap_in_use()-heap < 256*1024,model)
+            for c,ref in zip(cells,before):
+                for b,a,data in ref:
+                    self.assertTrue(getattr(c,b) is a and a.ctypes.data == data,b)
+                self.assertTrue(c.path.base is c._path)
+        out = npy.zeros((params['N'],8))
+        tri = cells[0].tri_halo
+        self.assertTrue(ms.meanshift(self.im,tri,0.0,0.0,lut=ms.LUT('white',10),out=out) is out)
+
+    def test_predictor(self):
+        """motion prediction saves iterations on moving cells, predictor state is recorded
+        """
+        frames = [npy.roll(npy.roll(self.im,4*i,axis=1),2*i,axis=0) for i in range(8)]
+        p = dict(params,niter=20,tol=0.05)
+        mean_iterations = {}
+        for predictor in [None,'velocity','kalman']:
+            tracks = [Track(x,y,0,AdaptiveCell,p,predictor=predictor) for x,y in locations[:3]]
+            for frame,im in enumerate(frames):
+                for t in tracks:
+                    t.update(frame,im,'fwd')
+            for t,(x,y) in zip(tracks,locations[:3]):
+                self.assertEqual(len(t.rec_structure()),len(t.records[0]))
+                #cells follow the rings
+                npy.testing.assert_allclose(t.records[7][0],t.records[0][0]+(28,14),atol=0.5)
+            mean_iterations[predictor] = npy.mean([t.records[k][3][0] for t in tracks for k in range(2,8)])
+            if predictor is not None:
+                #predictions are close to the motion once the velocity is known
+                npy.testing.assert_allclose(tracks[0].records[7][4][0:2],tracks[0].records[6][0]+(4,2),atol=0.5)
+        self.assertTrue(mean_iterations['velocity'] < mean_iterations[None])
+        self.assertTrue(mean_iterations['kalman'] < mean_iterations[None])
+
+    def test_pyramid(self):
+        """coarse to fine updates converge faster from a distant start, frame-level updates agree
+        """
+        for model in [Cell,AdaptiveCell]:
+            error = {}
+            for levels in [1,3]:
+                c = model(90,75,levels=levels,**params)
+                c.update(self.im)
+                error[levels] = npy.sqrt(npy.sum((c.center-(80,70))**2))
+                self.assertEqual(len(c.level_time),levels)
+            self.assertTrue(error[3] < 0.05 < error[1])
+            ref = [model(x+5,y+5,levels=2,**params) for x,y in locations]
+            for c in ref:
+                c.update(self.im)
+            cells = [model(x+5,y+5,levels=2,**params) for x,y in locations]
+            update_cells(cells,self.im,nthreads=2)
+            self.assertSameCells(cells,ref)
+
+    def test_lost(self):
+        """a track whose ring vanishes is lost after patience frames and is no longer updated
+        """
+        import h5py
+        gone = self.im.copy()
+        gone[50:90,60:100] = self.im[150:190,100:140]
+        frames = [self.im]*3+[gone]*7
+        policy = LossPolicy(patience=3)
+        self.assertEqual(policy.check([.8,.8,.4,.6],.6,0),('border',0))
+        self.assertEqual(policy.check([.4,.6,1.0,.05],.6,2),('low confidence',3))
+        self.assertEqual(policy.check([.8,.8,1.0,.55],.6,2),(None,0))
+        temp = tempfile.mkdtemp()
+        try:
+            for nthreads in [None,2]:
+                experiment = Experiment(ArrayReader(frames),nthreads=nthreads)
+                for x,y in locations[:3]:
+                    experiment.add_track(Track(x,y,0,AdaptiveCell,params,policy=policy))
+                experiment.do_tracking('fwd')
+                t = experiment.track_list[0]
+                self.assertEqual(t.lost,{'fwd':(5,'low confidence')})
+                self.assertEqual((sorted(t.records),t.frame_range,t.saved),(range(6),[0,5],4*2*params['niter']))
+                self.assertTrue(t.records[2][-1][3] > .5 > t.records[5][-1][3])
+                self.assertEqual([len(t.lost) for t in experiment.track_list[1:]],[0,0])
+                filename = os.path.join(temp,'lost.hdf5')
+                experiment.save_hdf5(filename)
+                fid = h5py.File(filename,'r')
+                npy.testing.assert_array_equal(fid['summary/lost'][:],[[5,-1,40],[-1,-1,0],[-1,-1,0]])
+                self.assertEqual(list(fid['tracks/track0000'].attrs['lost_reason']),['low confidence',''])
+                self.assertEqual(fid['tracks/track0000/confidence'].shape,(6,4))
+                fid.close()
+            #without policy the records and the saved tracks keep the cell model layout
+            t = Track(locations[0][0],locations[0][1],0,AdaptiveCell,params)
+            t.update(0,self.im,'fwd')
+            self.assertEqual(len(t.records[0]),len(t.cell.rec()))
+            self.assertEqual([s['dataset_name'] for s in t.rec_structure()],[s['dataset_name'] for s in t.cell.rec_structure()])
+        finally:
+            shutil.rmtree(temp)
+
+    def test_processes(self):
+        """tracks split between worker processes give the records of the serial tracking
+        """
+        frames = [npy.roll(npy.roll(self.im,2*i,axis=1),i,axis=0) for i in range(6)]
+        frames[4] = frames[4].copy()
+        frames[4][50:95,60:105] = self.im[150:195,100:145]
+        p = dict(params,niter=20,tol=0.05)
+        experiments = []
+        for processes in [None,2,4]:
+            experiment = Experiment(ArrayReader(frames),processes=processes)
+            for x,y in locations:
+                experiment.add_track(Track(x,y,0,AdaptiveCell,p,predictor='velocity',policy=LossPolicy(patience=1)))
+            experiment.do_tracking('fwd')
+            experiments.append(experiment)
+        ref = experiments[0]
+        self.assertEqual(ref.track_list[0].lost,{'fwd':(4,'low confidence')})
+        for experiment in experiments[1:]:
+            self.assertEqual([(t.lost,t.saved) for t in experiment.track_list],[(t.lost,t.saved) for t in ref.track_list])
+            for t,r in zip(experiment.track_list,ref.track_list):
+                self.assertEqual(sorted(t.records),sorted(r.records))
+                for k in r.records:
+                    for a,b in zip(t.records[k],r.records[k]):
+                        npy.testing.assert_array_equal(a,b)
+                self.assertTrue(t.cell.spec is r.cell.spec)
+        #the budget is split between the workers (24 and 16 iterations): each worker schedules its own tracks
+        experiment = Experiment(ArrayReader(frames),budget=40,processes=2)
+        for x,y in locations:
+            experiment.add_track(Track(x,y,0,AdaptiveCell,p))
+        experiment.do_tracking('fwd')
+        self.assertEqual(sorted(experiment.frame_iterations),range(6))
+        self.assertTrue(max(experiment.frame_iterations.values()) <= 40)
+        for k,budget in [(0,24),(1,16)]:
+            part = Experiment(ArrayReader(frames),budget=budget)
+            for x,y in locations[k::2]:
+                part.add_track(Track(x,y,0,AdaptiveCell,p))
+            part.do_tracking('fwd')
+            for t,r in zip(experiment.track_list[k::2],part.track_list):
+                for f in r.records:
+                    npy.testing.assert_array_equal(t.records[f][0],r.records[f][0])
+        frames[3] = frames[3][:-1]
+        self.assertRaises(ValueError,experiment.do_tracking,'fwd')
+
+    def test_activation(self):
+        """tracks are only updated from their mark frame on (frames before the first mark or after the last
+        track is lost are not decoded), records are the ones of polling every track
+        """
+        frames = [npy.roll(self.im,2*i,axis=1) for i in range(10)]
+        for i in range(6,10):
+            frames[i] = frames[i].copy()
+            frames[i][40:100,50+2*i:110+2*i] = self.im[150:210,100:160]
+        marks = [((80+2*2,70),2),((200+2*4,120),4),((260+2*4,190),4)]
+        ref = [Track(x,y,frame0,AdaptiveCell,params,policy=LossPolicy(patience=1)) for (x,y),frame0 in marks]
+        for frame,im in enumerate(frames):
+            for t in ref:
+                t.update(frame,im,'fwd')
+        for processes in [None,2]:
+            experiment = Experiment(ArrayReader(frames),processes=processes)
+            for (x,y),frame0 in marks:
+                experiment.add_track(Track(x,y,frame0,AdaptiveCell,params,policy=LossPolicy(patience=1)))
+            experiment.do_tracking('fwd')
+            self.assertEqual(experiment.update_calls,sum([len(t.records) for t in ref]))
+            self.assertEqual(experiment.decoded_frames,8)
+            for t,r in zip(experiment.track_list,ref):
+                self.assertEqual((t.lost,t.saved,sorted(t.records)),(r.lost,r.saved,sorted(r.records)))
+                for k in r.records:
+                    npy.testing.assert_array_equal(t.records[k][0],r.records[k][0])
+        self.assertEqual(ref[0].lost,{'fwd':(6,'low confidence')})
+        #all the tracks lost: the last frames are not decoded (one more frame with processes, decoded ahead)
+        for processes,decoded in [(None,5),(2,6)]:
+            experiment = Experiment(ArrayReader(frames),processes=processes)
+            for (x,y),frame0 in [((84,70),2),((84,70),2),((208+2*9,120),9)]:
+                experiment.add_track(Track(x,y,frame0,AdaptiveCell,params,policy=LossPolicy(patience=1)))
+            experiment.do_tracking('fwd')
+            self.assertEqual((experiment.decoded_frames,experiment.update_calls),(decoded+1,11))
+            self.assertEqual([t.saved for t in experiment.track_list],[3*2*params['niter']]*2+[0])
+
+    def test_prefetch(self):
+        """prefetched frames give the records of the serial tracking, metrics are kept
+        """
+        frames = [npy.roll(self.im,2*i,axis=1) for i in range(10)]
+        experiments = []
+        for prefetch in [None,1,3]:
+            experiment = Experiment(ArrayReader(frames),prefetch=prefetch,decoders=2)
+            for (x,y),frame0 in zip(locations,[0,2,2,5,9]):
+                experiment.add_track(Track(x+2*frame0,y,frame0,AdaptiveCell,params))
+            for dir in ['fwd','rev']:
+                experiment.do_tracking(dir)
+            experiments.append(experiment)
+        ref = experiments[0]
+        for experiment in experiments[1:]:
+            for t,r in zip(experiment.track_list,ref.track_list):
+                self.assertEqual(sorted(t.records),sorted(r.records))
+                for k in r.records:
+                    npy.testing.assert_array_equal(t.records[k][0],r.records[k][0])
+            self.assertEqual(experiment.update_calls,ref.update_calls)
+            self.assertEqual(len(experiment.queue_depths),ref.decoded_frames)
+            self.assertTrue(max(experiment.queue_depths) <= experiment.prefetch and experiment.stall_time >= 0.0)
+
+    def test_both(self):
+        """tracking both directions in one pass gives the records of the fwd and rev runs, each frame is decoded once
+        """
+        frames = [npy.roll(npy.roll(self.im,2*i,axis=1),i,axis=0) for i in range(8)]
+        frames[1] = frames[1].copy()
+        frames[1][40:100,50:110] = self.im[150:210,100:160]
+        p = dict(params,niter=20,tol=0.05)
+        experiments = {}
+        for dir in ['fwd','rev','both']:
+            experiment = Experiment(ArrayReader(frames),nthreads=2)
+            for (x,y),frame0 in zip(locations[:3],[3,5,3]):
+                experiment.add_track(Track(x+2*frame0,y+frame0,frame0,AdaptiveCell,p,predictor='kalman',policy=LossPolicy(patience=1)))
+            experiment.do_tracking(dir)
+            experiments[dir] = experiment
+        both = experiments['both']
+        self.assertEqual([experiments[dir].decoded_frames for dir in ['fwd','rev','both']],[5,6,8])
+        for t,f,r in zip(both.track_list,experiments['fwd'].track_list,experiments['rev'].track_list):
+            self.assertEqual(t.frame_range,[r.frame_range[0],f.frame_range[1]])
+            self.assertEqual((t.lost,t.saved),(dict(f.lost,**r.lost),f.saved+r.saved))
+            self.assertEqual(sorted(t.records),sorted(set(f.records)|set(r.records)))
+            for k in t.records:
+                for a,b in zip(t.records[k],f.records.get(k,r.records.get(k))):
+                    npy.testing.assert_array_equal(a,b)
+        self.assertEqual(both.track_list[0].lost,{'rev':(1,'low confidence')})
+        self.assertEqual(both.track_list[1].frame_range,[0,7])
+        self.assertRaises(ValueError,Experiment(ArrayReader(frames),processes=2).do_tracking,'both')
+
+    def assertSameHDF5(self,filename,ref_filename):
+        """same summary and track datasets and attributes (the track date excepted)
+        """
+        import h5py
+        def attributes(node):
+            return sorted([(k,npy.asarray(v).tolist()) for k,v in node.attrs.items()])
+        fid = h5py.File(filename,'r')
+        ref = h5py.File(ref_filename,'r')
+        try:
+            self.assertEqual(sorted(fid['tracks']),sorted(ref['tracks']))
+            for name in ['summary']+['tracks/'+k for k in ref['tracks']]:
+                self.assertEqual(attributes(fid[name]),attributes(ref[name]))
+                self.assertEqual(sorted(fid[name]),sorted(ref[name]))
+                for k in ref[name]:
+                    self.assertEqual(attributes(fid[name][k]),attributes(ref[name][k]))
+                    npy.testing.assert_array_equal(fid[name][k][:],ref[name][k][:])
+        finally:
+            fid.close()
+            ref.close()
+
+    def test_stream(self):
+        """the HDF5 file written while tracking is the one saved at the end, no record is kept in memory
+        """
+        frames = [npy.roll(npy.roll(self.im,2*i,axis=1),i,axis=0) for i in range(8)]
+        frames[1] = frames[1].copy()
+        frames[1][40:100,50:110] = self.im[150:210,100:160]
+        p = dict(params,niter=20,tol=0.05)
+        reader = ArrayReader(frames)
+        temp = tempfile.mkdtemp()
+        try:
+            for passes,processes in [(['fwd','rev'],None),(['both'],None),(['rev','fwd'],2)]:
+                filenames = []
+                counts = []
+                for stream in [False,True]:
+                    experiment = Experiment(reader,processes=processes)
+                    for (x,y),frame0 in zip(locations[:3],[3,5,3]):
+                        experiment.add_track(Track(x+2*frame0,y+frame0,frame0,AdaptiveCell,p,predictor='kalman',policy=LossPolicy(patience=1)))
+                    filenames.append(os.path.join(temp,'%s%s.hdf5'%(passes[0],stream)))
+                    if stream:
+                        experiment.stream_hdf5(filenames[-1],chunk=2)
+                    for dir in passes:
+                        experiment.do_tracking(dir)
+                    if stream:
+                        self.assertEqual([t.records for t in experiment.track_list],[{}]*3)
+                        experiment.close_stream()
+                    else:
+                        experiment.save_hdf5(filenames[-1])
+                    counts.append(experiment.iteration_counts())
+                npy.testing.assert_array_equal(counts[1],counts[0])
+                self.assertSameHDF5(filenames[1],filenames[0])
+        finally:
+            shutil.rmtree(temp)
+
+    def test_checkpoint(self):
+        """a pass interrupted then resumed from its last checkpoint gives the HDF5 file of an uninterrupted run (the
+        export date of the 'tracks' group excepted), the checkpoint is removed once the pass is completed
+        """
+        class FailingReader(ArrayReader):
+            def moveto(self,frame):
+                if frame == self.fail:
+                    raise RuntimeError('frame %d'%frame)
+                return self.frames[frame]
+        frames = [npy.roll(npy.roll(self.im,2*i,axis=1),i,axis=0) for i in range(10)]
+        frames[8] = frames[8].copy()
+        frames[8][40:100,50:110] = self.im[150:210,100:160]
+        reader = FailingReader(frames)
+        temp = tempfile.mkdtemp()
+        try:
+            checkpoint = os.path.join(temp,'checkpoint')
+            for stream,prefetch,budget in [(True,None,None),(False,None,40),(True,2,None)]:
+                filenames = []
+                calls = []
+                streamed = []
+                for fail in [None,7]:
+                    reader.fail = fail
+                    filenames.append(os.path.join(temp,'%s%s.hdf5'%(stream,fail)))
+                    experiment = Experiment(reader,budget=budget,prefetch=prefetch,checkpoint=checkpoint,checkpoint_every=2)
+                    for (x,y),frame0 in zip(locations[:3],[0,2,2]):
+                        experiment.add_track(Track(x+2*frame0,y+frame0,frame0,AdaptiveCell,params,predictor='velocity',
+                                                   policy=LossPolicy(patience=1)))
+                    if stream:
+                        experiment.stream_hdf5(filenames[-1],chunk=4)
+                    if fail is not None:
+                        self.assertRaises(RuntimeError,experiment.do_tracking,'fwd')
+                        self.assertTrue(os.path.exists(checkpoint))
+                        if stream:
+                            experiment.stream.close()
+                        reader.fail = None
+                        #the pass is only resumed with its options
+                        for options in [dict(budget=24,cap=8),dict(prefetch=1),dict(nthreads=2)]:
+                            self.assertRaises(ValueError,Experiment(reader,**options).resume,checkpoint)
+                        experiment = Experiment(reader,budget=budget,prefetch=prefetch,checkpoint=checkpoint if stream else None)
+                        experiment.resume(checkpoint)
+                    else:
+                        experiment.do_tracking('fwd')
+                    self.assertFalse(os.path.exists(checkpoint))
+                    if stream:
+                        experiment.stream.sync(experiment.track_list)
+                        streamed.append([group['frames'][:].tolist() for name,group in sorted(experiment.stream.tracks.items())])
+                    experiment.do_tracking('rev')
+                    self.assertFalse(os.path.exists(checkpoint))
+                    if stream:
+                        experiment.close_stream()
+                    else:
+                        experiment.save_hdf5(filenames[-1])
+                    calls.append(experiment.update_calls)
+                #the counters and the streamed rows are restored
+                self.assertEqual(calls[1],calls[0])
+                if stream:
+                    self.assertEqual(streamed[1],streamed[0])
+                self.assertSameHDF5(filenames[1],filenames[0])
+            self.assertRaises(ValueError,Experiment(reader,checkpoint=checkpoint).do_tracking,'both')
+        finally:
+            shutil.rmtree(temp)
+
+    def track(self,frames,locations,backend):
+        current = ms.get_backend()
+        ms.set_backend(backend)
+        try:
+            cells = [AdaptiveCell(x,y,**params) for x,y in locations]
+            for im in frames:
+                for c in cells:
+                    c.update(im)
+        finally:
+            ms.set_backend(current)
+        return npy.asarray([c.center for c in cells])
+
+    @unittest.skipIf(ms.compute_g_list is None,'_meanshift C extension not built')
+    def test_float32_tracks(self):
+        """tracks computed with float32 accumulation stay within 0.05 pixel of the float64 ones
+        """
+        frames = [npy.roll(npy.roll(self.im,2*i,axis=1),i,axis=0) for i in range(10)]
+        ref = self.track(frames,locations,'c')
+        res = self.track(frames,locations,'float32')
+        npy.testing.assert_allclose(res,ref,rtol=0,atol=0.05)
+
+    @unittest.skipIf(ms.compute_g_list is None or not os.path.exists(datazip),'seq0_extract.zip or C extension missing')
+    def test_float32_sequence(self):
+        from ivctrack.reader import ZipSource
+        frames = [im for _,im in ZipSource(datazip).generator()]
+        cell_locations = [(221,184),(408,158),(529,367)]
+        ref = self.track(frames,cell_locations,'c')
+        res = self.track(frames,cell_locations,'float32')
+        npy.testing.assert_allclose(res,ref,rtol=0,atol=0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+'''
+Convergence map test cases
+'''
+__author__ = 'Copyright (C) 2012, Olivier Debeir <odebeir@ulb.ac.be>'
+
+import unittest
+import numpy as npy
+
+from ivctrack.cellmodel import Cell,AdaptiveCell
+from ivctrack.convergence import convergence_map,cluster_points,update_grid
+from test_meanshift import synthetic_image
+from test_cellmodel import params
+
+
+class ConvergenceTestSuite(unittest.TestCase):
+    """Convergence map test cases."""
+
+    def setUp(self):
+        self.im = synthetic_image()
+
+    def test_cluster_points(self):
+        points = npy.asarray([[0.0,0.0],[10.0,0.0],[0.5,0.0],[10.2,0.3],[0.9,0.4],[50.0,50.0]])
+        npy.testing.assert_array_equal(cluster_points(points,1.0),[0,1,0,1,0,2])
+        self.assertEqual(len(cluster_points(npy.zeros((0,2)),1.0)),0)
+
+    def test_map(self):
+        """the grid seeds match the serial updates, each ring is one basin
+        """
+        p = dict(params,niter=20,tol=0.01)
+        for model in [Cell,AdaptiveCell]:
+            grid,centers,iterations,labels = convergence_map(self.im,model,p,16)
+            self.assertEqual((grid.shape,centers.shape,iterations.shape,labels.shape),((15,20,2),(15,20,2),(15,20),(15,20)))
+            npy.testing.assert_array_equal(grid[0,0:2],[[8,8],[24,8]])
+            for i,j in [(0,0),(4,5),(7,12),(14,19)]:
+                c = model(grid[i,j,0],grid[i,j,1],**p)
+                c.update(self.im)
+                npy.testing.assert_allclose(centers[i,j],c.center,atol=1e-9)
+                self.assertEqual(iterations[i,j],c.iterations)
+            for ring in [(80,70),(200,120),(260,190)]:
+                basin = npy.sqrt(npy.sum((centers-ring)**2,axis=2)) < 0.5
+                self.assertTrue(basin.any())
+                npy.testing.assert_array_equal(basin,labels == labels[basin][0])
+
+    def test_paths(self):
+        """the grid paths are the ones of the serial updates
+        """
+        p = dict(params,niter=20,tol=0.01)
+        starts = npy.asarray([[70.0,60.0],[210.0,130.0],[150.0,150.0]])
+        for model in [Cell,AdaptiveCell]:
+            centers,iterations,paths = update_grid(self.im,model,p,starts)
+            for (x,y),path,k in zip(starts,paths,iterations):
+                c = model(x,y,**p)
+                c.update(self.im)
+                self.assertEqual((k,path.shape),(c.iterations,c.path.shape))
+                npy.testing.assert_allclose(path,c.path,atol=1e-9)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+'''
+Seed detection test cases
+'''
+__author__ = 'Copyright (C) 2012, Olivier Debeir <odebeir@ulb.ac.be>'
+
+import unittest
+import numpy as npy
+
+from ivctrack.detection import detect_seeds
+from ivctrack.cellmodel import AdaptiveCell,Experiment
+from test_meanshift import synthetic_image
+from test_cellmodel import ArrayReader,params
+
+rings = [(200,120),(260,190),(80,70)]
+
+
+class DetectionTestSuite(unittest.TestCase):
+    """Seed detection test cases."""
+
+    def setUp(self):
+        self.im = synthetic_image()
+
+    def test_rings(self):
+        """all the rings are found (whatever the dtype), and only them
+        """
+        for im in [self.im,self.im.astype('uint16')*257,self.im.astype('float32')/255]:
+            seeds = detect_seeds(im,params)
+            self.assertEqual(seeds.shape,(3,2))
+            npy.testing.assert_allclose(seeds,rings,atol=1.0)
+        npy.testing.assert_array_equal(detect_seeds(self.im,params,max_seeds=2),detect_seeds(self.im,params)[:2])
+        background = npy.random.RandomState(1).randint(60,120,self.im.shape).astype('uint8')
+        self.assertEqual(detect_seeds(background,params).shape,(0,2))
+
+    def test_add_seeds(self):
+        experiment = Experiment(ArrayReader([self.im,self.im]))
+        seeds = experiment.add_seeds(1,AdaptiveCell,params,max_seeds=2)
+        self.assertEqual([(t.x0,t.y0,t.frame0) for t in experiment.track_list],[(x,y,1) for x,y in seeds])
+        experiment.do_tracking('rev')
+        for t,(x,y) in zip(experiment.track_list,rings):
+            npy.testing.assert_allclose(t.records[0][0],(x,y),atol=0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
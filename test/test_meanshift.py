@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+'''
+Meanshift engines test cases
+'''
+__author__ = 'Copyright (C) 2012, Olivier Debeir <odebeir@ulb.ac.be>'
+
+import unittest
+import numpy as npy
+
+from ivctrack import meanshift as ms
+
+
+def synthetic_image(m=240,n=320,seed=0):
+    """random background with a few bright rings and dark blobs (phase contrast like)
+    """
+    rs = npy.random.RandomState(seed)
+    yy,xx = npy.mgrid[0:m,0:n]
+    im = rs.rand(m,n)*60+60
+    for x,y in [(80,70),(200,120),(260,190)]:
+        d = npy.sqrt((xx-x)**2+(yy-y)**2)
+        im[(d>10)&(d<16)] = 230
+        im[d<=10] = 20
+    return im.astype('uint8')
+
+def cell_triangles(seed=0):
+    """halo and soma triangle tables of a few cells (interior of the synthetic image)
+    """
+    rs = npy.random.RandomState(seed)
+    halo = []
+    soma = []
+    for x,y in rs.rand(6,2)*(200,120)+(60,60):
+        halo.append(ms.generate_triangles(x,y,16,30))
+        soma.append(ms.generate_inverted_triangles(x,y,8,12))
+    return npy.vstack(halo),npy.vstack(soma)
+
+
+class MeanshiftTestSuite(unittest.TestCase):
+    """Meanshift engines test cases."""
+
+    def setUp(self):
+        self.backend = ms.get_backend()
+        self.im = synthetic_image()
+        self.halo,self.soma = cell_triangles()
+
+    def tearDown(self):
+        ms.set_backend(self.backend)
+
+    def run_backend(self,name,triangles,lut,offset=(0.0,0.0)):
+        ms.set_backend(name)
+        return ms.meanshift(self.im,triangles,offset[0],offset[1],lut=lut)
+
+    @unittest.skipIf(ms.compute_g_list is None,'_meanshift C extension not built')
+    def test_numpy_c_parity(self):
+        for triangles,lut,offset in [(self.halo,ms.LUT('white',10),(0.0,0.0)),
+                                     (self.soma,ms.LUT('black',2),(0.0,0.0)),
+                                     (self.halo,ms.LUT('white',1),(2.5,-3.25))]:
+            ref = self.run_backend('c',triangles,lut,offset)
+            res = self.run_backend('numpy',triangles,lut,offset)
+            for i,f in enumerate(ms.meanshift_features):
+                npy.testing.assert_allclose(res[:,i],ref[:,i],rtol=1e-9,atol=1e-9,err_msg=f)
+
+    @unittest.skipIf(ms.compute_g_list is None,'_meanshift C extension not built')
+    def test_dtypes_parity(self):
+        im16 = self.im.astype('uint16')*257
+        im32 = self.im.astype('float32')/255
+        for im,lut in [(im16,ms.LUT('white',10,'uint16')),
+                       (im16,ms.LUT('black',2,'uint16',vmax=4095)),
+                       (im32,ms.PowerLaw('white',10)),
+                       (im32,ms.PowerLaw('black',2))]:
+            ms.set_backend('c')
+            ref = ms.meanshift(im,self.halo,0.0,0.0,lut=lut)
+            ms.set_backend('numpy')
+            res = ms.meanshift(im,self.halo,0.0,0.0,lut=lut)
+            npy.testing.assert_allclose(res,ref,rtol=1e-9,atol=1e-9)
+
+    @unittest.skipIf(ms.compute_g_list is None,'_meanshift C extension not built')
+    def test_scanline(self):
+        """the scanline kernel weights the same pixels as the bounding box kernel
+        """
+        m,n = self.im.shape
+        border = npy.vstack([ms.generate_triangles(x,y,16,30) for x,y in [(5,5),(n-3,40),(-40,-40)]])
+        thin = npy.array([[100.0,100.0,100.2,160.0,100.4,100.0],[50.0,50.0,150.0,50.5,50.0,50.25]])
+        for im,lut in [(self.im,ms.LUT('white',10)),(self.im,ms.LUT('black',2)),
+                       (self.im.astype('float32')/255,ms.PowerLaw('white',10))]:
+            for triangles in [self.halo,self.soma,border,thin]:
+                ms.set_backend('c')
+                ref = ms.meanshift(im,triangles,1.5,-0.25,lut=lut)
+                ms.set_backend('scanline')
+                res = ms.meanshift(im,triangles,1.5,-0.25,lut=lut)
+                npy.testing.assert_array_equal(res[:,[2,5,6]],ref[:,[2,5,6]])
+                npy.testing.assert_allclose(res,ref,rtol=1e-9,atol=1e-9)
+
+    @unittest.skipIf(ms.compute_g_list is None,'_meanshift C extension not built')
+    def test_float32(self):
+        """float32 accumulation stays within its documented error bound (exp 15 weights reach 255**15)
+        """
+        im32 = self.im.astype('float32')/255
+        for im,lut,triangles,radius in [(self.im,ms.LUT('white',15),self.halo,30),
+                                        (self.im,ms.LUT('black',2),self.soma,12),
+                                        (self.im.astype('uint16')*257,ms.LUT('white',15,'uint16'),self.halo,30),
+                                        (im32,ms.PowerLaw('white',15),self.halo,30)]:
+            ms.set_backend('c')
+            ref = ms.meanshift(im,triangles,0.0,0.0,lut=lut)
+            ms.set_backend('float32')
+            res = ms.meanshift(im,triangles,0.0,0.0,lut=lut)
+            m = npy.ceil((2*radius+3)/8.0)
+            npy.testing.assert_allclose(res[:,0:2],ref[:,0:2],rtol=0,atol=2*(m+2)*2**-24*radius)
+            npy.testing.assert_array_equal(res[:,2],ref[:,2])
+            npy.testing.assert_allclose(res[:,[4,5,7]],ref[:,[4,5,7]],rtol=1e-5)
+
+    @unittest.skipIf(ms.compute_g_list is None,'_meanshift C extension not built')
+    def test_huge_coordinates(self):
+        """huge coordinates are clipped to the image, non-finite triangles are rejected
+        """
+        m,n = self.im.shape
+        lut = ms.LUT('white',2)
+        far = npy.array([[1e12,1e12,1e12+5,1e12,1e12,1e12+5],[-1e300,5.0,-1e300,10.0,-1e300-1,5.0]])
+        cover = npy.array([[-1e12,-1e12,1e13,-1e12,-1e12,1e13]])
+        nan = self.halo.copy()
+        nan[3,2] = npy.nan
+        for backend in ['c','scanline','float32','integral']:
+            if backend == 'integral':
+                engine = ms.integral_meanshift
+            else:
+                ms.set_backend(backend)
+                engine = ms.meanshift
+            res = engine(self.im,far,0.0,0.0,lut=lut)
+            npy.testing.assert_array_equal(res[:,2],0)
+            res = engine(self.im,cover,0.0,0.0,lut=lut)
+            self.assertEqual(res[0,2],m*n)
+            self.assertRaises(ValueError,engine,self.im,nan,0.0,0.0,lut=lut)
+            self.assertRaises(ValueError,engine,self.im,self.halo,npy.inf,0.0,lut=lut)
+
+    def test_dtypes(self):
+        """the centroids do not depend on the image dynamic (weights are only scaled)
+        """
+        ref = ms.meanshift(self.im,self.halo,0.0,0.0,lut=ms.LUT('white',10))
+        res16 = ms.meanshift(self.im.astype('uint16')*257,self.halo,0.0,0.0,lut=ms.weight_table('white',10,'uint16'))
+        res32 = ms.meanshift(self.im.astype('float32')/255,self.halo,0.0,0.0,lut=ms.weight_table('white',10,'float32'))
+        npy.testing.assert_allclose(res16[:,0:3],ref[:,0:3],rtol=1e-9)
+        npy.testing.assert_allclose(res32[:,0:3],ref[:,0:3],rtol=1e-6)
+        self.assertRaises(TypeError,ms.meanshift,self.im.astype('float32'),self.halo,0.0,0.0,lut=ms.LUT('white'))
+        self.assertRaises(ValueError,ms.meanshift,self.im.astype('uint16'),self.halo,0.0,0.0,lut=ms.LUT('white'))
+
+    def test_border(self):
+        """triangles crossing (or outside) the image border are clipped to the image
+        """
+        m,n = self.im.shape
+        halo = npy.vstack([ms.generate_triangles(x,y,16,30) for x,y in [(5,5),(n-3,40),(100,m+10),(-40,-40),(n+50,m/2)]])
+        lut = ms.LUT('white',2)
+        for backend in ms.backends:
+            if backend in ms.compiled_backends and ms.compute_g_list is None:
+                continue
+            res = self.run_backend(backend,halo,lut)
+            #centroids of the clipped triangles are inside the image, outside triangles are empty
+            full = res[:,4] > 0
+            self.assertTrue(npy.all(res[full,0:2] >= 0) and npy.all(res[full,0] < n) and npy.all(res[full,1] < m))
+            self.assertTrue(npy.all(res[-32:,2] == 0) and full[:16].all())
+            if backend == 'numpy' and ms.compute_g_list is not None:
+                ref = self.run_backend('c',halo,lut)
+                npy.testing.assert_allclose(res,ref,rtol=1e-9,atol=1e-9)
+
+    def test_threads(self):
+        """results do not depend on the number of kernel threads
+        """
+        lut = ms.LUT('white',10)
+        for backend in ms.backends:
+            if backend in ms.compiled_backends and ms.compute_g_list is None:
+                continue
+            ref = self.run_backend(backend,self.halo,lut)
+            res = ms.meanshift(self.im,self.halo,0.0,0.0,lut=lut,nthreads=3)
+            npy.testing.assert_array_equal(res,ref)
+
+    def test_batch(self):
+        lut = ms.LUT('white',10)
+        ref = ms.meanshift(self.im,npy.vstack((self.halo,self.soma)),0.0,0.0,lut=lut)
+        res = ms.meanshift_batch(self.im,[self.halo,self.soma],0.0,0.0,lut=lut)
+        self.assertEqual(len(res),2)
+        npy.testing.assert_array_equal(npy.vstack(res),ref)
+
+    def test_out(self):
+        lut = ms.LUT('white',10)
+        ref = ms.meanshift(self.im,self.halo,0.0,0.0,lut=lut)
+        out = npy.zeros_like(ref)
+        self.assertTrue(ms.meanshift(self.im,self.halo,0.0,0.0,lut=lut,out=out) is out)
+        npy.testing.assert_array_equal(out,ref)
+        self.assertRaises(ValueError,ms.meanshift,self.im,self.halo,0.0,0.0,lut=lut,out=out[1:])
+        self.assertRaises(ValueError,ms.meanshift,self.im,self.halo,0.0,0.0,lut=lut,out=npy.zeros((8,out.shape[0])).T)
+
+    def test_integral(self):
+        """integral engine against a crisp (no anti-aliasing) brute force reference
+        """
+        yy,xx = npy.mgrid[0:self.im.shape[0],0:self.im.shape[1]]
+        for lut in [ms.LUT('white',2),ms.LUT('white',15)]:
+            w = lut[self.im]
+            res = ms.integral_meanshift(self.im,self.halo,0.0,0.0,lut=lut)
+            res_numpy = npy.zeros_like(res)
+            ms.MomentStore(self.im,lut).compute_g_numpy(self.halo,0.0,0.0,res_numpy)
+            npy.testing.assert_allclose(res_numpy,res,rtol=1e-9)
+            for tri,r in zip(self.halo,res):
+                inside = npy.ones(self.im.shape,dtype=bool)
+                for i,j,k in [(1,0,2),(1,2,0),(0,2,1)]:
+                    a,b,c,s = ms._edge(tri[2*i],tri[2*i+1],tri[2*j],tri[2*j+1],tri[2*k],tri[2*k+1])
+                    inside &= ((a*xx+b*yy+c)*s) >= 0.0
+                mass = w[inside].sum()
+                npy.testing.assert_allclose(r[[0,1,2,4]],
+                    [(xx*w)[inside].sum()/mass,(yy*w)[inside].sum()/mass,inside.sum(),mass],rtol=1e-9)
+            self.assertTrue(npy.isnan(res[:,5:7]).all() and (res[:,2] == res[:,3]).all())
+        self.assertTrue(ms.moment_store(self.im,lut) is ms.moment_store(self.im,lut))
+        self.assertRaises(ValueError,ms.set_backend,'integral')
+
+    @unittest.skipIf(ms.compute_g_list is None,'_meanshift C extension not built')
+    def test_integral_parity(self):
+        """the crisp cell centroids (mass weighted mean of the triangle centroids) stay within half a pixel
+        of the anti-aliased ones at exp 15
+        """
+        lut = ms.LUT('white',15)
+        centers = []
+        for res in [self.run_backend('c',self.halo,lut),ms.integral_meanshift(self.im,self.halo,0.0,0.0,lut=lut)]:
+            res = res.reshape((6,-1,8))
+            mass = res[:,:,4:5]
+            centers.append((res[:,:,0:2]*mass).sum(axis=1)/mass.sum(axis=1))
+        npy.testing.assert_allclose(centers[0],centers[1],rtol=0,atol=0.5)
+
+    def test_pyramid(self):
+        im16 = self.im.astype('uint16')*257
+        for im in [self.im[:,:-1],im16,self.im.astype('float32')]:
+            pyramid = ms.image_pyramid(im,3)
+            self.assertEqual([p.shape for p in pyramid],[im.shape,(im.shape[0]/2,im.shape[1]/2),(im.shape[0]/4,im.shape[1]/4)])
+            self.assertTrue(all([p.dtype == im.dtype for p in pyramid]))
+            self.assertTrue(ms.image_pyramid(im,2)[1] is pyramid[1])
+            npy.testing.assert_allclose(pyramid[1][10,20],im[20:22,40:42].astype(float).mean(),atol=0.5)
+        #pixel (i,j) of level k is located at 2**k*(i,j)+(2**k-1)/2
+        lut = ms.LUT('white',1)
+        tri = npy.asarray([[60.0,40.0,100.0,40.0,60.0,80.0]])
+        ref = ms.meanshift(self.im,tri,0.0,0.0,lut=lut)
+        res = ms.meanshift(ms.image_pyramid(self.im,2)[1],(tri-.5)/2,0.0,0.0,lut=lut)
+        npy.testing.assert_allclose(res[0,0:2]*2+.5,ref[0,0:2],atol=0.5)
+
+    def test_backend_switch(self):
+        self.assertRaises(ValueError,ms.set_backend,'unknown')
+        ms.set_backend('numpy')
+        self.assertEqual(ms.get_backend(),'numpy')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+'''
+Sequence reader test cases
+'''
+__author__ = 'Copyright (C) 2012, Olivier Debeir <odebeir@ulb.ac.be>'
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+import numpy as npy
+
+from ivctrack.reader import Reader,ZipSource,Prefetcher
+from test_meanshift import synthetic_image
+
+
+class ReaderTestSuite(unittest.TestCase):
+    """Sequence reader test cases."""
+
+    def test_read(self):
+        """Reader.read gives the moveto frames, from several threads
+        """
+        from PIL import Image
+        temp = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(temp,'seq.zip')
+            zf = zipfile.ZipFile(filename,'w')
+            for i in range(6):
+                png = os.path.join(temp,'exp%04d.png'%i)
+                Image.fromarray(npy.roll(synthetic_image(),i,axis=1)).save(png)
+                zf.write(png,'exp%04d.png'%i)
+            zf.close()
+            reader = Reader(ZipSource(filename))
+            ref = [reader.moveto(i) for i in range(6)]
+            prefetcher = Prefetcher(reader.read,range(5,-1,-1),depth=3,workers=3)
+            for i in range(5,-1,-1):
+                npy.testing.assert_array_equal(prefetcher.get(i),ref[i])
+            prefetcher.close()
+            self.assertRaises(IndexError,reader.read,6)
+        finally:
+            shutil.rmtree(temp)
+
+    def test_prefetcher(self):
+        """frames come in order, at most depth frames are decoded ahead, skipped frames are not decoded
+        """
+        lock = threading.Lock()
+        created = threading.Event()
+        calls = []
+        def read(frame):
+            created.wait()
+            with lock:
+                calls.append((frame,prefetcher.consumed))
+            time.sleep(0.002)
+            if frame == 13:
+                raise IOError('corrupted frame')
+            return npy.ones(1)*frame
+        prefetcher = Prefetcher(read,range(20),depth=3,workers=2)
+        created.set()
+        for frame in range(8):
+            self.assertEqual(prefetcher.get(frame)[0],frame)
+        time.sleep(0.05)
+        #frames 8..10 are ready, frame 11 waits for a free slot
+        self.assertEqual(max([frame-c for frame,c in calls]),2)
+        self.assertTrue(max(prefetcher.depths) <= 3)
+        self.assertEqual(prefetcher.get(12)[0],12)
+        self.assertRaises(IOError,prefetcher.get,13)
+        self.assertRaises(ValueError,prefetcher.get,5)
+        prefetcher.close()
+        self.assertTrue(prefetcher.decoded <= 17)
+        self.assertEqual(len(prefetcher.depths),10)
+
+
+if __name__ == '__main__':
+    unittest.main()